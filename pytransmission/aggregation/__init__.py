@@ -7,4 +7,7 @@
 Description here
 
 """
-from timeaveraging import MoranCumulativeTimeAverager
\ No newline at end of file
+from timeaveraging import MoranCumulativeTimeAverager, MoranRollingTimeAverager
+from dense import DenseTraitCounts, DenseConfigurationCounts
+from views import CounterView, LocusCountsView
+from spill import CountSpillFile
\ No newline at end of file
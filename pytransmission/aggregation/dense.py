@@ -0,0 +1,252 @@
+# !/usr/bin/env python
+# Copyright (c) 2013.  Mark E. Madsen <mark@madsenlab.org>
+#
+# This work is licensed under the terms of the Apache Software License, Version 2.0.  See the file LICENSE for details.
+
+"""
+Dense NumPy storage for trait counts, used as an alternative to nested dicts of Counter objects when
+there are very many traits (e.g., infinite-alleles models).
+
+"""
+
+import logging as log
+import numpy as np
+from collections import Counter
+
+
+def _integer_labels(traits):
+    # returns the labels as an int64 array if they are all integers, or None
+    if len(traits) == 0 or not isinstance(traits[0], (int, long, np.integer)) or isinstance(traits[0], bool):
+        return None
+    keys = np.asarray(traits)
+    if keys.ndim != 1 or keys.dtype.kind not in 'iu':
+        return None
+    return keys
+
+
+class DenseTraitCounts(object):
+    """
+    Holds trait counts for a number of "slots" (e.g., time averaging intervals or segments) and loci in a single
+    int64 array of shape (slots, loci, traits).  Trait labels are mapped to column indices separately for each
+    locus, in order of first appearance, so that loci with disjoint trait labels do not waste columns.  The trait
+    axis grows by doubling as new traits appear.
+    """
+
+    def __init__(self, numslots, numloci, capacity=1024):
+        """
+
+        :param numslots: Number of slots (intervals or segments) being tracked
+        :param numloci: Number of loci being tracked
+        :param capacity: Initial number of trait columns to allocate
+        :return: void
+        """
+        self.numslots = numslots
+        self.numloci = numloci
+        self.counts = np.zeros((numslots, numloci, capacity), dtype=np.int64)
+        self.trait_index = [dict() for locus in range(0, numloci)]
+        self.traits = [[] for locus in range(0, numloci)]
+        # sorted arrays of integer trait labels and their columns, for vectorized lookups
+        self.sorted_labels = [np.empty(0, dtype=np.int64) for locus in range(0, numloci)]
+        self.sorted_columns = [np.empty(0, dtype=np.int64) for locus in range(0, numloci)]
+
+
+    def _grow(self, needed):
+        capacity = self.counts.shape[2]
+        while capacity < needed:
+            capacity *= 2
+        #log.debug("growing dense trait count array from %s to %s columns", self.counts.shape[2], capacity)
+        grown = np.zeros((self.numslots, self.numloci, capacity), dtype=np.int64)
+        grown[:, :, :self.counts.shape[2]] = self.counts
+        self.counts = grown
+
+
+    def get_columns(self, locus, traits):
+        """
+        Returns the column indices for a sequence of distinct trait labels at a locus, assigning new columns to
+        traits which have not been seen before.  Integer labels (as in infinite-alleles models) are looked up in
+        one vectorized search of a sorted array of the known labels, so that only new traits are handled one at a
+        time; other labels are looked up in a dict.
+
+        :param locus:
+        :param traits: sequence of distinct trait labels
+        :return: numpy array of column indices
+        """
+        keys = _integer_labels(traits)
+        if keys is None:
+            columns = self._lookup_columns(locus, traits)
+        else:
+            columns = np.empty(len(traits), dtype=np.int64)
+            known = self.sorted_labels[locus]
+            if len(known) > 0:
+                pos = np.minimum(np.searchsorted(known, keys), len(known) - 1)
+                hit = known[pos] == keys
+                columns[hit] = self.sorted_columns[locus][pos[hit]]
+                missing = np.flatnonzero(~hit)
+            else:
+                missing = np.arange(len(keys))
+
+            if len(missing) > 0:
+                columns[missing] = self._lookup_columns(locus, [traits[i] for i in missing.tolist()])
+                # add the missing labels to the sorted arrays
+                order = np.argsort(keys[missing])
+                new_labels = keys[missing][order].astype(np.int64)
+                at = np.searchsorted(known, new_labels)
+                self.sorted_labels[locus] = np.insert(known, at, new_labels)
+                self.sorted_columns[locus] = np.insert(self.sorted_columns[locus], at, columns[missing][order])
+
+        if len(self.traits[locus]) > self.counts.shape[2]:
+            self._grow(len(self.traits[locus]))
+        return columns
+
+
+    def _lookup_columns(self, locus, traits):
+        # looks up (or assigns) the columns for a sequence of traits through the dict index
+        index = self.trait_index[locus]
+        labels = self.traits[locus]
+        get = index.get
+        columns = [get(trait) for trait in traits]
+        if None in columns:
+            for i, col in enumerate(columns):
+                if col is None:
+                    trait = traits[i]
+                    col = index.get(trait)
+                    if col is None:
+                        col = len(labels)
+                        index[trait] = col
+                        labels.append(trait)
+                    columns[i] = col
+        return np.array(columns, dtype=np.int64)
+
+
+    def add(self, slots, locus, traits, counts):
+        """
+        Adds counts for a set of traits at one locus to one or more slots.  A trait may appear more than once, in
+        which case its counts are summed.
+
+        :param slots: slot index, or slice of slot indices
+        :param locus:
+        :param traits: sequence of trait labels
+        :param counts: sequence of counts, parallel to traits
+        :return: void
+        """
+        if len(set(traits)) < len(traits):
+            totals = Counter()
+            for trait, count in zip(traits, counts):
+                totals[trait] += count
+            self.add_counts(slots, locus, totals)
+        else:
+            self._add_distinct(slots, locus, traits, counts)
+
+
+    def _add_distinct(self, slots, locus, traits, counts):
+        columns = self.get_columns(locus, traits)
+        # the columns are distinct, so plain fancy-index addition is safe (and much faster than np.add.at)
+        self.counts[slots, locus, columns] += np.asarray(counts, dtype=np.int64)
+
+
+    def add_counts(self, slots, locus, countdict):
+        """
+        Adds a dict (or Counter) of trait:count to one or more slots at a locus.
+
+        :param slots: slot index, or slice of slot indices
+        :param locus:
+        :param countdict:
+        :return: void
+        """
+        self._add_distinct(slots, locus, list(countdict.keys()), list(countdict.values()))
+
+
+    def get_trait_labels(self, locus):
+        """
+        Returns the trait labels at a locus, in column order.
+
+        :param locus:
+        :return: list of trait labels
+        """
+        return self.traits[locus]
+
+
+    def get_counter(self, slot, locus, counts=None):
+        """
+        Returns the non-zero counts for one slot and locus as a Counter.
+
+        :param slot:
+        :param locus:
+        :param counts: array with the same layout as self.counts to read from instead (e.g., a prefix sum of it)
+        :return: Counter mapping traits to counts
+        """
+        if counts is None:
+            counts = self.counts
+        labels = self.traits[locus]
+        row = counts[slot, locus, :len(labels)]
+        nonzero = np.flatnonzero(row)
+        return Counter(dict(zip([labels[i] for i in nonzero], row[nonzero].tolist())))
+
+
+class DenseConfigurationCounts(DenseTraitCounts):
+    """
+    Holds counts of multilocus configurations (tuples of traits, one per locus) for a number of slots.  Each
+    distinct configuration tuple is interned once, and given a single integer id which indexes a column of a
+    growable (slots, configurations) int64 array.  Each configuration is thus hashed once per tick no matter how
+    many slots it is added to, and the tuples are held only once rather than as keys of a Counter per slot.
+    """
+
+    def __init__(self, numslots, capacity=1024):
+        """
+
+        :param numslots: Number of slots (intervals or segments) being tracked
+        :param capacity: Initial number of configuration columns to allocate
+        :return: void
+        """
+        super(DenseConfigurationCounts, self).__init__(numslots, 1, capacity)
+
+
+    def get_columns(self, locus, configurations):
+        # configuration tuples are always interned through the dict index
+        columns = self._lookup_columns(0, configurations)
+        if len(self.traits[0]) > self.counts.shape[2]:
+            self._grow(len(self.traits[0]))
+        return columns
+
+
+    def encode(self, configurations):
+        """
+        Returns the integer ids for a sequence of configuration tuples, interning new configurations.
+
+        :param configurations: sequence of configuration tuples
+        :return: numpy array of integer ids
+        """
+        return self.get_columns(0, configurations)
+
+
+    def decode(self, ids):
+        """
+        Returns the configuration tuples for a sequence of integer ids.
+
+        :param ids: sequence of integer ids
+        :return: list of configuration tuples
+        """
+        configurations = self.traits[0]
+        return [configurations[i] for i in ids]
+
+
+    def add_configurations(self, slots, configuration_map):
+        """
+        Adds a dict of configuration:count to one or more slots.
+
+        :param slots: slot index, or slice of slot indices
+        :param configuration_map:
+        :return: void
+        """
+        self.add_counts(slots, 0, configuration_map)
+
+
+    def get_configuration_counter(self, slot, counts=None):
+        """
+        Returns the non-zero configuration counts for one slot as a Counter.
+
+        :param slot:
+        :param counts: array with the same layout as self.counts to read from instead (e.g., a prefix sum of it)
+        :return: Counter mapping configuration tuples to counts
+        """
+        return self.get_counter(slot, 0, counts)
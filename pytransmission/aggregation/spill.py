@@ -0,0 +1,225 @@
+# !/usr/bin/env python
+# Copyright (c) 2013.  Mark E. Madsen <mark@madsenlab.org>
+#
+# This work is licensed under the terms of the Apache Software License, Version 2.0.  See the file LICENSE for details.
+
+"""
+Append-only on-disk storage for partial trait and configuration counts, which lets time averagers flush their
+in-memory counts periodically during very long runs and merge them back together by streaming over the files.
+
+"""
+
+import logging as log
+import os
+import tempfile
+import numpy as np
+from collections import defaultdict, Counter
+
+
+def _reduce(records, keys):
+    # sorts a record array by its key columns (most significant first), and sums the counts of equal keys
+    if len(records) == 0:
+        return records
+    columns = keys(records)
+    order = np.lexsort(tuple(reversed(columns)))
+    records = records[order]
+    columns = [column[order] for column in columns]
+    new_key = np.zeros(len(records), dtype=bool)
+    new_key[0] = True
+    for column in columns:
+        new_key[1:] |= column[1:] != column[:-1]
+    starts = np.flatnonzero(new_key)
+    reduced = records[starts]
+    reduced['count'] = np.add.reduceat(records['count'], starts)
+    return reduced
+
+
+def _count_not_after(columns, boundary):
+    # number of rows of sorted key columns which are lexicographically less than or equal to the boundary key
+    if len(columns[0]) == 0:
+        return 0
+    less = np.zeros(len(columns[0]), dtype=bool)
+    equal = np.ones(len(columns[0]), dtype=bool)
+    for column, bound in zip(columns, boundary):
+        less |= equal & (column < bound)
+        equal &= column == bound
+    return int(np.count_nonzero(less | equal))
+
+
+class CountSpillFile(object):
+    """
+    A pair of append-only binary files holding partial counts as flat records.  Trait counts are stored as
+    (slot, locus, trait, count) records, and configuration counts as (slot, count, trait at each locus) records,
+    so trait labels must be integers (as they are in infinite-alleles models).  Records are appended unsorted while
+    recording, and compacted into sorted, summed files when counts are read.  The files are read back through
+    numpy.memmap in fixed-size chunks, so compaction never needs more memory than a few chunks, and the interval
+    totals are produced one at a time as the running sums over the sorted files.
+    """
+
+    COUNT_DTYPE = np.dtype([('slot', np.int32), ('locus', np.int32), ('trait', np.int64), ('count', np.int64)])
+
+    def __init__(self, numloci, spill_dir=None, chunk_rows=1000000):
+        """
+
+        :param numloci: Number of loci in each configuration
+        :param spill_dir: Directory in which to create the spill files, or None for the system temporary directory
+        :param chunk_rows: Number of records to read into memory at a time while merging
+        :return: void
+        """
+        self.numloci = numloci
+        self.chunk_rows = chunk_rows
+        self.config_dtype = np.dtype([('slot', np.int32), ('count', np.int64), ('config', np.int64, (numloci,))])
+        (handle, self.path) = tempfile.mkstemp(prefix="ta-spill-", dir=spill_dir)
+        os.close(handle)
+        self.counts_path = self.path + ".counts"
+        self.configs_path = self.path + ".configs"
+        self.sorted_counts_path = self.counts_path + ".sorted"
+        self.sorted_configs_path = self.configs_path + ".sorted"
+        for path in [self.counts_path, self.configs_path, self.sorted_counts_path, self.sorted_configs_path]:
+            open(path, "wb").close()
+
+
+    def append_counts(self, slots, loci, traits, counts):
+        """
+        Appends trait count records, given as parallel sequences.
+
+        :param slots:
+        :param loci:
+        :param traits:
+        :param counts:
+        :return: void
+        """
+        records = np.empty(len(counts), dtype=self.COUNT_DTYPE)
+        records['slot'] = slots
+        records['locus'] = loci
+        records['trait'] = traits
+        records['count'] = counts
+        with open(self.counts_path, "ab") as f:
+            records.tofile(f)
+
+
+    def append_configurations(self, slots, configurations, counts):
+        """
+        Appends configuration count records.
+
+        :param slots: sequence of slot indices
+        :param configurations: sequence of configuration tuples, each with one integer trait per locus
+        :param counts: sequence of counts
+        :return: void
+        """
+        records = np.empty(len(counts), dtype=self.config_dtype)
+        records['slot'] = slots
+        records['count'] = counts
+        if len(counts) > 0:
+            records['config'] = np.asarray(configurations, dtype=np.int64).reshape((len(counts), self.numloci))
+        with open(self.configs_path, "ab") as f:
+            records.tofile(f)
+
+
+    def _chunks(self, path, dtype):
+        if os.path.getsize(path) == 0:
+            return
+        records = np.memmap(path, dtype=dtype, mode='r')
+        for start in xrange(0, len(records), self.chunk_rows):
+            yield np.array(records[start:start + self.chunk_rows])
+        del records
+
+
+    def _count_keys(self, records):
+        return [records['slot'], records['locus'], records['trait']]
+
+
+    def _config_keys(self, records):
+        return [records['slot']] + [records['config'][:, i] for i in range(0, self.numloci)]
+
+
+    def compact(self):
+        """
+        Folds the records appended since the last compaction into the sorted files, which hold one record for each
+        distinct (slot, locus, trait) or (slot, configuration), in key order.  The appended files are then emptied,
+        so the size of the spill file is bounded by the number of distinct keys rather than the length of the run.
+        Compaction streams over the files, so it never holds more than a few chunks in memory.
+
+        :return: void
+        """
+        self._compact(self.counts_path, self.sorted_counts_path, self.COUNT_DTYPE, self._count_keys)
+        self._compact(self.configs_path, self.sorted_configs_path, self.config_dtype, self._config_keys)
+
+
+    def _compact(self, path, sorted_path, dtype, keys):
+        for chunk in self._chunks(path, dtype):
+            run = _reduce(chunk, keys)
+            merged_path = sorted_path + ".merging"
+            with open(merged_path, "wb") as out:
+                for block in self._chunks(sorted_path, dtype):
+                    # the appended run's records up to the last key of this block go out with it, in order
+                    boundary = [column[-1] for column in keys(block)]
+                    take = _count_not_after(keys(run), boundary)
+                    _reduce(np.concatenate((block, run[:take])), keys).tofile(out)
+                    run = run[take:]
+                run.tofile(out)
+            os.rename(merged_path, sorted_path)
+        open(path, "wb").close()
+
+
+    def _iter_prefix_sums(self, sorted_path, dtype, keys, numslots):
+        # The sorted file is ordered by slot, so each slot's records are one contiguous range.  The running totals
+        # are held as a sorted record array, and merged with each slot's records in turn.
+        running = np.empty(0, dtype=dtype)
+        size = os.path.getsize(sorted_path)
+        records = np.memmap(sorted_path, dtype=dtype, mode='r') if size > 0 else np.empty(0, dtype=dtype)
+        bounds = np.searchsorted(records['slot'], np.arange(0, numslots + 1))
+        for slot in xrange(0, numslots):
+            block = np.array(records[bounds[slot]:bounds[slot + 1]])
+            running = _reduce(np.concatenate((running, block)), lambda r: keys(r)[1:])
+            yield (slot, running)
+        del records
+
+
+    def iter_interval_counts(self, numslots):
+        """
+        Compacts the spill file, and then yields the cumulative trait counts for each slot in turn:  the counts
+        for slot i are the sums over slots 0..i, which for segments of nested intervals are the interval totals.
+        Only the running totals, as NumPy arrays, and the Counters for the current slot are held in memory.
+
+        :param numslots:
+        :return: generator of (slot, dict mapping loci to Counters of trait counts)
+        """
+        self.compact()
+        for slot, running in self._iter_prefix_sums(self.sorted_counts_path, self.COUNT_DTYPE, self._count_keys,
+                                                    numslots):
+            merged = defaultdict(Counter)
+            loci = running['locus']
+            starts = np.flatnonzero(np.concatenate(([True], loci[1:] != loci[:-1]))) if len(loci) > 0 else []
+            ends = list(starts[1:]) + [len(loci)]
+            for start, end in zip(starts, ends):
+                merged[int(loci[start])] = Counter(dict(zip(running['trait'][start:end].tolist(),
+                                                            running['count'][start:end].tolist())))
+            yield (slot, merged)
+
+
+    def iter_interval_configurations(self, numslots):
+        """
+        Compacts the spill file, and then yields the cumulative configuration counts for each slot in turn, in the
+        same way as iter_interval_counts().
+
+        :param numslots:
+        :return: generator of (slot, Counter of configuration counts)
+        """
+        self.compact()
+        for slot, running in self._iter_prefix_sums(self.sorted_configs_path, self.config_dtype, self._config_keys,
+                                                    numslots):
+            configs = [tuple(config) for config in running['config'].tolist()]
+            yield (slot, Counter(dict(zip(configs, running['count'].tolist()))))
+
+
+    def remove(self):
+        """
+        Deletes the spill files.
+
+        :return: void
+        """
+        for path in [self.path, self.counts_path, self.configs_path, self.sorted_counts_path,
+                     self.sorted_configs_path]:
+            if os.path.exists(path):
+                os.remove(path)
@@ -9,8 +9,63 @@ Description here
 """
 
 import logging as log
-from collections import defaultdict, Counter
-from copy import deepcopy
+import numpy as np
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, Counter, deque
+from fractions import gcd
+from itertools import izip
+from dense import DenseTraitCounts, DenseConfigurationCounts
+from views import LocusCountsView
+from spill import CountSpillFile
+from pytransmission.utils.sampling import sample_count_rows
+
+
+def _label_array(labels):
+    """
+    Converts a list of trait labels (or of configuration tuples) to an array for saving.  Labels of a single kind
+    (all integers, all floats, or all strings) are stored in a plain array of that kind; mixed labels are stored in
+    an object array, so that np.array() does not coerce them to a common type (e.g., 7 to '7').
+    """
+    kinds = set()
+    for label in labels:
+        for item in (label if isinstance(label, tuple) else (label,)):
+            if isinstance(item, basestring):
+                kinds.add(str)
+            elif isinstance(item, (bool, np.bool_)):
+                kinds.add(bool)
+            elif isinstance(item, (int, long, np.integer)):
+                kinds.add(int)
+            elif isinstance(item, (float, np.floating)):
+                kinds.add(float)
+            else:
+                kinds.add(object)
+    if len(kinds) <= 1 and object not in kinds:
+        return np.array(labels)
+    array = np.empty(len(labels), dtype=object)
+    for idx, label in enumerate(labels):
+        array[idx] = label
+    return array
+
+
+def _concatenate_columns(columns, names):
+    """
+    Concatenates the arrays collected for each column of a columnar table.  Arrays of different dtypes (e.g.,
+    integer and string labels from different intervals) are joined as an object array, so that the labels are not
+    coerced to a common type.  Columns without any rows are returned as empty arrays, of object dtype for the trait
+    and configuration columns and int64 for the others.
+    """
+    table = dict()
+    for name in names:
+        arrays = columns[name]
+        if len(set(array.dtype for array in arrays)) > 1:
+            arrays = [array.astype(object) for array in arrays]
+        if len(arrays) > 0:
+            table[name] = np.concatenate(arrays)
+        elif name in ("trait", "configuration"):
+            table[name] = np.empty(0, dtype=object)
+        else:
+            table[name] = np.empty(0, dtype=np.int64)
+    return table
 
 
 class MoranCumulativeTimeAverager(object):
@@ -28,9 +83,32 @@ class MoranCumulativeTimeAverager(object):
     tick varies.  A starting interval is specified by giving "ending_interval = False", while an ending
     interval is "True."
 
+    By default, each tick's counts are added to every interval which contains the tick.  Because the intervals
+    are nested, the averager can instead be constructed with "segmented = True", which records each tick once,
+    into the "segment" between the shortest active interval and the next shorter one.  The cumulative count for
+    each interval is then the prefix sum of the segments up to that interval, and is only formed when the counts
+    are requested.  This makes the per-tick cost independent of the number of intervals.
+
+    Trait counts are held in Counter objects by default.  Constructing the averager with "dense = True" instead
+    holds them in a DenseTraitCounts array of shape (intervals or segments, loci, traits), which uses much less
+    memory when there are millions of traits, and turns each tick's update into a vectorized add.  In dense mode,
+    configurations are interned to integer ids and counted in a DenseConfigurationCounts array in the same way.
+    The getters return the same Counter structures in either case.
+
+    For very long runs, giving "spill_ticks" makes the averager flush its partial counts to an append-only
+    CountSpillFile every spill_ticks recorded ticks, so that memory stays bounded regardless of run length.  Spilling
+    implies segmented mode, and requires integer trait labels.  When counts are requested, the appended records are
+    merged into a sorted, compacted spill file, and the per-interval totals are streamed from it one interval at a
+    time (see iter_counts_for_generation_intervals()), so they are never all held on the averager.
+
+    Averagers with the same intervals can be combined with merge(), which adds the counts of one averager into
+    another (e.g., to pool replicates in a map-reduce), and their state can be saved to and loaded from a compact
+    NumPy .npz file with save() and load().
+
     """
 
-    def __init__(self, indextime, interval_list, popsize, numloci, ending_interval=True):
+    def __init__(self, indextime, interval_list, popsize, numloci, ending_interval=True, segmented=False, dense=False,
+                 spill_ticks=None, spill_dir=None):
         """
 
         :param indextime: The simulation tick which is either the starting or ending time for the "stack" of TA intervals
@@ -38,18 +116,41 @@ class MoranCumulativeTimeAverager(object):
         :param popsize: Population size of agents, used to turn generations into clock ticks in a Moran model
         :param numloci: Number of dimensions or loci for which we're counting traits
         :param ending_interval: Boolean, indicates whether this TA interval stack is at the beginning of a survival analysis or the end.  A set of intervals not used for a dual-sample analysis should give "True" or let this default.
+        :param segmented: Boolean, record each tick once into its segment and form the interval counts by prefix sums when read
+        :param dense: Boolean, accumulate trait counts in a dense NumPy array rather than in Counters
+        :param spill_ticks: If given, flush partial counts to disk after this many recorded ticks
+        :param spill_dir: Directory for the spill file, or None for the system temporary directory
         :return: void
 
         """
+        self.interval_list = list(interval_list)
+        self.popsize = popsize
         self.intervals_by_tick = [t * popsize for t in interval_list]
         self.int_tick_to_gen = dict(zip(self.intervals_by_tick, interval_list))
         self.int_gen_to_tick = dict(zip(interval_list, self.intervals_by_tick))
         self.interval_tuples = []
+        self.indextime = indextime
+        self.ending_interval = ending_interval
+        # the intervals are nested, so the intervals active at any tick are always the longest ones.  Keeping
+        # the durations sorted lets us find them by bisection instead of testing every interval.
+        self.sorted_intervals = sorted(set(self.intervals_by_tick))
         self.earliest_tick = 0
         self.latest_tick = 0
         self.interval_tuple_map = dict()
         self.counts_by_interval_by_locus = dict()
         self.configurations_by_interval = dict()
+        self.numloci = numloci
+        self.segmented = segmented or spill_ticks is not None
+        self.dense = dense
+        self.spill_ticks = spill_ticks
+        self.spill_file = None
+        self.ticks_since_spill = 0
+        self.counts_by_segment_by_locus = []
+        self.configurations_by_segment = []
+        self.dense_counts = None
+        self.dense_configurations = None
+        self.counts_dirty = False
+        self.shared_counters = set()
         #log.debug("map intervals: %s", self.int_tick_to_gen)
 
         # initialize the count maps.  We use the Counter class because we can update an entire locus of counts
@@ -60,6 +161,22 @@ class MoranCumulativeTimeAverager(object):
             for locus in range(0,numloci):
                 self.counts_by_interval_by_locus[interval][locus] = Counter()
 
+        # segment i holds the ticks at which sorted_intervals[i] is the shortest active interval
+        if self.segmented == True:
+            for segment in self.sorted_intervals:
+                locus_map = defaultdict(Counter)
+                for locus in range(0,numloci):
+                    locus_map[locus] = Counter()
+                self.counts_by_segment_by_locus.append(locus_map)
+                self.configurations_by_segment.append(Counter())
+
+        # in dense mode, slot i of the array is either sorted_intervals[i] or its segment
+        if self.dense == True:
+            self.dense_counts = DenseTraitCounts(len(self.sorted_intervals), numloci)
+            self.dense_configurations = DenseConfigurationCounts(len(self.sorted_intervals))
+
+        if self.spill_ticks is not None:
+            self.spill_file = CountSpillFile(numloci, spill_dir)
 
         #log.debug("initialized count map: %s", self.counts_by_interval_by_locus)
 
@@ -88,6 +205,8 @@ class MoranCumulativeTimeAverager(object):
             self.earliest_tick = min(start_list)
             self.latest_tick = indextime
 
+        self.interval_boundaries = sorted(set([tup[0] for tup in self.interval_tuples] + [tup[1] for tup in self.interval_tuples]))
+
         #log.debug("intervals as tuples: %s", self.interval_tuples)
         #log.debug("interval tuple map: %s", self.interval_tuple_map)
 
@@ -115,40 +234,416 @@ class MoranCumulativeTimeAverager(object):
         return tup[0] <= timestep < tup[1]
 
 
+    def _first_active_index(self, timestep):
+        """
+        Returns the index in sorted_intervals of the shortest interval whose half-open tuple contains the
+        timestep, found by bisection over the sorted durations.  Every longer interval is active as well.
+
+        :param timestep:
+        :return: index into sorted_intervals, or None if the timestep is outside all of the intervals
+        """
+        if timestep < self.earliest_tick or timestep >= self.latest_tick:
+            return None
+
+        if self.ending_interval == True:
+            # interval d is active if indextime <= timestep < indextime + d
+            return bisect_right(self.sorted_intervals, timestep - self.indextime)
+        else:
+            # interval d is active if indextime - d <= timestep < indextime
+            return bisect_left(self.sorted_intervals, self.indextime - timestep)
+
+
+    def _active_intervals(self, timestep):
+        """
+        Returns the intervals (in ticks) whose half-open tuples contain the timestep.
+
+        :param timestep:
+        :return: list of intervals, in ticks, shortest first
+        """
+        idx = self._first_active_index(timestep)
+        if idx is None:
+            return []
+        return self.sorted_intervals[idx:]
+
+
+    def _sync_counts(self):
+        """
+        Rebuilds the cumulative Counters for each interval from the segments (in segmented mode) or the dense
+        count array (in dense mode), if anything has been recorded since the last time they were built.  In the
+        default mode the Counters are updated directly and there is nothing to do.  When spilling, the interval
+        totals are never stored on the averager (see _iter_interval_totals()).
+
+        :return: void
+        """
+        if self.counts_dirty == False or self.spill_file is not None:
+            return
+
+        if self.dense == True:
+            counts = self.dense_counts.counts
+            configs = self.dense_configurations.counts
+            if self.segmented == True:
+                counts = counts.cumsum(axis=0)
+                configs = configs.cumsum(axis=0)
+            for idx, interval in enumerate(self.sorted_intervals):
+                for locus in range(0, self.numloci):
+                    self.counts_by_interval_by_locus[interval][locus] = self.dense_counts.get_counter(idx, locus, counts)
+                self.configurations_by_interval[interval] = self.dense_configurations.get_configuration_counter(idx, configs)
+
+        elif self.segmented == True:
+            self._build_from_segments(self.counts_by_segment_by_locus, self.configurations_by_segment)
+
+        self.counts_dirty = False
+
+
+    def _build_from_segments(self, segment_counts, segment_configurations):
+        """
+        Sets the cumulative Counters for each interval to the prefix sums of a list of per-segment counts.
+
+        :param segment_counts: list of dicts mapping loci to Counters, one per segment
+        :param segment_configurations: list of configuration Counters, one per segment
+        :return: void
+        """
+        running_counts = defaultdict(Counter)
+        running_configs = Counter()
+        for idx, interval in enumerate(self.sorted_intervals):
+            for locus, counter in segment_counts[idx].items():
+                running_counts[locus].update(counter)
+            for locus in running_counts.keys():
+                self.counts_by_interval_by_locus[interval][locus] = Counter(running_counts[locus])
+            running_configs.update(segment_configurations[idx])
+            self.configurations_by_interval[interval] = Counter(running_configs)
+
+
+    def _iter_interval_totals(self):
+        """
+        Yields the cumulative counts for each interval, shortest first.  When spilling, the in-memory partial
+        counts are flushed, and the totals are streamed from the compacted spill file one interval at a time, so that
+        only one interval's counts are in memory at once and none are kept on the averager.  Otherwise the stored
+        Counters are yielded.
+
+        :return: generator of (interval in ticks, dict of loci mapping to Counters, configuration Counter)
+        """
+        if self.spill_file is None:
+            self._sync_counts()
+            for interval in self.sorted_intervals:
+                yield (interval, self.counts_by_interval_by_locus[interval], self.configurations_by_interval[interval])
+            return
+
+        self.spill()
+        numslots = len(self.sorted_intervals)
+        counts = self.spill_file.iter_interval_counts(numslots)
+        configurations = self.spill_file.iter_interval_configurations(numslots)
+        for (idx, locus_map), (idx2, configs) in izip(counts, configurations):
+            # every locus is present, as in the stored maps, even if nothing was recorded for it
+            for locus in range(0, self.numloci):
+                locus_map.setdefault(locus, Counter())
+            yield (self.sorted_intervals[idx], locus_map, configs)
+
+
+    def _interval_batches(self):
+        """
+        Groups the intervals for batched sampling:  all of them together when the counts are held in memory, or
+        one at a time when they are streamed from a spill file, which keeps memory bounded.
+
+        :return: generator of lists of (interval in ticks, dict of loci mapping to Counters, configuration Counter)
+        """
+        if self.spill_file is None:
+            yield list(self._iter_interval_totals())
+        else:
+            for totals in self._iter_interval_totals():
+                yield [totals]
+
+
+    def spill(self):
+        """
+        Appends the partial counts held in memory to the spill file, and clears them.  This is called
+        automatically every spill_ticks recorded ticks, and before the counts are merged for a getter.
+
+        :return: void
+        """
+        slots = []
+        loci = []
+        traits = []
+        counts = []
+        config_slots = []
+        configs = []
+        config_counts = []
+
+        if self.dense == True:
+            for locus in range(0, self.numloci):
+                labels = self.dense_counts.get_trait_labels(locus)
+                (slot, col) = np.nonzero(self.dense_counts.counts[:, locus, :len(labels)])
+                slots.extend(slot.tolist())
+                loci.extend([locus] * len(slot))
+                traits.extend([labels[i] for i in col])
+                counts.extend(self.dense_counts.counts[slot, locus, col].tolist())
+            num_configs = len(self.dense_configurations.get_trait_labels(0))
+            (slot, col) = np.nonzero(self.dense_configurations.counts[:, 0, :num_configs])
+            config_slots.extend(slot.tolist())
+            configs.extend(self.dense_configurations.decode(col))
+            config_counts.extend(self.dense_configurations.counts[slot, 0, col].tolist())
+            self.dense_counts = DenseTraitCounts(len(self.sorted_intervals), self.numloci)
+            self.dense_configurations = DenseConfigurationCounts(len(self.sorted_intervals))
+        else:
+            for slot, locus_map in enumerate(self.counts_by_segment_by_locus):
+                for locus, counter in locus_map.items():
+                    for trait, count in counter.items():
+                        slots.append(slot)
+                        loci.append(locus)
+                        traits.append(trait)
+                        counts.append(count)
+                    locus_map[locus] = Counter()
+            for slot, counter in enumerate(self.configurations_by_segment):
+                for config, count in counter.items():
+                    config_slots.append(slot)
+                    configs.append(config)
+                    config_counts.append(count)
+                self.configurations_by_segment[slot] = Counter()
+
+        self.spill_file.append_counts(slots, loci, traits, counts)
+        self.spill_file.append_configurations(config_slots, configs, config_counts)
+        self.ticks_since_spill = 0
+
+
+    def remove_spill_file(self):
+        """
+        Deletes the spill file, if this averager is spilling counts to disk.
+
+        :return: void
+        """
+        if self.spill_file is not None:
+            self.spill_file.remove()
+
 
     def record_trait_count_sample(self,timestep,countmap,configuration_map):
         """
         Given a time step, a map of trait counts by locus, and a map of counts for the cartesian product of loci (configurations),
-         we iterate over the
-        intervals for which we're accumulating samples.  If the timestep fits within a given
-        time interval, the counts for each locus are added to those already held in the
-        accumulator.  Otherwise, we move on to the next interval.
+         we find the intervals which contain the timestep.  For each of them, the counts for each locus are added to
+         those already held in the accumulator.  Timesteps outside all of the intervals are skipped immediately.
+
+        In segmented mode, the counts are added once, to the segment for the shortest active interval.  In dense
+        mode, the counts for each locus are added to the count array in one vectorized operation.
 
         :param timestep:
         :param countmap:
         :return:
         """
+        idx = self._first_active_index(timestep)
+        if idx is None:
+            return
+
+        if self.dense == True:
+            slots = idx if self.segmented == True else slice(idx, None)
+            for locus in countmap.keys():
+                self.dense_counts.add_counts(slots, locus, countmap[locus])
+            self.dense_configurations.add_configurations(slots, configuration_map)
+            self.counts_dirty = True
+            self._check_spill()
+            return
+
+        if self.segmented == True:
+            for locus in countmap.keys():
+                self.counts_by_segment_by_locus[idx][locus].update(countmap[locus])
+            self.configurations_by_segment[idx].update(configuration_map)
+            self.counts_dirty = True
+            self._check_spill()
+            return
+
+        for interval in self.sorted_intervals[idx:]:
+            # iterate over the loci in countmap, create a counter from the map from each locus, add that counter to the
+            # main counter.  We use the addition operator because both objects are Counters, which will add the
+            # counts from temp_counter to that held in the cache.
+
+            for locus in countmap.keys():
+                counts = countmap[locus]
+                if (interval, locus) in self.shared_counters:
+                    # copy on write, since the caller holds a view of this Counter
+                    self.counts_by_interval_by_locus[interval][locus] = Counter(self.counts_by_interval_by_locus[interval][locus])
+                    self.shared_counters.discard((interval, locus))
+                #log.debug("interval: %s before timestep %s: %s", timestep, self.counts_by_interval_by_locus[interval][locus])
+                self.counts_by_interval_by_locus[interval][locus].update(counts)
+                #log.debug("interval: %s  counts after timestep %s: %s", interval, timestep, self.counts_by_interval_by_locus[interval][locus])
+
+            # configuration_map has the right structure to let Counter do the work
+            self.configurations_by_interval[interval].update(configuration_map)
+
+            #log.debug("configurations for interval %s: %s", interval, self.configurations_by_interval[interval])
+
+
+    def record_trait_count_span(self, timestep, nticks, countmap, configuration_map):
+        """
+        Records the same counts for each of nticks consecutive time steps starting at timestep, with the same
+        result as calling record_trait_count_sample() once per tick.  The span is split wherever it crosses the start
+        or end of an interval, and the counts for each piece are multiplied by its length and recorded once.  This
+        lets simulators which skip over ticks where nothing changes (see MoranInfiniteAlleles) record whole runs
+        of unchanged ticks at once.
 
-        for interval, tuple in self.interval_tuple_map.items():
-            if self._is_within_tuple(tuple,timestep):
-                # iterate over the loci in countmap, create a counter from the map from each locus, add that counter to the
-                # main counter.  We use the addition operator because both objects are Counters, which will add the
-                # counts from temp_counter to that held in the cache.
+        :param timestep: first tick of the span
+        :param nticks: number of ticks in the span
+        :param countmap:
+        :param configuration_map:
+        :return: void
+        """
+        start = max(timestep, self.earliest_tick)
+        end = min(timestep + nticks, self.latest_tick)
+        if start >= end:
+            return
 
-                for locus in countmap.keys():
-                    counts = countmap[locus]
-                    #log.debug("interval: %s before timestep %s: %s", timestep, self.counts_by_interval_by_locus[interval][locus])
-                    self.counts_by_interval_by_locus[interval][locus].update(counts)
-                    #log.debug("interval: %s  counts after timestep %s: %s", interval, timestep, self.counts_by_interval_by_locus[interval][locus])
+        cuts = [start] + [b for b in self.interval_boundaries if start < b < end] + [end]
+        for (piece_start, piece_end) in zip(cuts[:-1], cuts[1:]):
+            length = piece_end - piece_start
+            scaled_countmap = dict((locus, dict((trait, count * length) for trait, count in counts.items()))
+                                   for locus, counts in countmap.items())
+            scaled_configs = dict((config, count * length) for config, count in configuration_map.items())
+            self.record_trait_count_sample(piece_start, scaled_countmap, scaled_configs)
 
-                # configuration_map has the right structure to let Counter do the work
-                self.configurations_by_interval[interval].update(configuration_map)
 
-                #log.debug("configurations for interval %s: %s", interval, self.configurations_by_interval[interval])
+    def _add_interval_totals(self, interval_totals):
+        """
+        Adds cumulative per-interval counts to this averager's storage, whatever its mode.  In segmented modes the
+        totals are first turned back into per-segment counts, as the differences between the totals for successive
+        nested intervals.
 
+        :param interval_totals: iterable of (interval in ticks, dict of loci mapping to Counters, configuration
+            Counter), shortest interval first, as from _iter_interval_totals()
+        :return: void
+        """
+        previous_counts = defaultdict(Counter)
+        previous_configs = Counter()
+        for idx, (interval, locus_map, configs) in enumerate(interval_totals):
+            configs = Counter(configs)
+
+            if self.segmented == True:
+                deltas = dict((locus, Counter(counter) - previous_counts[locus]) for locus, counter in locus_map.items())
+                config_deltas = configs - previous_configs
+                previous_counts = defaultdict(Counter)
+                for locus, counter in locus_map.items():
+                    previous_counts[locus] = Counter(counter)
+                previous_configs = configs
             else:
-                #log.debug("timestep %s not within interval %s", timestep, interval)
-                continue
+                deltas = locus_map
+                config_deltas = configs
+
+            if self.spill_file is not None:
+                records = [(locus, trait, count) for locus, counter in deltas.items() for trait, count in counter.items()]
+                self.spill_file.append_counts([idx] * len(records), [r[0] for r in records], [r[1] for r in records],
+                                              [r[2] for r in records])
+                self.spill_file.append_configurations([idx] * len(config_deltas), list(config_deltas.keys()),
+                                                      list(config_deltas.values()))
+            elif self.dense == True:
+                for locus, counter in deltas.items():
+                    self.dense_counts.add_counts(idx, locus, counter)
+                self.dense_configurations.add_configurations(idx, config_deltas)
+            elif self.segmented == True:
+                for locus, counter in deltas.items():
+                    self.counts_by_segment_by_locus[idx][locus].update(counter)
+                self.configurations_by_segment[idx].update(config_deltas)
+            else:
+                for locus, counter in deltas.items():
+                    if (interval, locus) in self.shared_counters:
+                        self.counts_by_interval_by_locus[interval][locus] = Counter(self.counts_by_interval_by_locus[interval][locus])
+                        self.shared_counters.discard((interval, locus))
+                    self.counts_by_interval_by_locus[interval][locus].update(counter)
+                self.configurations_by_interval[interval].update(config_deltas)
+
+        self.counts_dirty = True
+
+
+    def merge(self, other):
+        """
+        Adds the counts accumulated by another averager into this one.  Both averagers must track the same
+        intervals, but may use different storage modes.  Merging is associative, so replicate averagers can be
+        combined pairwise in any grouping, e.g., reduce(lambda a, b: a.merge(b), averagers).
+
+        :param other: MoranCumulativeTimeAverager with the same intervals
+        :return: this averager, with the counts of other added
+        """
+        if sorted(self.interval_tuples) != sorted(other.interval_tuples) or self.numloci != other.numloci:
+            raise ValueError("cannot merge time averagers with different intervals or numbers of loci")
+
+        self._add_interval_totals(other._iter_interval_totals())
+        return self
+
+
+    def save(self, path):
+        """
+        Saves the intervals and accumulated counts of this averager to a NumPy .npz file, as flat arrays of
+        (interval, locus, trait, count) records and (interval, count, configuration) records.  Trait labels
+        of a single type are stored in a plain array; mixed labels (e.g., integers and strings) are pickled in an
+        object array so that their types survive the round trip.
+
+        :param path: file name or open file
+        :return: void
+        """
+        interval_idx = []
+        loci = []
+        traits = []
+        counts = []
+        config_idx = []
+        configs = []
+        config_counts = []
+        for idx, (interval, locus_map, configurations) in enumerate(self._iter_interval_totals()):
+            for locus, counter in locus_map.items():
+                for trait, count in counter.items():
+                    if count > 0:
+                        interval_idx.append(idx)
+                        loci.append(locus)
+                        traits.append(trait)
+                        counts.append(count)
+            for config, count in configurations.items():
+                if count > 0:
+                    config_idx.append(idx)
+                    configs.append(config)
+                    config_counts.append(count)
+
+        np.savez_compressed(path,
+                            indextime=np.array(self.indextime),
+                            interval_list=np.array(self.interval_list),
+                            popsize=np.array(self.popsize),
+                            numloci=np.array(self.numloci),
+                            ending_interval=np.array(self.ending_interval),
+                            count_interval=np.array(interval_idx, dtype=np.int32),
+                            count_locus=np.array(loci, dtype=np.int32),
+                            count_trait=_label_array(traits),
+                            count=np.array(counts, dtype=np.int64),
+                            config_interval=np.array(config_idx, dtype=np.int32),
+                            config=_label_array(configs),
+                            config_count=np.array(config_counts, dtype=np.int64))
+
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """
+        Creates an averager from a file written by save().  Keyword arguments (e.g., segmented, dense) are passed
+        to the constructor to choose the storage mode of the new averager.
+
+        :param path: file name or open file
+        :return: MoranCumulativeTimeAverager
+        """
+        data = np.load(path, allow_pickle=True)
+        tatrack = cls(data['indextime'].item(), data['interval_list'].tolist(), data['popsize'].item(),
+                      data['numloci'].item(), ending_interval=data['ending_interval'].item(), **kwargs)
+
+        counts_by_interval = dict((interval, defaultdict(Counter)) for interval in tatrack.sorted_intervals)
+        for idx, locus, trait, count in zip(data['count_interval'].tolist(), data['count_locus'].tolist(),
+                                            data['count_trait'].tolist(), data['count'].tolist()):
+            counts_by_interval[tatrack.sorted_intervals[idx]][locus][trait] = count
+
+        configurations_by_interval = dict((interval, Counter()) for interval in tatrack.sorted_intervals)
+        for idx, config, count in zip(data['config_interval'].tolist(), data['config'].tolist(),
+                                      data['config_count'].tolist()):
+            configurations_by_interval[tatrack.sorted_intervals[idx]][tuple(config)] = count
+
+        tatrack._add_interval_totals((interval, counts_by_interval[interval], configurations_by_interval[interval])
+                                     for interval in tatrack.sorted_intervals)
+        return tatrack
+
+
+    def _check_spill(self):
+        if self.spill_file is not None:
+            self.ticks_since_spill += 1
+            if self.ticks_since_spill >= self.spill_ticks:
+                self.spill()
 
 
     def get_counts_for_interval_generations(self, gen):
@@ -156,19 +651,72 @@ class MoranCumulativeTimeAverager(object):
         Returns the count map for a given interval, where the interval is specified in generations.  This argument
         is turned into ticks for a Moran model, and the appropriate map of counts (by locus) is returned.
 
-        A deep copy of the original countmap is returned, so that the caller does not accidentally modify an ongoing
-        cumulative counting operation.
+        A read-only snapshot view of the countmap is returned, so that the caller does not accidentally modify an
+        ongoing cumulative counting operation.  The counts are not copied:  the averager copies a Counter only if
+        it needs to record into it after it has been handed out, so the snapshot is not affected by later ticks.
+        Call copy() on the view to get mutable Counters.
 
         :param gen:
-        :return: dict of loci with Counter() instances mapping traits to counts
+        :return: LocusCountsView mapping loci to read-only views of Counter instances mapping traits to counts
         """
         interval_by_tick = self.int_gen_to_tick[gen]
-        countmap = self.counts_by_interval_by_locus[interval_by_tick]
-        return deepcopy(countmap)
+        if self.spill_file is not None:
+            for interval, locus_map, configs in self._iter_interval_totals():
+                if interval == interval_by_tick:
+                    return LocusCountsView(locus_map)
+        self._sync_counts()
+        return self._share_interval(interval_by_tick)
 
 
     def get_counts_all_intervals(self):
-        return deepcopy(self.counts_by_interval_by_locus)
+        """
+        Returns read-only snapshot views of the count maps for all intervals, in the same manner as
+        get_counts_for_interval_generations().
+
+        :return: dict of intervals (in ticks), each pointing to a LocusCountsView
+        """
+        if self.spill_file is not None:
+            return {interval: LocusCountsView(locus_map) for interval, locus_map, configs in self._iter_interval_totals()}
+        self._sync_counts()
+        return {interval: self._share_interval(interval) for interval in self.counts_by_interval_by_locus.keys()}
+
+
+    def iter_counts_for_generation_intervals(self):
+        """
+        Yields read-only views of the count maps for each interval in turn, shortest first.  When spilling,
+        only one interval's counts are held in memory at a time, so this is the way to read the counts of a
+        very long run without holding them all at once.
+
+        :return: generator of (duration in generations, LocusCountsView)
+        """
+        for interval, locus_map, configs in self._iter_interval_totals():
+            view = self._share_interval(interval) if self.spill_file is None else LocusCountsView(locus_map)
+            yield (self.int_tick_to_gen[interval], view)
+
+
+    def iter_configuration_counts_for_generation_intervals(self):
+        """
+        Yields the configuration counts for each interval in turn, shortest first, in the same manner as
+        iter_counts_for_generation_intervals().
+
+        :return: generator of (duration in generations, dict with configuration as key, and count as value)
+        """
+        for interval, locus_map, configs in self._iter_interval_totals():
+            yield (self.int_tick_to_gen[interval], {config: count for config, count in configs.items() if count > 0})
+
+
+    def _share_interval(self, interval):
+        """
+        Returns a view of the counts for an interval, and marks its Counters as shared so that they are copied
+        before they are next written.
+
+        :param interval: interval in ticks
+        :return: LocusCountsView
+        """
+        countmap = self.counts_by_interval_by_locus[interval]
+        for locus in countmap.keys():
+            self.shared_counters.add((interval, locus))
+        return LocusCountsView(countmap)
 
 
     def get_counts_for_generation_intervals(self):
@@ -182,7 +730,7 @@ class MoranCumulativeTimeAverager(object):
         :return: dict of durations (in generations), each pointing to a dict of loci with Counter instances mapping traits to counts.
         """
         countmap_gens = dict()
-        for interval, map in self.counts_by_interval_by_locus.items():
+        for interval, map, configs in self._iter_interval_totals():
             gens = self.int_tick_to_gen[interval]
             countmap_gens[gens] = map
         return countmap_gens
@@ -195,25 +743,287 @@ class MoranCumulativeTimeAverager(object):
 
         :return: dict of durations (in generations), each pointing to a dict with configuration as key, and count as value
         """
-        countmap_gens = dict()
-        for interval, counter in self.configurations_by_interval.items():
-            gens = self.int_tick_to_gen[interval]
-            #countmap_gens[gens] = dict(counter)  # TODO only return non-zero items from the counter?
-            countmap_gens[gens] = {config: count for config, count in counter.items() if count > 0}
-        return countmap_gens
+        return dict(self.iter_configuration_counts_for_generation_intervals())
+
+
+    def _sample_interval_counters(self, counters, ssize_list, replace):
+        """
+        Samples every sample size from each of a list of Counters (one per interval) in a single batched draw.
+        The Counters are laid out as rows of one count matrix over the union of their labels, repeated once per
+        sample size, and sampled together with sample_count_rows().
+
+        :param counters: list of Counters, one per interval
+        :param ssize_list:
+        :param replace: Boolean, whether to sample with replacement (multinomial) or without (hypergeometric)
+        :return: tuple of (list of labels, array of shape (len(counters), len(ssize_list), len(labels)) of sampled counts)
+        """
+        label_index = dict()
+        labels = []
+        for counter in counters:
+            for label, count in counter.items():
+                if count > 0 and label not in label_index:
+                    label_index[label] = len(labels)
+                    labels.append(label)
+
+        matrix = np.zeros((len(counters), len(labels)), dtype=np.int64)
+        for row, counter in enumerate(counters):
+            for label, count in counter.items():
+                if count > 0:
+                    matrix[row, label_index[label]] = count
 
+        # sample_count_rows() rejects sample sizes larger than a population only when sampling without replacement
+        rows = np.repeat(matrix, len(ssize_list), axis=0)
+        sizes = np.tile(np.asarray(ssize_list, dtype=np.int64), len(counters))
+        sampled = sample_count_rows(rows, sizes, replace=replace)
+        return (labels, sampled.reshape((len(counters), len(ssize_list), len(labels))))
 
-    def get_counts_for_generation_for_ssize_for_intervals(self, ssize_list):
+
+    def get_counts_for_generation_for_ssize_for_intervals(self, ssize_list, replace=True, columnar=False):
         """
         Returns trait counts by locus, for each time interval in generations, for each sample size requested.
         The output is nested by interval, locus, ssize, then trait:count
 
+        All of the intervals and sample sizes for a locus are subsampled together in one batched draw (or one
+        interval at a time when spilling, to keep memory bounded), with replacement (multinomial) by default, or
+        without replacement (multivariate hypergeometric) if replace is False.  Traits which do not appear in a sample are omitted from its dict.
+
+        Given columnar = True, the samples are instead returned as a flat table:  a dict of parallel numpy arrays
+        "interval" (in generations), "locus", "ssize", "trait", and "count", with one entry per non-zero count.  Mixed
+        trait labels keep their types, in an object array.
+
         :param ssize_list:
+        :param replace: Boolean, whether to sample with replacement (sample sizes may then exceed the interval totals)
+        :param columnar: Boolean, return a flat table of parallel arrays instead of nested dicts
         :return: nested dicts giving trait counts by interval, locus, and sample size
         """
-        pass
+        result = dict()
+        columns = defaultdict(list)
+        for batch in self._interval_batches():
+            gens = [self.int_tick_to_gen[interval] for interval, locus_map, configs in batch]
+            for gen in gens:
+                result[gen] = dict()
+            for locus in range(0, self.numloci):
+                counters = [locus_map[locus] for interval, locus_map, configs in batch]
+                (labels, sampled) = self._sample_interval_counters(counters, ssize_list, replace)
+
+                if columnar == True:
+                    (irow, scol, tcol) = np.nonzero(sampled)
+                    if len(irow) > 0:
+                        columns["interval"].append(np.asarray(gens)[irow])
+                        columns["locus"].append(np.repeat(locus, len(irow)))
+                        columns["ssize"].append(np.asarray(ssize_list)[scol])
+                        columns["trait"].append(_label_array(labels)[tcol])
+                        columns["count"].append(sampled[irow, scol, tcol])
+                    continue
+
+                for irow, gen in enumerate(gens):
+                    by_ssize = dict()
+                    for scol, ssize in enumerate(ssize_list):
+                        row = sampled[irow, scol]
+                        nonzero = np.flatnonzero(row)
+                        by_ssize[ssize] = dict(zip([labels[i] for i in nonzero], row[nonzero].tolist()))
+                    result[gen][locus] = by_ssize
+
+        if columnar == True:
+            return _concatenate_columns(columns, ["interval", "locus", "ssize", "trait", "count"])
+        return result
+
+
+    def get_configurations_for_generation_for_ssize_for_intervals(self, ssize_list, replace=True, columnar=False):
+        """
+        Returns configuration counts for each time interval in generations, for each sample size requested.
+        The output is nested by interval, ssize, then configuration:count.  Sampling is batched across intervals
+        and sample sizes in the same way as get_counts_for_generation_for_ssize_for_intervals().
+
+        Given columnar = True, the samples are instead returned as a dict of parallel numpy arrays "interval"
+        (in generations), "ssize", "configuration" (an object array of configuration tuples), and "count".
+
+        :param ssize_list:
+        :param replace: Boolean, whether to sample with replacement
+        :param columnar: Boolean, return a flat table of parallel arrays instead of nested dicts
+        :return: nested dicts giving configuration counts by interval and sample size
+        """
+        result = dict()
+        columns = defaultdict(list)
+        for batch in self._interval_batches():
+            gens = [self.int_tick_to_gen[interval] for interval, locus_map, configs in batch]
+            counters = [configs for interval, locus_map, configs in batch]
+            (labels, sampled) = self._sample_interval_counters(counters, ssize_list, replace)
 
-    def get_configurations_for_generation_for_ssize_for_intervals(self, ssize_list):
-        pass
+            if columnar == True:
+                (irow, scol, ccol) = np.nonzero(sampled)
+                if len(irow) > 0:
+                    configurations = np.empty(len(ccol), dtype=object)
+                    configurations[:] = [labels[i] for i in ccol]
+                    columns["interval"].append(np.asarray(gens)[irow])
+                    columns["ssize"].append(np.asarray(ssize_list)[scol])
+                    columns["configuration"].append(configurations)
+                    columns["count"].append(sampled[irow, scol, ccol])
+                continue
+
+            for irow, gen in enumerate(gens):
+                by_ssize = dict()
+                for scol, ssize in enumerate(ssize_list):
+                    row = sampled[irow, scol]
+                    nonzero = np.flatnonzero(row)
+                    by_ssize[ssize] = dict(zip([labels[i] for i in nonzero], row[nonzero].tolist()))
+                result[gen] = by_ssize
+
+        if columnar == True:
+            return _concatenate_columns(columns, ["interval", "ssize", "configuration", "count"])
+        return result
+
+
+class MoranRollingTimeAverager(object):
+    """
+    Tracks time averaged trait counts over a sequence of sliding windows, rather than a stack of nested intervals
+    anchored at one index time.  Windows have a fixed duration, and a new window starts every "step", so that
+    windows overlap whenever the step is shorter than the duration.  As with MoranCumulativeTimeAverager, the
+    duration and step are given in generations and translated into ticks given the population size.
+
+    Rather than adding each tick to every window which contains it, ticks are accumulated into blocks whose
+    length is the greatest common divisor of the duration and step.  Each window is then a run of consecutive
+    blocks, and the averager keeps a ring buffer of the most recent blocks plus a running total over them:  when
+    a block closes, it is added to the running total and the block leaving the window is subtracted.  Every
+    window which ends at that block boundary is emitted from the running total.  The per-tick cost is thus
+    independent of how many windows overlap.
+
+    Completed windows are passed to a callback as (start_tick, end_tick, countmap, configuration_map) if one
+    is given, and otherwise are kept and returned by get_window_counts().  Only complete windows are emitted:
+    a window which would run past the end of the run (see finalize()) is dropped, so every emitted window
+    covers exactly the duration.
+    """
+
+    def __init__(self, starttime, duration, step, popsize, numloci, callback=None):
+        """
+
+        :param starttime: The simulation tick at which the first window starts
+        :param duration: The duration of each TA window, given in "generations"
+        :param step: The number of generations between the starts of successive windows
+        :param popsize: Population size of agents, used to turn generations into clock ticks in a Moran model
+        :param numloci: Number of dimensions or loci for which we're counting traits
+        :param callback: Optional function called with (start_tick, end_tick, countmap, configuration_map) for each completed window
+        :return: void
+        """
+        self.starttime = starttime
+        self.duration_ticks = duration * popsize
+        self.step_ticks = step * popsize
+        self.numloci = numloci
+        self.callback = callback
+        self.block_ticks = gcd(self.duration_ticks, self.step_ticks)
+        self.blocks_per_window = self.duration_ticks // self.block_ticks
+        self.blocks = deque()
+        self.window_counts = self._empty_countmap()
+        self.window_configurations = Counter()
+        self.current_block = 0
+        self.block_counts = self._empty_countmap()
+        self.block_configurations = Counter()
+        self.completed_windows = []
+        self.last_timestep = None
+
+
+    def _empty_countmap(self):
+        countmap = defaultdict(Counter)
+        for locus in range(0, self.numloci):
+            countmap[locus] = Counter()
+        return countmap
+
+
+    def record_trait_count_sample(self, timestep, countmap, configuration_map):
+        """
+        Given a time step, a map of trait counts by locus, and a map of configuration counts, adds the counts to
+        the block containing the time step.  Time steps must be recorded in non-decreasing order.  Any blocks
+        which end before the time step are closed first, which emits the windows ending at those blocks.
+
+        :param timestep:
+        :param countmap:
+        :param configuration_map:
+        :return: void
+        """
+        if timestep < self.starttime:
+            return
 
+        block = (timestep - self.starttime) // self.block_ticks
+        while self.current_block < block:
+            self._close_block()
 
+        for locus in countmap.keys():
+            self.block_counts[locus].update(countmap[locus])
+        self.block_configurations.update(configuration_map)
+        self.last_timestep = timestep
+
+
+    def finalize(self, end_tick=None):
+        """
+        Closes the block currently being accumulated, emitting any window which ends with it, if the run covers
+        the whole block.  If the run ends part way through the block, the block is discarded instead, since any
+        window ending with it would be incomplete.  Call this after the last tick of a run has been recorded.
+
+        :param end_tick: The tick after the last tick of the run, or None for the tick after the last one recorded
+        :return: void
+        """
+        if end_tick is None:
+            if self.last_timestep is None:
+                return
+            end_tick = self.last_timestep + 1
+
+        block_end = self.starttime + (self.current_block + 1) * self.block_ticks
+        if end_tick >= block_end:
+            self._close_block()
+        else:
+            log.debug("Discarding partial block ending at %s, since the run ends at %s", block_end, end_tick)
+            self.block_counts = self._empty_countmap()
+            self.block_configurations = Counter()
+
+
+    def _close_block(self):
+        for locus, counter in self.block_counts.items():
+            self.window_counts[locus].update(counter)
+        self.window_configurations.update(self.block_configurations)
+        self.blocks.append((self.block_counts, self.block_configurations))
+
+        if len(self.blocks) > self.blocks_per_window:
+            (old_counts, old_configurations) = self.blocks.popleft()
+            for locus, counter in old_counts.items():
+                _subtract_counts(self.window_counts[locus], counter)
+            _subtract_counts(self.window_configurations, old_configurations)
+
+        # the window made up of the blocks in the ring buffer is complete if it starts on a step boundary
+        first_block = self.current_block - self.blocks_per_window + 1
+        if first_block >= 0 and (first_block * self.block_ticks) % self.step_ticks == 0:
+            start = self.starttime + first_block * self.block_ticks
+            self._emit_window(start, start + self.duration_ticks)
+
+        self.current_block += 1
+        self.block_counts = self._empty_countmap()
+        self.block_configurations = Counter()
+
+
+    def _emit_window(self, start, end):
+        countmap = dict((locus, Counter(counter)) for locus, counter in self.window_counts.items())
+        configuration_map = Counter(self.window_configurations)
+        if self.callback is not None:
+            self.callback(start, end, countmap, configuration_map)
+        else:
+            self.completed_windows.append((start, end, countmap, configuration_map))
+
+
+    def get_window_counts(self):
+        """
+        Returns the windows completed so far, when no callback was given.
+
+        :return: list of (start_tick, end_tick, countmap, configuration_map) tuples, in order of ending tick
+        """
+        return self.completed_windows
+
+
+def _subtract_counts(counter, other):
+    """
+    Subtracts the counts in other from counter in place, dropping entries which fall to zero.
+    """
+    for key, count in other.items():
+        remaining = counter[key] - count
+        if remaining == 0:
+            del counter[key]
+        else:
+            counter[key] = remaining
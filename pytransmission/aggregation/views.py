@@ -0,0 +1,73 @@
+# !/usr/bin/env python
+# Copyright (c) 2013.  Mark E. Madsen <mark@madsenlab.org>
+#
+# This work is licensed under the terms of the Apache Software License, Version 2.0.  See the file LICENSE for details.
+
+"""
+Read-only views of accumulated trait counts, which let the time averagers hand out their counts without copying
+them.  The averagers never modify a Counter after it has been handed out in a view -- they replace it with a copy
+first -- so a view is a stable snapshot of the counts at the time it was taken.
+
+"""
+
+from collections import Mapping, Counter
+
+
+class CounterView(Mapping):
+    """
+    Read-only view of a Counter.  Like a Counter, missing traits have a count of zero.  Use copy() to obtain
+    a mutable Counter.
+    """
+
+    def __init__(self, counter):
+        self._counter = counter
+
+    def __getitem__(self, key):
+        return self._counter[key]
+
+    def __contains__(self, key):
+        return key in self._counter
+
+    def __iter__(self):
+        return iter(self._counter)
+
+    def __len__(self):
+        return len(self._counter)
+
+    def __repr__(self):
+        return "CounterView(%r)" % dict(self._counter)
+
+    def most_common(self, n=None):
+        return self._counter.most_common(n)
+
+    def elements(self):
+        return self._counter.elements()
+
+    def copy(self):
+        return Counter(self._counter)
+
+
+class LocusCountsView(Mapping):
+    """
+    Read-only view of a map of loci to Counters, which returns CounterView objects for each locus.  The map of
+    loci is copied when the view is created (which copies only references to the Counters), so that the view
+    keeps pointing at the same Counters even if the underlying map is later given new ones.
+    """
+
+    def __init__(self, locus_map):
+        self._locus_map = dict(locus_map)
+
+    def __getitem__(self, locus):
+        return CounterView(self._locus_map[locus])
+
+    def __iter__(self):
+        return iter(self._locus_map)
+
+    def __len__(self):
+        return len(self._locus_map)
+
+    def __repr__(self):
+        return "LocusCountsView(%r)" % dict((locus, dict(counter)) for locus, counter in self._locus_map.items())
+
+    def copy(self):
+        return dict((locus, Counter(counter)) for locus, counter in self._locus_map.items())
@@ -9,12 +9,20 @@ Description here
 """
 
 from moran import moran_watkins_convergence_to_stationarity, moran_watkins_convergence_stationarity_timesteps, \
-    moran_watkins_multilocus_convergence_time_timesteps, moran_mutation_rate_from_theta, moran_expected_traits_at_locus
+    moran_watkins_multilocus_convergence_time_timesteps, moran_mutation_rate_from_theta, moran_expected_traits_at_locus, \
+    moran_expected_traits_at_locus_vectorized, MoranInfiniteAlleles
 
-from wright_fisher import wfia_convergence_to_stationarity_generations, wf_mutation_rate_from_theta
+from wright_fisher import wfia_convergence_to_stationarity_generations, wf_mutation_rate_from_theta, \
+    WrightFisherInfiniteAlleles
 
 
-from crp import simulate_crp_memberships, get_crp_unlabeled_counts
+from crp import simulate_crp_memberships, simulate_crp_memberships_vectorized, get_crp_unlabeled_counts, \
+    sample_ewens_partition_counts, sample_ewens_partition_counts_batch, simulate_crp_memberships_batch, \
+    get_replicate_prng
+
+from ewens import expected_num_alleles, variance_num_alleles, ewens_sampling_formula_logprob, \
+    log_stirling_first_kind, EwensTheoryTable, get_theory_table, count_matrix, estimate_theta, \
+    estimate_theta_from_counts, slatkin_exact_test
 
 def constructUniformAllelicDistribution(numalleles):
     """Constructs a uniform distribution of N alleles in the form of a frequency list.
@@ -4,6 +4,7 @@
 import numpy as np
 import random as rand
 import logging as log
+import multiprocessing
 
 # RUBY code to translate....
 
@@ -53,7 +54,7 @@ def simulate_crp_memberships(population, theta):
     assignments = []
     current_slot = 1
     assignments.append(current_slot)  # first individual assigned to slot 1
-    for i in xrange(2, population):
+    for i in xrange(2, population + 1):
         prob = theta_f / (i - 1 + theta_f)
         if np.random.random_sample() < prob:
             # assign individual to a new slot
@@ -69,15 +70,172 @@ def simulate_crp_memberships(population, theta):
     return assignments
 
 
-def get_crp_unlabeled_counts(population, theta):
+def simulate_crp_memberships_vectorized(population, theta, prng=None):
     """
-    Simulates the Chinese Restaurant Process using simulate_crp_memberships(),
-    and returns unlabeled trait counts, sorted from largest to smallest.
+    Simulates the same Chinese Restaurant Process as simulate_crp_memberships(), but builds the
+    partition in bulk with NumPy rather than one individual at a time.
+
+    All of the "new table" Bernoulli events are drawn at once, using the fact that individual i
+    (counting from 1) opens a new table with probability theta / (i - 1 + theta) regardless of
+    what happened before.  Every other individual copies the table of a uniformly chosen earlier
+    individual, so we draw all of those "parent" indices at once as well.  This gives a forest of
+    pointers in which each root is an individual who opened a table, and we resolve each
+    individual to its root by pointer doubling, which takes O(log log n) passes over the array
+    for the random recursive trees the CRP generates.
+
+    Tables are numbered from 1 in order of creation, exactly as in simulate_crp_memberships(),
+    and the two functions return the same distribution of partitions; the loop version is kept
+    so that the two can be cross-checked.
 
     :param population:
     :param theta:
-    :return: list of unlabeled counts
+    :param prng: numpy RandomState to draw from, or None to use the global numpy random state
+    :return: numpy array of individual table/trait assignments
+    """
+    if prng is None:
+        prng = np.random
+
+    theta_f = float(theta)
+    if population < 1:
+        raise UserWarning("Population size must be positive for calculating CRP partitions")
+
+    # individual at (zero-based) index i has i predecessors already seated
+    predecessors = np.arange(population, dtype=np.int64)
+    new_table = prng.random_sample(population) < theta_f / (predecessors + theta_f)
+    new_table[0] = True
+
+    parents = (prng.random_sample(population) * predecessors).astype(np.int64)
+    parents[new_table] = predecessors[new_table]
+
+    roots = parents
+    while True:
+        next_roots = roots[roots]
+        if np.array_equal(next_roots, roots):
+            break
+        roots = next_roots
+
+    table_numbers = np.cumsum(new_table)
+    return table_numbers[roots]
+
+
+def get_replicate_prng(seed, replicate):
+    """
+    Returns the numpy RandomState used for one replicate of a seeded batch.  The state is initialized
+    from the (seed, replicate) pair, so each replicate gets its own stream, and the stream depends only on
+    the master seed and the replicate index -- not on which process draws it or in what order.
+
+    :param seed: master seed, an integer in [0, 2**32)
+    :param replicate: replicate index
+    :return: numpy RandomState
+    """
+    return np.random.RandomState([seed, replicate])
+
+
+def _crp_memberships_replicate(args):
+    (population, theta, seed, replicate) = args
+    return simulate_crp_memberships_vectorized(population, theta, prng=get_replicate_prng(seed, replicate))
+
+
+def simulate_crp_memberships_batch(population, theta, replicates, seed=None, processes=None):
+    """
+    Simulates many replicate CRP partitions with simulate_crp_memberships_vectorized(), each drawing from
+    its own seeded random stream (see get_replicate_prng()).  Replicates can be spread over a pool of worker
+    processes, and the results are identical for a given seed regardless of the number of workers.
+
+    :param population:
+    :param theta:
+    :param replicates:
+    :param seed: master seed, an integer in [0, 2**32).  If None, a seed is drawn from OS entropy and logged so the batch can be replayed.
+    :param processes: number of worker processes, or None (or 1) to run the replicates serially in this process
+    :return: list of numpy arrays of individual table/trait assignments, one per replicate
+    """
+    if seed is None:
+        seed = int(np.random.RandomState().randint(0, 2**31 - 1))
+        log.debug("CRP batch using generated seed: %s", seed)
+
+    tasks = [(population, theta, seed, replicate) for replicate in xrange(0, replicates)]
+
+    if processes is None or processes == 1:
+        return map(_crp_memberships_replicate, tasks)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_crp_memberships_replicate, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def sample_ewens_partition_counts_batch(population, theta, replicates, prng=None):
+    """
+    Samples unlabeled trait counts for many replicate CRP/Ewens partitions of a population, without ever
+    assigning individuals to tables, so that memory is proportional to the number of traits rather than
+    the population size.
+
+    We use the stick-breaking (size-biased) construction of the Ewens partition:  the trait carried by
+    the first remaining individual has frequency W ~ Beta(1, theta), each of the other M - 1 remaining individuals
+    carries it independently with probability W, and the individuals left over form an Ewens partition of their
+    own with the same theta.  Each step thus peels off one trait count with a Beta and a Binomial draw, and
+    all replicates are advanced together, one trait per pass.
+
+    :param population:
+    :param theta:
+    :param replicates:
+    :param prng: numpy RandomState to draw from, or None to use the global numpy random state
+    :return: numpy array of shape (replicates, Kmax), each row sorted from largest to smallest and padded with zeros
     """
-    return sorted(np.bincount(simulate_crp_memberships(population, theta))[1:], reverse=True,key=int)
+    if prng is None:
+        prng = np.random
+
+    theta_f = float(theta)
+    if population < 1:
+        raise UserWarning("Population size must be positive for calculating CRP partitions")
+    if theta_f < 0.0:
+        raise UserWarning("Theta must be non-negative for calculating CRP partitions")
+    if replicates < 0:
+        raise UserWarning("Number of replicates must be non-negative for calculating CRP partitions")
+
+    if replicates == 0:
+        return np.zeros((0, 1), dtype=np.int64)
+    if theta_f == 0.0:
+        return np.full((replicates, 1), population, dtype=np.int64)
+
+    remaining = np.full(replicates, population, dtype=np.int64)
+    columns = []
+    while remaining.any():
+        weights = prng.beta(1.0, theta_f, size=replicates)
+        sizes = 1 + prng.binomial(np.maximum(remaining - 1, 0), weights)
+        sizes[remaining == 0] = 0
+        columns.append(sizes)
+        remaining -= sizes
+
+    counts = np.column_stack(columns)
+    return -np.sort(-counts, axis=1)
 
 
+def sample_ewens_partition_counts(population, theta, prng=None):
+    """
+    Samples the unlabeled trait counts of a single CRP/Ewens partition, using
+    sample_ewens_partition_counts_batch().
+
+    :param population:
+    :param theta:
+    :param prng: numpy RandomState to draw from, or None to use the global numpy random state
+    :return: list of unlabeled counts, sorted from largest to smallest
+    """
+    counts = sample_ewens_partition_counts_batch(population, theta, 1, prng=prng)[0]
+    return counts[counts > 0].tolist()
+
+
+def get_crp_unlabeled_counts(population, theta):
+    """
+    Simulates the Chinese Restaurant Process and returns unlabeled trait counts, sorted from largest to smallest.
+    The counts are sampled directly with sample_ewens_partition_counts(), which has the same distribution as
+    tabulating the assignments from simulate_crp_memberships() but never materializes them.
+
+    :param population:
+    :param theta:
+    :return: list of unlabeled counts
+    """
+    return sample_ewens_partition_counts(population, theta)
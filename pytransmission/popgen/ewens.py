@@ -0,0 +1,373 @@
+# !/usr/bin/env python
+# Copyright (c) 2013.  Mark E. Madsen <mark@pytransmission.org>
+#
+# This work is licensed under the terms of the Apache Software License, Version 2.0.  See the file LICENSE for details.
+
+"""
+Analytical quantities from the Ewens sampling theory for the infinite-alleles model:  the expectation and variance
+of the number of alleles in a sample, the Ewens sampling formula, and the distribution of the number of alleles
+given by the Stirling numbers of the first kind (Ewens 2004, Section 3.5).  Also provides batch estimation of
+theta from sampled trait counts, and Slatkin's exact test of neutrality.
+
+Scalar functions are memoized with a bounded LRU cache, since parameter sweeps evaluate them for the same
+(ssize, theta) values over and over.  The Stirling numbers are held in log space in an EwensTheoryTable, which can
+be saved to disk once and memory-mapped by worker processes at startup instead of being recomputed.
+
+"""
+
+import math
+import numpy as np
+from scipy.special import digamma, polygamma, gammaln
+from collections import Counter, Mapping
+from pytransmission.utils.caching import lru_cache
+from pytransmission.popgen.crp import sample_ewens_partition_counts_batch
+
+
+@lru_cache(maxsize=65536)
+def expected_num_alleles(theta, ssize):
+    """
+    Expected number of alleles in a sample of size n (Ewens 2004, Eq. 3.84):
+
+    E[K] = sum_{i=0}^{n-1} theta / (theta + i) = theta * (psi(theta + n) - psi(theta))
+
+    The arguments are in the same order as moran.moran_expected_traits_at_locus(), but the sum has the n terms of
+    Eq. 3.84, which match the CRP and ESF sampling in this module, where moran_expected_traits_at_locus() and
+    moran_expected_traits_at_locus_vectorized() keep their historical n - 1 terms.  The two therefore differ by
+    theta / (theta + n - 1) for the same arguments.
+
+    :param theta:
+    :param ssize:
+    :return: expected number of alleles
+    """
+    theta = float(theta)
+    return float(theta * (digamma(theta + ssize) - digamma(theta)))
+
+
+@lru_cache(maxsize=65536)
+def variance_num_alleles(theta, ssize):
+    """
+    Variance of the number of alleles in a sample of size n (Ewens 2004, Eq. 3.85):
+
+    Var[K] = sum_{i=1}^{n-1} theta * i / (theta + i)^2
+
+    As with expected_num_alleles(), the sum has one more term than moran_expected_traits_at_locus().
+
+    :param theta:
+    :param ssize:
+    :return: variance of the number of alleles
+    """
+    theta = float(theta)
+    harmonic = digamma(theta + ssize) - digamma(theta + 1.0)
+    harmonic_sq = polygamma(1, theta + 1.0) - polygamma(1, theta + ssize)
+    return float(theta * (harmonic - theta * harmonic_sq))
+
+
+def log_rising_factorial(theta, n):
+    """
+    Returns log(theta (theta + 1) ... (theta + n - 1)).
+
+    :param theta:
+    :param n:
+    :return: float
+    """
+    return math.lgamma(theta + n) - math.lgamma(theta)
+
+
+def ewens_sampling_formula_logprob(counts, theta):
+    """
+    Log probability of an unlabeled allele count configuration under the Ewens sampling formula (Ewens 2004,
+    Eq. 3.87).  If a_j is the number of alleles represented j times in a sample of size n:
+
+    P(a | n, theta) = n! / theta^(n) * prod_j (theta / j)^{a_j} / a_j!
+
+    where theta^(n) is the rising factorial.  The calculation is done in log space with lgamma, so it is accurate
+    for large samples.
+
+    :param counts: sequence of allele counts in the sample (in any order; zero counts are ignored)
+    :param theta:
+    :return: log probability
+    """
+    return _ewens_logprob(tuple(sorted(int(count) for count in counts if count > 0)), float(theta))
+
+
+@lru_cache(maxsize=65536)
+def _ewens_logprob(counts, theta):
+    n = sum(counts)
+    logp = math.lgamma(n + 1) - log_rising_factorial(theta, n)
+    for j, a_j in Counter(counts).items():
+        logp += a_j * (math.log(theta) - math.log(j)) - math.lgamma(a_j + 1)
+    return logp
+
+
+def log_stirling_first_kind(nmax):
+    """
+    Returns a table of the logs of the unsigned Stirling numbers of the first kind, |s(n, k)|, for
+    0 <= k <= n <= nmax, computed in log space from the recurrence |s(n+1, k)| = n |s(n, k)| + |s(n, k-1)|.
+    Entries with k > n (where |s(n, k)| = 0) are -inf.
+
+    :param nmax:
+    :return: numpy array of shape (nmax + 1, nmax + 1), indexed [n, k]
+    """
+    table = np.full((nmax + 1, nmax + 1), -np.inf)
+    table[0, 0] = 0.0
+    for n in xrange(0, nmax):
+        previous = table[n]
+        with np.errstate(divide='ignore'):
+            stay = previous + math.log(n) if n > 0 else np.full(nmax + 1, -np.inf)
+        table[n + 1, 1:] = np.logaddexp(stay[1:], previous[:-1])
+        table[n + 1, 0] = stay[0]
+    return table
+
+
+class EwensTheoryTable(object):
+    """
+    A precomputed table of log |s(n, k)| for sample sizes up to nmax, giving the distribution of the number of
+    alleles K in a sample (Ewens 2004, Eq. 3.83):
+
+    P(K = k | n, theta) = |s(n, k)| theta^k / theta^(n)
+
+    Computing the table costs O(nmax^2) once; afterwards each probability is a table lookup.  The table can be
+    saved with save() and opened with load(), which memory-maps it by default so that many worker processes
+    share one copy in the OS page cache.
+    """
+
+    def __init__(self, nmax=None, log_stirling=None):
+        """
+
+        :param nmax: Largest sample size to tabulate
+        :param log_stirling: An existing table from log_stirling_first_kind(), used instead of computing one
+        :return: void
+        """
+        if log_stirling is None:
+            log_stirling = log_stirling_first_kind(nmax)
+        self.log_stirling = log_stirling
+        self.nmax = log_stirling.shape[0] - 1
+
+
+    def save(self, path):
+        """
+        Saves the table to a .npy file.
+
+        :param path:
+        :return: void
+        """
+        np.save(path, np.asarray(self.log_stirling))
+
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads a table saved with save().
+
+        :param path:
+        :param mmap: Boolean, whether to memory-map the file read-only instead of reading it into memory
+        :return: EwensTheoryTable
+        """
+        return cls(log_stirling=np.load(path, mmap_mode='r' if mmap else None))
+
+
+    def log_prob_num_alleles(self, k, ssize, theta):
+        """
+        Log of P(K = k | n, theta).  The arguments may be NumPy arrays, and are broadcast against each other.
+
+        :param k: number of alleles
+        :param ssize: sample size, at most nmax
+        :param theta:
+        :return: log probability, or array of them
+        """
+        k = np.asarray(k)
+        ssize = np.asarray(ssize)
+        theta = np.asarray(theta, dtype=np.float64)
+        if np.any(ssize > self.nmax):
+            raise ValueError("sample size %s is larger than the tabulated maximum: %s" % (ssize.max(), self.nmax))
+        rising = gammaln(theta + ssize) - gammaln(theta)
+        return self.log_stirling[ssize, k] + k * np.log(theta) - rising
+
+
+    def num_alleles_distribution(self, ssize, theta):
+        """
+        The full distribution P(K = k | n, theta) for k = 0 ... n.
+
+        :param ssize: sample size, at most nmax
+        :param theta:
+        :return: numpy array of probabilities, indexed by k
+        """
+        k = np.arange(0, ssize + 1)
+        return np.exp(self.log_prob_num_alleles(k, ssize, theta))
+
+
+@lru_cache(maxsize=8)
+def get_theory_table(nmax):
+    """
+    Returns an EwensTheoryTable for sample sizes up to nmax, computing it at most once per process for
+    each nmax (subject to a small LRU bound, since the tables are O(nmax^2) in size).
+
+    :param nmax:
+    :return: EwensTheoryTable
+    """
+    return EwensTheoryTable(nmax)
+
+
+def count_matrix(samples):
+    """
+    Converts a batch of samples of trait counts into a padded count matrix.  Each sample may be a Counter or dict
+    of trait:count (e.g., from get_sampled_counter()), or a sequence of counts (e.g., from
+    get_crp_unlabeled_counts()).  A 2D array, such as from sample_ewens_partition_counts_batch(), is taken as one
+    sample per row.
+
+    :param samples: sequence of samples
+    :return: numpy array of shape (samples, Kmax), each row sorted from largest to smallest and padded with zeros
+    """
+    if isinstance(samples, np.ndarray) and samples.ndim == 2:
+        return -np.sort(-samples.astype(np.int64), axis=1)
+
+    rows = [list(sample.values()) if isinstance(sample, Mapping) else list(sample) for sample in samples]
+    width = max([len(row) for row in rows] + [1])
+    matrix = np.zeros((len(rows), width), dtype=np.int64)
+    for i, row in enumerate(rows):
+        matrix[i, :len(row)] = row
+    return -np.sort(-matrix, axis=1)
+
+
+def estimate_theta(num_alleles, ssize, tol=1e-10, maxiter=200):
+    """
+    Ewens' maximum likelihood estimate of theta from the number of alleles K in a sample of size n, which is the
+    root of E[K | n, theta] = K (Ewens 2004, Eq. 3.88).  The arguments may be NumPy arrays, and are broadcast
+    against each other, so whole batches of samples are solved together by bisection on log(theta).
+
+    The estimate is 0 when K = 1, and infinite when K = n.
+
+    :param num_alleles: number of alleles K in each sample
+    :param ssize: sample size n of each sample
+    :param tol: tolerance on log(theta)
+    :param maxiter: maximum number of bisection steps
+    :return: estimate of theta, or array of them
+    """
+    (k, n) = np.broadcast_arrays(np.asarray(num_alleles, dtype=np.float64), np.asarray(ssize, dtype=np.float64))
+    if np.any(k < 1) or np.any(k > n):
+        raise ValueError("number of alleles must be between 1 and the sample size")
+
+    # E[K] is increasing in theta, so bracket the root on a log scale
+    lower = np.full(k.shape, -30.0)
+    upper = np.full(k.shape, 30.0)
+    for i in xrange(0, maxiter):
+        mid = 0.5 * (lower + upper)
+        theta = np.exp(mid)
+        too_small = theta * (digamma(theta + n) - digamma(theta)) < k
+        lower = np.where(too_small, mid, lower)
+        upper = np.where(too_small, upper, mid)
+        if np.all(upper - lower < tol):
+            break
+
+    estimate = np.exp(0.5 * (lower + upper))
+    estimate = np.where(k == 1, 0.0, estimate)
+    estimate = np.where(k == n, np.inf, estimate)
+    return estimate if estimate.ndim > 0 else float(estimate)
+
+
+def estimate_theta_from_counts(samples):
+    """
+    Ewens' maximum likelihood estimate of theta for each of a batch of samples of trait counts.  See count_matrix()
+    for the forms a batch can take.
+
+    :param samples:
+    :return: numpy array with one estimate per sample
+    """
+    matrix = count_matrix(samples)
+    return estimate_theta((matrix > 0).sum(axis=1), matrix.sum(axis=1))
+
+
+def conditional_logprob(matrix):
+    """
+    Log probability, up to a constant depending only on n and K, of each row of a count matrix under the Ewens
+    sampling formula conditioned on the number of alleles K.  Given K the formula does not depend on theta, and is
+    proportional to 1 / prod_j (j^{a_j} a_j!).
+
+    :param matrix: count matrix, rows sorted from largest to smallest, as from count_matrix()
+    :return: numpy array with one value per row
+    """
+    present = matrix > 0
+    log_counts = np.where(present, np.log(np.maximum(matrix, 1)), 0.0)
+
+    # log(a_j!) summed over j is the sum of log(rank within each run of equal counts)
+    positions = np.arange(matrix.shape[1])
+    new_run = np.ones(matrix.shape, dtype=bool)
+    new_run[:, 1:] = matrix[:, 1:] != matrix[:, :-1]
+    run_start = np.maximum.accumulate(np.where(new_run, positions, 0), axis=1)
+    log_ranks = np.where(present, np.log(positions - run_start + 1), 0.0)
+    return -(log_counts + log_ranks).sum(axis=1)
+
+
+def homozygosity(matrix):
+    """
+    Sample homozygosity F = sum_i (n_i / n)^2 of each row of a count matrix, which is Watterson's statistic for the
+    neutrality test.
+
+    :param matrix: count matrix, as from count_matrix()
+    :return: numpy array with one value per row
+    """
+    freqs = matrix / matrix.sum(axis=1, keepdims=True).astype(np.float64)
+    return (freqs ** 2).sum(axis=1)
+
+
+def _sample_conditional_on_k(ssize, num_alleles, replicates, prng):
+    # Rejection sampling from the CRP:  at the MLE of theta the target K is the mode or near it, so a reasonable
+    # fraction of draws are accepted, and the accepted partitions follow the Ewens distribution conditioned on K.
+    theta = estimate_theta(num_alleles, ssize)
+    accepted = []
+    needed = replicates
+    batch = replicates
+    while needed > 0:
+        draws = sample_ewens_partition_counts_batch(ssize, theta, batch, prng=prng)
+        keep = draws[(draws > 0).sum(axis=1) == num_alleles][:needed, :num_alleles]
+        # a batch without any accepted draws may be narrower than num_alleles
+        if keep.shape[0] > 0:
+            accepted.append(keep)
+        needed -= keep.shape[0]
+        rate = max(float(keep.shape[0]) / batch, 0.01)
+        batch = min(int(needed / rate * 1.2) + 1, 100 * replicates)
+    if len(accepted) == 0:
+        return np.empty((0, num_alleles))
+    return np.vstack(accepted)
+
+
+def slatkin_exact_test(samples, replicates=1000, prng=None):
+    """
+    Slatkin's exact test of neutrality (Slatkin 1994, 1996) for each of a batch of samples of trait counts.  For each
+    sample, the null distribution is the Ewens sampling formula conditioned on the observed n and K, estimated by
+    Monte Carlo with partitions drawn from the CRP sampler at the MLE of theta and kept when they have K traits.
+    Samples with the same n and K share one set of null replicates.
+
+    Two p-values are reported for each sample:  the fraction of null replicates with conditional probability no
+    larger than the observed one (Slatkin's test), and the fraction with homozygosity no smaller than the observed
+    one (Watterson's test).  Samples with K = 1 or K = n have only one possible configuration, and p-values of 1.
+
+    :param samples: sequence of samples (see count_matrix())
+    :param replicates: number of Monte Carlo replicates from the conditional null distribution
+    :param prng: numpy RandomState to draw from, or None to use the global numpy random state
+    :return: tuple of numpy arrays (slatkin p-values, watterson p-values), one entry per sample
+    """
+    if prng is None:
+        prng = np.random
+
+    matrix = count_matrix(samples)
+    ks = (matrix > 0).sum(axis=1)
+    ns = matrix.sum(axis=1)
+    observed_prob = conditional_logprob(matrix)
+    observed_f = homozygosity(matrix)
+
+    p_slatkin = np.ones(len(matrix))
+    p_watterson = np.ones(len(matrix))
+    # a small relative slack so that configurations equal to the observed one are counted despite rounding
+    slack = 1e-9
+    for (n, k) in set(zip(ns.tolist(), ks.tolist())):
+        if k == 1 or k == n:
+            continue
+        rows = np.flatnonzero((ns == n) & (ks == k))
+        null = _sample_conditional_on_k(n, k, replicates, prng)
+        null_prob = np.sort(conditional_logprob(null))
+        null_f = np.sort(homozygosity(null))
+        p_slatkin[rows] = np.searchsorted(null_prob, observed_prob[rows] + slack, side='right') / float(replicates)
+        p_watterson[rows] = 1.0 - np.searchsorted(null_f, observed_f[rows] * (1.0 - slack),
+                                                  side='left') / float(replicates)
+    return (p_slatkin, p_watterson)
@@ -11,6 +11,9 @@ Description here
 
 import math as math
 import logging as log
+import numpy as np
+from scipy.special import digamma, polygamma
+from pytransmission.utils.caching import lru_cache
 
 def moran_watkins_convergence_to_stationarity(popsize, innovation_rate):
     """
@@ -71,11 +74,12 @@ def moran_mutation_rate_from_theta(popsize, theta):
     return mutation
 
 
+@lru_cache(maxsize=65536)
 def moran_expected_traits_at_locus(theta, ssize):
     """
     Calculates the expectation and variance of the number of alleles in a sample of size n, given
     equations 3.84 - 3.86 from Ewens 2004, with the difference that we need a factor of 2n given the
-    Moran model.
+    Moran model.  Results are memoized, since sweeps evaluate the same (theta, ssize) repeatedly.
 
     :param theta:
     :param ssize:
@@ -91,10 +95,344 @@ def moran_expected_traits_at_locus(theta, ssize):
 
     accum = 0.0
     for j in xrange(1, ssize_factor - 1):
-        accum += j / (theta + j) ** 2
+        accum += float(j) / (theta + j) ** 2
     v_k = theta * accum
     log.debug("variance K for theta: %s ssize: %s is %s", theta, ssize, v_k)
 
     return (e_k, v_k)
 
 
+def moran_expected_traits_at_locus_vectorized(theta, ssize):
+    """
+    Array version of moran_expected_traits_at_locus(), which accepts NumPy arrays (or scalars) for theta and ssize,
+    broadcasts them against each other, and returns arrays of the expectation and variance of the number of alleles.
+
+    The sums in moran_expected_traits_at_locus() are replaced by their closed forms in terms of the digamma and
+    trigamma functions, so each point costs O(1) regardless of sample size:
+
+    E[K] = sum_{i=0}^{n-2} theta / (theta + i) = theta * (psi(theta + n - 1) - psi(theta))
+
+    Var[K] = theta * sum_{j=1}^{n-2} j / (theta + j)^2
+           = theta * ((psi(theta + n - 1) - psi(theta + 1)) - theta * (psi_1(theta + 1) - psi_1(theta + n - 1)))
+
+    :param theta: array of positive theta values
+    :param ssize: array of sample sizes
+    :return: tuple with arrays of expected value, variance
+    """
+    theta = np.asarray(theta, dtype=np.float64)
+    ssize = np.asarray(ssize, dtype=np.float64)
+    (theta, ssize) = np.broadcast_arrays(theta, ssize)
+
+    # number of terms in each sum, which is zero for very small samples
+    e_terms = np.maximum(ssize - 1.0, 0.0)
+    v_terms = np.maximum(ssize - 2.0, 0.0)
+
+    e_k = theta * (digamma(theta + e_terms) - digamma(theta))
+    harmonic = digamma(theta + v_terms + 1.0) - digamma(theta + 1.0)
+    harmonic_sq = polygamma(1, theta + 1.0) - polygamma(1, theta + v_terms + 1.0)
+    v_k = theta * (harmonic - theta * harmonic_sq)
+
+    return (e_k, v_k)
+
+
+
+
+def _fenwick_tree(counts):
+    """
+    Builds a Fenwick (binary indexed) tree over an array of counts, as a 1-based Python list in which
+    tree[i] holds the sum of the counts in slots (i - (i & -i), i].
+    """
+    tree = [0] + counts.tolist()
+    size = len(counts)
+    for i in xrange(1, size + 1):
+        parent = i + (i & -i)
+        if parent <= size:
+            tree[parent] += tree[i]
+    return tree
+
+
+class MoranInfiniteAlleles(object):
+    """
+    Simulates a haploid, multilocus infinite-alleles Moran process, representing each locus only by an array of
+    allele ids and a parallel array of counts rather than by individual agents.
+
+    At each tick one locus is chosen at random.  With probability equal to the innovation rate, a random individual
+    dies and is replaced by an individual carrying a new allele at that locus; otherwise a random individual dies
+    and is replaced by a copy of another random individual (which may be itself).  Only mutations, and copies in
+    which the dying and copied individuals carry different alleles, change the counts.
+
+    Instead of simulating every tick, the simulator skips directly from one change to the next:  the number of
+    ticks until the next change is geometric, with a success probability given by the innovation rate and the
+    current homozygosity at each locus, and the change itself is then drawn conditional on happening.  This is
+    exact, and makes the cost proportional to the number of changes rather than the number of ticks.  Uniform
+    random numbers are drawn from the generator in chunks.
+
+    The counts at each locus are held in a preallocated array with spare capacity, which doubles (or is compacted,
+    when at least half of its alleles are extinct) only when a mutation finds it full, and the random individuals
+    are chosen by descending a Fenwick tree over the counts.  Each change therefore costs O(log K) for K allele
+    slots, rather than a cumulative sum over all of the counts and a reallocation per mutation.
+
+    Regime limits:  the skipping pays off when homozygosity is high (theta small relative to the population size),
+    since most ticks then change nothing.  When theta is large, nearly every tick is a change, and the simulator
+    runs at roughly one interpreted change per tick.  Changes cannot be batched, because each one alters the
+    homozygosity which sets the waiting time to the next, so only the random numbers are drawn in bulk.  Memory is
+    O(K) per locus, and K grows with the number of alleles segregating at once, about theta * log(popsize).
+
+    Because the counts are constant between changes, they can be reported either to a per-tick callback with the
+    signature of MoranCumulativeTimeAverager.record_trait_count_sample(), which is called for every tick, or much
+    more cheaply to a span callback with the signature of record_trait_count_span(), which is called once per run
+    of unchanged ticks.  Loci evolve independently in this representation, so configuration maps are empty.
+    """
+
+    def __init__(self, popsize, innovation_rate, numloci=1, initial_alleles=1, prng=None, chunk_size=4096):
+        """
+
+        :param popsize: The size of the haploid population
+        :param innovation_rate: probability of a mutation per locus per tick, e.g., from moran_mutation_rate_from_theta()
+        :param numloci: Number of independent loci
+        :param initial_alleles: Number of alleles at each locus in the initial population, in (nearly) equal frequencies
+        :param prng: numpy RandomState to draw from, or None to use the global numpy random state
+        :param chunk_size: Number of uniform random numbers to draw from the generator at a time
+        :return: void
+        """
+        self.popsize = popsize
+        self.innovation_rate = float(innovation_rate)
+        self.numloci = numloci
+        self.prng = np.random if prng is None else prng
+        self.chunk_size = chunk_size
+        self.tick = 0
+        self.burned_in = False
+        self.next_trait_id = 0
+        self.traits = []
+        self.counts = []
+        self.sizes = []
+        self.trees = []
+        self.sum_squares = []
+        self.extinct = [0] * numloci
+        self.uniforms = []
+        self.uniform_pos = 0
+
+        capacity = 16
+        while capacity < 2 * initial_alleles:
+            capacity *= 2
+        for locus in range(0, numloci):
+            counts = np.zeros(capacity, dtype=np.int64)
+            counts[:initial_alleles] = popsize // initial_alleles
+            counts[:popsize % initial_alleles] += 1
+            traits = np.zeros(capacity, dtype=np.int64)
+            traits[:initial_alleles] = np.arange(self.next_trait_id, self.next_trait_id + initial_alleles)
+            self.traits.append(traits)
+            self.counts.append(counts)
+            self.sizes.append(initial_alleles)
+            self.trees.append(_fenwick_tree(counts))
+            self.sum_squares.append(int((counts ** 2).sum()))
+            self.next_trait_id += initial_alleles
+
+
+    def get_burn_in_ticks(self):
+        """
+        Returns the number of ticks needed to reach stationarity at all loci, from
+        moran_watkins_multilocus_convergence_time_timesteps().
+
+        :return: number of ticks
+        """
+        ticks = moran_watkins_multilocus_convergence_time_timesteps(self.popsize, self.numloci, self.innovation_rate)
+        return max(0, int(math.ceil(ticks)))
+
+
+    def _uniform(self):
+        if self.uniform_pos >= len(self.uniforms):
+            self.uniforms = self.prng.random_sample(self.chunk_size).tolist()
+            self.uniform_pos = 0
+        u = self.uniforms[self.uniform_pos]
+        self.uniform_pos += 1
+        return u
+
+
+    def _change_probabilities(self):
+        """
+        Returns, for each locus, the probability that a tick which selects that locus changes its counts.
+        """
+        popsq = float(self.popsize) * float(self.popsize)
+        mu = self.innovation_rate
+        return [mu + (1.0 - mu) * (1.0 - ss / popsq) for ss in self.sum_squares]
+
+
+    def _pick(self, locus):
+        """
+        Chooses a random individual at a locus and returns the slot of its allele, by descending the Fenwick tree
+        of the counts:  the first slot whose cumulative count exceeds a uniform draw on [0, popsize).
+        """
+        tree = self.trees[locus]
+        capacity = len(tree) - 1
+        target = self._uniform() * self.popsize
+        pos = 0
+        step = capacity
+        while step > 0:
+            nxt = pos + step
+            if nxt <= capacity and tree[nxt] <= target:
+                pos = nxt
+                target -= tree[nxt]
+            step >>= 1
+        return pos
+
+
+    def _add_count(self, locus, slot, delta):
+        counts = self.counts[locus]
+        self.sum_squares[locus] += delta * (2 * int(counts[slot]) + delta)
+        counts[slot] += delta
+        if counts[slot] == 0:
+            self.extinct[locus] += 1
+        tree = self.trees[locus]
+        capacity = len(tree) - 1
+        idx = slot + 1
+        while idx <= capacity:
+            tree[idx] += delta
+            idx += idx & -idx
+
+
+    def _new_slot(self, locus):
+        """
+        Returns a free slot for a new allele at a locus.  When the arrays are full, extinct alleles are dropped if
+        they make up at least half of them, and otherwise the capacity is doubled, so that the cost of rebuilding
+        the arrays and the tree is amortized over many mutations.
+        """
+        size = self.sizes[locus]
+        if size == len(self.counts[locus]):
+            counts = self.counts[locus]
+            traits = self.traits[locus]
+            if 2 * self.extinct[locus] >= size:
+                present = counts > 0
+                size = int(present.sum())
+                counts = counts[present]
+                traits = traits[present]
+                capacity = len(self.counts[locus])
+                self.extinct[locus] = 0
+            else:
+                capacity = 2 * len(counts)
+            self.counts[locus] = np.zeros(capacity, dtype=np.int64)
+            self.counts[locus][:size] = counts
+            self.traits[locus] = np.zeros(capacity, dtype=np.int64)
+            self.traits[locus][:size] = traits
+            self.trees[locus] = _fenwick_tree(self.counts[locus])
+        self.sizes[locus] = size + 1
+        return size
+
+
+    def _apply_change(self, probs):
+        """
+        Draws and applies one change, conditional on a change happening at this tick.
+        """
+        total = sum(probs)
+        target = self._uniform() * total
+        locus = 0
+        while locus < self.numloci - 1 and target >= probs[locus]:
+            target -= probs[locus]
+            locus += 1
+
+        dead = self._pick(locus)
+        if self._uniform() * probs[locus] < self.innovation_rate:
+            self._add_count(locus, dead, -1)
+            slot = self._new_slot(locus)
+            self.traits[locus][slot] = self.next_trait_id
+            self._add_count(locus, slot, 1)
+            self.next_trait_id += 1
+        else:
+            born = self._pick(locus)
+            while born == dead:
+                dead = self._pick(locus)
+                born = self._pick(locus)
+            self._add_count(locus, dead, -1)
+            self._add_count(locus, born, 1)
+
+
+    def _report(self, start, nticks, callback, span_callback):
+        if nticks == 0 or (callback is None and span_callback is None):
+            return
+        countmap = self.get_countmap()
+        if span_callback is not None:
+            span_callback(start, nticks, countmap, {})
+        if callback is not None:
+            for timestep in xrange(start, start + nticks):
+                callback(timestep, countmap, {})
+
+
+    def run(self, ticks, callback=None, span_callback=None, burn_in=True):
+        """
+        Runs the process for a number of ticks, reporting the counts after each tick to callback (once per tick)
+        and/or span_callback (once per run of unchanged ticks).  Unless burn_in is False, the burn-in period is run
+        first, the first time run() is called.
+
+        :param ticks: Number of ticks to run (after any burn-in)
+        :param callback: Optional function called as callback(timestep, countmap, configuration_map) for every tick
+        :param span_callback: Optional function called as span_callback(timestep, nticks, countmap, configuration_map)
+        :param burn_in: Boolean, whether to run the burn-in period first if it has not been run yet
+        :return: void
+        """
+        if burn_in == True and self.burned_in == False:
+            self.burn_in()
+
+        end = self.tick + ticks
+        span_start = self.tick
+        while self.tick < end:
+            probs = self._change_probabilities()
+            prob = sum(probs) / self.numloci
+            if prob <= 0.0:
+                self.tick = end
+                break
+
+            # ticks up to and including the next change are geometric; all but the last leave the counts unchanged
+            if prob >= 1.0:
+                unchanged = 0
+            else:
+                unchanged = int(math.floor(math.log(1.0 - self._uniform()) / math.log1p(-prob)))
+
+            if self.tick + unchanged >= end:
+                self.tick = end
+                break
+
+            self.tick += unchanged
+            self._report(span_start, self.tick - span_start, callback, span_callback)
+            self._apply_change(probs)
+            span_start = self.tick
+            self.tick += 1
+
+        self._report(span_start, self.tick - span_start, callback, span_callback)
+
+
+    def burn_in(self):
+        """
+        Runs the process for the burn-in period given by get_burn_in_ticks(), without reporting counts.
+
+        :return: void
+        """
+        ticks = self.get_burn_in_ticks()
+        log.debug("Moran-IA burn-in for N: %s mu: %s loci: %s is %s ticks", self.popsize, self.innovation_rate,
+                  self.numloci, ticks)
+        self.burned_in = True
+        self.run(ticks, burn_in=False)
+
+
+    def get_trait_counts(self, locus):
+        """
+        Returns the allele ids and counts at a locus, for alleles currently present.
+
+        :param locus:
+        :return: tuple of (array of allele ids, array of counts)
+        """
+        size = self.sizes[locus]
+        present = self.counts[locus][:size] > 0
+        return (self.traits[locus][:size][present], self.counts[locus][:size][present])
+
+
+    def get_countmap(self):
+        """
+        Returns the current counts as a dict of loci, each mapping allele ids to counts.
+
+        :return: dict of loci with dicts of allele:count
+        """
+        countmap = dict()
+        for locus in range(0, self.numloci):
+            (traits, counts) = self.get_trait_counts(locus)
+            countmap[locus] = dict(zip(traits.tolist(), counts.tolist()))
+        return countmap
@@ -11,6 +11,7 @@ Description here
 
 import math
 import logging as log
+import numpy as np
 
 
 def wf_mutation_rate_from_theta(popsize, theta):
@@ -61,4 +62,139 @@ def wfia_convergence_to_stationarity_generations(popsize,mutationrate):
     theta = 2.0 * popsize * mutationrate
     time = (9.2 * popsize) / (theta + 1.0) # this is conservative given the original constant is for the diploid process
 
-    return int(math.ceil(time / 1000.0)) * 1000
\ No newline at end of file
+    return int(math.ceil(time / 1000.0)) * 1000
+
+
+class WrightFisherInfiniteAlleles(object):
+    """
+    Simulates a haploid Wright-Fisher infinite-alleles process at one or more independent loci.  The population
+    is represented at each locus only by an array of allele ids and a parallel array of counts, never by
+    individual agents, so each generation costs O(K) in the number of alleles rather than O(N).
+
+    Each generation is one multinomial resample of the counts (random copying), followed by a binomial draw
+    of the number of copies of each allele which mutate.  Every mutant becomes a new, never before seen allele.
+    Allele ids are unique across all loci.
+
+    The per-generation counts can be passed to a callback with the same signature as
+    MoranCumulativeTimeAverager.record_trait_count_sample(), so that a time averager constructed with a
+    population size of 1 (i.e., with intervals given directly in WF generations) can record them.  Since loci
+    evolve independently in this representation, the configuration map passed to the callback is empty.
+    """
+
+    def __init__(self, popsize, mutationrate, numloci=1, initial_alleles=1, prng=None):
+        """
+
+        :param popsize: The size of the haploid population
+        :param mutationrate: the rate of innovation per individual per generation, at each locus
+        :param numloci: Number of independent loci
+        :param initial_alleles: Number of alleles at each locus in the initial population, in (nearly) equal frequencies
+        :param prng: numpy RandomState to draw from, or None to use the global numpy random state
+        :return: void
+        """
+        self.popsize = popsize
+        self.mutationrate = float(mutationrate)
+        self.numloci = numloci
+        self.prng = np.random if prng is None else prng
+        self.generation = 0
+        self.burned_in = False
+        self.next_trait_id = 0
+        self.traits = []
+        self.counts = []
+
+        for locus in range(0, numloci):
+            counts = np.full(initial_alleles, popsize // initial_alleles, dtype=np.int64)
+            counts[:popsize % initial_alleles] += 1
+            self.traits.append(np.arange(self.next_trait_id, self.next_trait_id + initial_alleles, dtype=np.int64))
+            self.counts.append(counts)
+            self.next_trait_id += initial_alleles
+
+
+    def get_burn_in_generations(self):
+        """
+        Returns the number of generations needed to reach quasi-stationarity, from
+        wfia_convergence_to_stationarity_generations().
+
+        :return: number of generations
+        """
+        return wfia_convergence_to_stationarity_generations(self.popsize, self.mutationrate)
+
+
+    def step(self):
+        """
+        Advances the population one generation at every locus.
+
+        :return: void
+        """
+        for locus in range(0, self.numloci):
+            counts = self.counts[locus]
+            counts = self.prng.multinomial(self.popsize, counts / float(self.popsize))
+            mutants = self.prng.binomial(counts, self.mutationrate)
+            counts -= mutants
+
+            num_new = mutants.sum()
+            present = counts > 0
+            traits = self.traits[locus][present]
+            counts = counts[present]
+            if num_new > 0:
+                traits = np.concatenate((traits, np.arange(self.next_trait_id, self.next_trait_id + num_new, dtype=np.int64)))
+                counts = np.concatenate((counts, np.ones(num_new, dtype=np.int64)))
+                self.next_trait_id += num_new
+
+            self.traits[locus] = traits
+            self.counts[locus] = counts
+
+        self.generation += 1
+
+
+    def burn_in(self):
+        """
+        Runs the process for the burn-in period given by get_burn_in_generations(), without reporting counts.
+
+        :return: void
+        """
+        generations = self.get_burn_in_generations()
+        log.debug("WF-IA burn-in for N: %s mu: %s is %s generations", self.popsize, self.mutationrate, generations)
+        for gen in xrange(0, generations):
+            self.step()
+        self.burned_in = True
+
+
+    def run(self, generations, callback=None, burn_in=True):
+        """
+        Runs the process for a number of generations, calling callback(generation, countmap, configuration_map)
+        after each one.  Unless burn_in is False, the burn-in period is run first, the first time run() is called.
+
+        :param generations: Number of generations to run (after any burn-in)
+        :param callback: Optional function, e.g., the record_trait_count_sample method of a time averager
+        :param burn_in: Boolean, whether to run the burn-in period first if it has not been run yet
+        :return: void
+        """
+        if burn_in == True and self.burned_in == False:
+            self.burn_in()
+
+        for gen in xrange(0, generations):
+            self.step()
+            if callback is not None:
+                callback(self.generation, self.get_countmap(), {})
+
+
+    def get_trait_counts(self, locus):
+        """
+        Returns the allele ids and counts at a locus.
+
+        :param locus:
+        :return: tuple of (array of allele ids, array of counts)
+        """
+        return (self.traits[locus], self.counts[locus])
+
+
+    def get_countmap(self):
+        """
+        Returns the current counts as a dict of loci, each mapping allele ids to counts.
+
+        :return: dict of loci with dicts of allele:count
+        """
+        countmap = dict()
+        for locus in range(0, self.numloci):
+            countmap[locus] = dict(zip(self.traits[locus].tolist(), self.counts[locus].tolist()))
+        return countmap
@@ -8,4 +8,6 @@ Description here
 
 """
 
-from network_sequence import NetworkSequence
\ No newline at end of file
+from network_sequence import NetworkSequence
+from snapshot_store import SparseSnapshotStore
+from transmission import sample_neighbors, copy_neighbor_traits
@@ -9,8 +9,15 @@ Description here
 """
 
 import logging as log
+import bisect
+import os
+import cPickle as pickle
+import threading
+from collections import OrderedDict
 import numpy as np
 import networkx as nx
+import scipy.sparse as sparse
+from snapshot_store import SparseSnapshotStore, decode_edges
 
 
 class NetworkSequence(object):
@@ -24,70 +31,360 @@ class NetworkSequence(object):
      of the sequence.
 
     The interface is designed to hide the underlying representation, and mostly pass back lists of vertices or edges
-    for NetworkX graphs, and occasionally whole NetworkX graphs.
+    for NetworkX graphs, and occasionally whole NetworkX graphs.  Internally, snapshots are held in a
+    SparseSnapshotStore, as sparse keyframes plus the edges and vertices added and removed at each change time,
+    which is compact when each change touches only a small part of a large network.
     """
 
-    def __init__(self):
-        self.time_to_matrix = {}
+    def __init__(self, keyframe_interval=64, cache_size=8, cache_edges=None, prefetch=False):
+        """
+
+        :param keyframe_interval: Number of snapshots between full keyframes in the underlying SparseSnapshotStore
+        :param cache_size: Maximum number of NetworkX graphs to keep in the cache, or 0 to disable caching
+        :param cache_edges: Maximum total number of edges over the cached graphs, or None for no limit
+        :param prefetch: Boolean, whether to build the graph for the next change time in a background thread
+        :return: void
+        """
+        self.store = SparseSnapshotStore(keyframe_interval)
         self.times = []
-        self.time_to_graph = {}
+        # LRU cache of NetworkX graphs keyed by change time, least recently used first
+        self.time_to_graph = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_edges = cache_edges
+        self.cached_edges = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.prefetch = prefetch
+        # change times being built in the background, mapped to an Event set when each is done
+        self.prefetching = {}
+        # incremented whenever snapshots change, so that stale background builds are discarded
+        self.generation = 0
+        self.cache_lock = threading.Lock()
+        # (index, matrix) for the most recently requested CSR matrix
+        self.last_matrix = None
+        # index into self.times of the snapshot returned by the last lookup
+        self.cursor = 0
+        # vertex labels are mapped to integer indices, shared across all snapshots
+        self.vertex_index = {}
+        self.vertex_labels = []
+        self.directed = False
+
+
+    def _get_vertex_ids(self, labels):
+        ids = np.empty(len(labels), dtype=np.int64)
+        for i, label in enumerate(labels):
+            vid = self.vertex_index.get(label)
+            if vid is None:
+                vid = len(self.vertex_labels)
+                self.vertex_index[label] = vid
+                self.vertex_labels.append(label)
+            ids[i] = vid
+        return ids
 
 
+    def _to_sparse(self, matrix):
+        # Converts a NetworkX graph, NumPy array, or scipy.sparse matrix into a COO matrix over the shared vertex
+        # indices and an array of active vertices.  Arrays and sparse matrices are taken to have vertices 0..n-1.
+        if isinstance(matrix, nx.Graph):
+            labels = list(matrix.nodes())
+            self.directed = matrix.is_directed()
+            coo = nx.to_scipy_sparse_matrix(matrix, nodelist=labels, format='coo')
+        else:
+            coo = sparse.coo_matrix(matrix)
+            labels = range(0, coo.shape[0])
+        ids = self._get_vertex_ids(labels)
+        size = len(self.vertex_labels)
+        remapped = sparse.coo_matrix((coo.data, (ids[coo.row], ids[coo.col])), shape=(size, size))
+        return (remapped, ids)
 
 
     def add_network(self, time, matrix):
         """
-        Adds a network snapshot (in the form of an adjacency matrix) to the sequence
+        Adds a network snapshot (in the form of an adjacency matrix, or a NetworkX graph) to the sequence.  The
+        list of change times is kept in order by insertion, and adding a snapshot at an existing time replaces it.
+
+        Snapshots are stored as changes from the previous snapshot, so adding one before the end of the sequence
+        re-encodes the snapshots which follow it.  Sequences are best built in time order.
+
         :param time:
         :param matrix:
         :return:
         """
-        self.time_to_matrix[time] = matrix
-        self.times.append(time)
-        self.times.sort()
+        self._insert({time: self._to_sparse(matrix)})
+
+
+    def add_networks(self, snapshots):
+        """
+        Adds many network snapshots at once, sorting the change times only once.  Use this instead of repeated
+        calls to add_network() when loading a long sequence.
+
+        :param snapshots: dict of time:matrix, or iterable of (time, matrix) pairs
+        :return:
+        """
+        if isinstance(snapshots, dict):
+            snapshots = snapshots.items()
+        self._insert(dict((time, self._to_sparse(matrix)) for time, matrix in snapshots))
+
+
+    def _insert(self, converted):
+        # Snapshots at or after the earliest new time are rebuilt and re-appended to the store together with the
+        # new ones, since each snapshot is stored relative to the one before it.
+        position = bisect.bisect_left(self.times, min(converted.keys()))
+        size = len(self.vertex_labels)
+        merged = dict()
+        for index in xrange(position, len(self.times)):
+            (keys, weights, vertices) = self.store.get_snapshot(index)
+            (rows, cols) = decode_edges(keys)
+            merged[self.times[index]] = (sparse.coo_matrix((weights, (rows, cols)), shape=(size, size)), vertices)
+        merged.update(converted)
+
+        self.store.truncate(position)
+        del self.times[position:]
+        for time in sorted(merged.keys()):
+            (matrix, vertices) = merged[time]
+            self.store.append(matrix, vertices)
+            self.times.append(time)
+        self.cursor = 0
+        self.clear_cache()
+
+
+    def save(self, path):
+        """
+        Writes the sequence to a directory, in a binary format which load() can memory-map.  Besides the files of
+        the SparseSnapshotStore, the directory holds the change times and the vertex labels.
+
+        :param path: directory to write to, which is created if necessary
+        :return: void
+        """
+        self.store.save(path)
+        np.save(os.path.join(path, "times.npy"), np.asarray(self.times, dtype=np.int64))
+        with open(os.path.join(path, "vertices.pkl"), "wb") as f:
+            pickle.dump({'labels': self.vertex_labels, 'directed': self.directed}, f, pickle.HIGHEST_PROTOCOL)
+
+
+    @classmethod
+    def load(cls, path, mmap=True, **kwargs):
+        """
+        Opens a sequence written by save().  By default the snapshot arrays are memory-mapped read-only, so that
+        opening is nearly instant, only the snapshots which are used are read from disk, and many worker processes
+        opening the same sequence share one copy in the OS page cache.
+
+        :param path: directory written by save()
+        :param mmap: Boolean, whether to memory-map the snapshot arrays instead of reading them into memory
+        :param kwargs: other arguments to the constructor (e.g., cache_size)
+        :return: NetworkSequence
+        """
+        sequence = cls(**kwargs)
+        sequence.store = SparseSnapshotStore.load(path, mmap=mmap)
+        sequence.times = np.load(os.path.join(path, "times.npy")).tolist()
+        with open(os.path.join(path, "vertices.pkl"), "rb") as f:
+            vertices = pickle.load(f)
+        sequence.vertex_labels = vertices['labels']
+        sequence.vertex_index = dict((label, i) for i, label in enumerate(sequence.vertex_labels))
+        sequence.directed = vertices['directed']
+        return sequence
+
+
+    def get_snapshot_time_for_time(self, time):
+        """
+        Returns the change time of the snapshot which is in effect at the specified time:  the latest change time
+        which is less than or equal to it.  Lookups are by bisection over the change times, but the position of the
+        last lookup is remembered, so a simulation which asks for the network at each tick, in increasing
+        order, only ever steps the cursor forward, in amortized constant time.
+
+        :param time:
+        :return: integer change time
+        """
+        return self.times[self._get_snapshot_index(time)]
+
+
+    def _get_snapshot_index(self, time):
+        times = self.times
+        if len(times) == 0 or time < times[0]:
+            raise ValueError("no network snapshot is in effect at time %s" % time)
+
+        cursor = self.cursor
+        if cursor >= len(times) or times[cursor] > time:
+            cursor = bisect.bisect_right(times, time) - 1
+        else:
+            # step forward over a few change times before falling back to bisection
+            steps = 0
+            while cursor + 1 < len(times) and times[cursor + 1] <= time:
+                cursor += 1
+                steps += 1
+                if steps == 8:
+                    cursor = bisect.bisect_right(times, time, lo=cursor) - 1
+                    break
+        self.cursor = cursor
+        return cursor
+
+
+    def get_matrix_for_time(self, time):
+        """
+        Returns the adjacency matrix of the network at the specified time, as a CSR matrix whose rows and
+        columns are the shared vertex indices (see get_vertex_labels()).  The matrix for the current snapshot is
+        kept, so that asking for it at every tick of an interval does not rebuild it, and it must not be modified.
 
+        :param time:
+        :return: scipy.sparse.csr_matrix
+        """
+        index = self._get_snapshot_index(time)
+        last = self.last_matrix
+        if last is not None and last[0] == index:
+            return last[1]
+        matrix = self.store.get_matrix(index, len(self.vertex_labels))
+        self.last_matrix = (index, matrix)
+        return matrix
+
+
+    def get_vertex_labels(self):
+        """
+        Returns the labels of the vertices, in the order of the shared vertex indices used by the matrices.
+
+        :return: list of vertex labels
+        """
+        return self.vertex_labels
 
 
     def get_graph_matrix_for_time(self, time):
         """
-        Returns networkx Graph object for the state of the temporal network at the specified time
+        Returns networkx Graph object for the state of the temporal network at the specified time.  Graphs are
+        cached, so the same object is returned for every time in a snapshot's interval, and it must not be modified.
         :param time:
         :return:
         """
-        index = None
+        index = self._get_snapshot_index(time)
+        #log.debug("snapshot time for index %s is: %s", time, self.times[index])
+        graph = self._get_graph(index)
+        if self.prefetch and index + 1 < len(self.times):
+            self._start_prefetch(index + 1)
+        return graph
+
+
+    def _get_graph(self, index):
+        time = self.times[index]
+        if self.cache_size == 0:
+            self.cache_misses += 1
+            return self._build_graph(index)
+
+        with self.cache_lock:
+            graph = self.time_to_graph.pop(time, None)
+            pending = self.prefetching.get(time)
+            if graph is not None:
+                self.cache_hits += 1
+                self.time_to_graph[time] = graph
+                return graph
+
+        if pending is not None:
+            pending.wait()
+            with self.cache_lock:
+                graph = self.time_to_graph.get(time)
+                if graph is not None:
+                    self.cache_hits += 1
+                    return graph
+
+        self.cache_misses += 1
+        graph = self._build_graph(index)
+        with self.cache_lock:
+            self._cache_graph(time, graph)
+        return graph
 
-        for t in self.times:
-            if time > t:
-                index = t
-            elif time <= t and index != None:
-                break
-            else:
-                continue
 
-        # handle the zero equality case
-        if time == 0:
-            index = 0
+    def _build_graph(self, index):
+        (keys, weights, vertices) = self.store.get_snapshot(index)
+        (rows, cols) = decode_edges(keys)
+        labels = self.vertex_labels
+        graph = nx.DiGraph() if self.directed else nx.Graph()
+        graph.add_nodes_from(labels[v] for v in vertices.tolist())
+        graph.add_weighted_edges_from((labels[r], labels[c], w)
+                                      for r, c, w in zip(rows.tolist(), cols.tolist(), weights.tolist()))
+        return graph
 
-        log.debug("snapshot time for index %s is: %s", time, index)
 
-        return
+    def _cache_graph(self, time, graph):
+        # called with the cache lock held
+        if time in self.time_to_graph:
+            return
+        self.time_to_graph[time] = graph
+        self.cached_edges += graph.number_of_edges()
+        while len(self.time_to_graph) > self.cache_size or \
+                (self.cache_edges is not None and self.cached_edges > self.cache_edges and len(self.time_to_graph) > 1):
+            (evicted_time, evicted) = self.time_to_graph.popitem(last=False)
+            self.cached_edges -= evicted.number_of_edges()
+
+
+    def _start_prefetch(self, index):
+        time = self.times[index]
+        with self.cache_lock:
+            if time in self.time_to_graph or time in self.prefetching:
+                return
+            done = threading.Event()
+            self.prefetching[time] = done
+        thread = threading.Thread(target=self._prefetch, args=(index, time, self.generation, done))
+        thread.daemon = True
+        thread.start()
+
+
+    def _prefetch(self, index, time, generation, done):
+        try:
+            graph = self._build_graph(index)
+            with self.cache_lock:
+                if generation == self.generation:
+                    self._cache_graph(time, graph)
+        except Exception:
+            log.exception("error prefetching network snapshot for time %s", time)
+        finally:
+            with self.cache_lock:
+                if self.prefetching.get(time) is done:
+                    del self.prefetching[time]
+            done.set()
+
+
+    def get_cache_info(self):
+        """
+        Returns statistics for the cache of NetworkX graphs.
+
+        :return: dict with hits, misses, current number of graphs, and total edges of the cached graphs
+        """
+        with self.cache_lock:
+            return {'hits': self.cache_hits, 'misses': self.cache_misses, 'maxsize': self.cache_size,
+                    'currsize': len(self.time_to_graph), 'edges': self.cached_edges}
+
+
+    def clear_cache(self):
+        """
+        Empties the cache of NetworkX graphs, and discards any graphs still being built in the background.
+
+        :return: void
+        """
+        with self.cache_lock:
+            self.generation += 1
+            self.time_to_graph.clear()
+            self.cached_edges = 0
+            self.prefetching.clear()
+            self.last_matrix = None
 
 
     def get_new_vertices_for_time(self, time):
         """
+        Returns the vertices which were added to the network at the change time in effect at the specified time.
+        All vertices of the first snapshot are new.
 
         :param time:
-        :return:
+        :return: list of vertex labels
         """
-        pass
+        index = self._get_snapshot_index(time)
+        return [self.vertex_labels[v] for v in self.store.get_added_vertices(index).tolist()]
 
     def get_removed_vertices_for_time(self, time):
         """
+        Returns the vertices which were removed from the network at the change time in effect at the specified time.
 
         :param time:
-        :return:
+        :return: list of vertex labels
         """
-        pass
+        index = self._get_snapshot_index(time)
+        return [self.vertex_labels[v] for v in self.store.get_removed_vertices(index).tolist()]
 
 
     def get_list_of_change_times(self):
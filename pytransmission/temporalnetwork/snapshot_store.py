@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# Copyright (c) 2013.  Mark E. Madsen <mark@madsenlab.org>
+#
+# This work is licensed under the terms of the Apache Software License, Version 2.0.  See the file LICENSE for details.
+
+"""
+Compact storage for a sequence of sparse network snapshots, as periodic full keyframes plus per-snapshot deltas
+of added and removed edges and vertices.
+
+"""
+
+import logging as log
+import os
+import numpy as np
+import scipy.sparse as sparse
+
+
+def encode_edges(rows, cols):
+    """
+    Packs (row, col) vertex index pairs into single int64 edge keys, which sort in row-major order.
+
+    :param rows:
+    :param cols:
+    :return: numpy array of edge keys
+    """
+    return (np.asarray(rows, dtype=np.int64) << 32) | np.asarray(cols, dtype=np.int64)
+
+
+def decode_edges(keys):
+    """
+    Unpacks int64 edge keys into (row, col) vertex index arrays.
+
+    :param keys:
+    :return: tuple of numpy arrays (rows, cols)
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    return (keys >> 32, keys & 0xFFFFFFFF)
+
+
+def _diff(previous, previous_values, current, current_values):
+    # keys are sorted and unique in both arrays
+    removed = previous[~np.in1d(previous, current, assume_unique=True)]
+    is_new = ~np.in1d(current, previous, assume_unique=True)
+    if current_values is not None and len(previous) > 0:
+        # keys whose value changed are re-added with the new value
+        common = np.flatnonzero(~is_new)
+        old_values = previous_values[np.searchsorted(previous, current[common])]
+        is_new[common[old_values != current_values[common]]] = True
+    added = current[is_new]
+    added_values = current_values[is_new] if current_values is not None else None
+    return (added, added_values, removed)
+
+
+def _apply(keys, values, deltas):
+    # Replays a run of deltas onto a sorted key array in one pass:  the events for each key are reduced to the
+    # last one, and the net additions and removals are merged into the base with a single sort.
+    if len(deltas) == 0:
+        return (keys, values)
+
+    event_keys = np.concatenate([np.concatenate((d[0], d[2])) for d in deltas])
+    event_order = np.concatenate([np.full(len(d[0]) + len(d[2]), i, dtype=np.int64) for i, d in enumerate(deltas)])
+    event_add = np.concatenate([np.concatenate((np.ones(len(d[0]), dtype=bool), np.zeros(len(d[2]), dtype=bool)))
+                                for d in deltas])
+    order = np.lexsort((event_order, event_keys))
+    event_keys = event_keys[order]
+    last = np.ones(len(event_keys), dtype=bool)
+    last[:-1] = event_keys[1:] != event_keys[:-1]
+    net_keys = event_keys[last]
+    net_add = event_add[order][last]
+
+    keep = ~np.in1d(keys, net_keys, assume_unique=True)
+    merged_keys = np.concatenate((keys[keep], net_keys[net_add]))
+    sort = np.argsort(merged_keys, kind='mergesort')
+    if values is None:
+        return (merged_keys[sort], None)
+
+    event_values = np.concatenate([np.concatenate((d[1], np.zeros(len(d[2])))) for d in deltas])
+    net_values = event_values[order][last]
+    merged_values = np.concatenate((values[keep], net_values[net_add]))
+    return (merged_keys[sort], merged_values[sort])
+
+
+def _pack(arrays, dtype):
+    # concatenates a list of arrays, returning the concatenation and the offsets of each array within it
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(a) for a in arrays])
+    packed = np.concatenate(arrays).astype(dtype) if len(arrays) > 0 else np.empty(0, dtype=dtype)
+    return (packed, offsets)
+
+
+class _PackedSequence(object):
+    """
+    Read-only list-like view of a packed sequence of tuples of arrays, as written by SparseSnapshotStore.save().
+    Each field is a packed array with its offsets (or None), and items are sliced out only when accessed, so a
+    memory-mapped file is only read for the items which are used.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __len__(self):
+        return len(self.fields[0][1]) - 1
+
+    def _item(self, i):
+        return tuple(packed[offsets[i]:offsets[i + 1]] if packed is not None else None
+                     for packed, offsets in self.fields)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("packed sequence index out of range: %s" % i)
+        return self._item(i)
+
+    def __iter__(self):
+        for i in xrange(0, len(self)):
+            yield self._item(i)
+
+
+class _PackedDeltas(_PackedSequence):
+    # deltas are nested as (edge delta, vertex delta)
+    def _item(self, i):
+        item = super(_PackedDeltas, self)._item(i)
+        return (item[0:3], item[3:6])
+
+
+class SparseSnapshotStore(object):
+    """
+    Stores a sequence of network snapshots over integer vertex indices.  Each snapshot is a set of weighted edges
+    and a set of active vertices.  Every keyframe_interval-th snapshot is stored in full, and every snapshot
+    stores the edges and vertices added and removed since the previous one (an edge whose weight changes is
+    stored as added again, with its new weight).  A snapshot is rebuilt from the nearest earlier keyframe by
+    replaying the deltas since, so the cost is proportional to the keyframe size plus the delta distance, and at
+    most keyframe_interval - 1 deltas are ever replayed.
+
+    Edges are held as sorted int64 keys packing (row, col), with a parallel array of weights, so the store puts no
+    limit on the number of vertices other than 2^32.
+    """
+
+    def __init__(self, keyframe_interval=64):
+        """
+
+        :param keyframe_interval: Number of snapshots between full keyframes
+        :return: void
+        """
+        if keyframe_interval < 1:
+            raise ValueError("keyframe interval must be positive: %s" % keyframe_interval)
+        self.keyframe_interval = keyframe_interval
+        # keyframes are (edge keys, weights, vertices), indexed by snapshot number / keyframe_interval
+        self.keyframes = []
+        # deltas are ((added edges, added weights, removed edges), (added vertices, None, removed vertices))
+        self.deltas = []
+        self.last_snapshot = None
+
+
+    def __len__(self):
+        return len(self.deltas)
+
+
+    def append(self, matrix, vertices):
+        """
+        Appends a snapshot to the end of the sequence.
+
+        :param matrix: scipy.sparse matrix of edge weights, indexed by vertex
+        :param vertices: sequence of indices of the active vertices (including any without edges)
+        :return: void
+        """
+        self._make_writable()
+        coo = sparse.coo_matrix(matrix)
+        coo.sum_duplicates()
+        keys = encode_edges(coo.row, coo.col)
+        order = np.argsort(keys)
+        keys = keys[order]
+        weights = coo.data.astype(np.float64)[order]
+        vertices = np.unique(np.asarray(vertices, dtype=np.int64))
+
+        if self.last_snapshot is None:
+            empty = np.empty(0, dtype=np.int64)
+            self.last_snapshot = (empty, np.empty(0), empty)
+        (last_keys, last_weights, last_vertices) = self.last_snapshot
+
+        edge_delta = _diff(last_keys, last_weights, keys, weights)
+        vertex_delta = _diff(last_vertices, None, vertices, None)
+        if len(self.deltas) % self.keyframe_interval == 0:
+            self.keyframes.append((keys, weights, vertices))
+        self.deltas.append((edge_delta, vertex_delta))
+        self.last_snapshot = (keys, weights, vertices)
+
+
+    def _make_writable(self):
+        # a store opened with load() holds read-only packed views, which are unpacked into lists (of views of the
+        # same arrays, so no data is copied) the first time it is modified
+        if isinstance(self.deltas, list):
+            return
+        self.keyframes = list(self.keyframes)
+        self.deltas = list(self.deltas)
+        self.last_snapshot = self.get_snapshot(-1) if len(self.deltas) > 0 else None
+
+
+    def save(self, path):
+        """
+        Writes the store to a directory of .npy files, which load() can memory-map.  Each kind of array (edge keys,
+        weights, and vertices of the keyframes, and the added and removed edges and vertices of the deltas) is
+        packed into a single flat file, with a companion file of offsets marking where each snapshot's array starts.
+
+        :param path: directory to write to, which is created if necessary
+        :return: void
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        def write(name, arrays, dtype):
+            (packed, offsets) = _pack(arrays, dtype)
+            np.save(os.path.join(path, name + ".npy"), packed)
+            np.save(os.path.join(path, name + "_offsets.npy"), offsets)
+
+        keyframes = list(self.keyframes)
+        deltas = list(self.deltas)
+        write("keyframe_edges", [k[0] for k in keyframes], np.int64)
+        write("keyframe_weights", [k[1] for k in keyframes], np.float64)
+        write("keyframe_vertices", [k[2] for k in keyframes], np.int64)
+        write("added_edges", [d[0][0] for d in deltas], np.int64)
+        write("added_weights", [d[0][1] for d in deltas], np.float64)
+        write("removed_edges", [d[0][2] for d in deltas], np.int64)
+        write("added_vertices", [d[1][0] for d in deltas], np.int64)
+        write("removed_vertices", [d[1][2] for d in deltas], np.int64)
+        np.save(os.path.join(path, "keyframe_interval.npy"), np.array([self.keyframe_interval], dtype=np.int64))
+
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Opens a store written by save().  By default the files are memory-mapped read-only, so opening is fast,
+        only the snapshots which are rebuilt are ever read from disk, and processes which open the same files share
+        them in the OS page cache.  The store can still be appended to, which keeps the existing snapshots on disk.
+
+        :param path: directory written by save()
+        :param mmap: Boolean, whether to memory-map the files instead of reading them into memory
+        :return: SparseSnapshotStore
+        """
+        mode = 'r' if mmap else None
+
+        def read(name):
+            return (np.load(os.path.join(path, name + ".npy"), mmap_mode=mode),
+                    np.load(os.path.join(path, name + "_offsets.npy")))
+
+        interval = int(np.load(os.path.join(path, "keyframe_interval.npy"))[0])
+        store = cls(interval)
+        store.keyframes = _PackedSequence([read("keyframe_edges"), read("keyframe_weights"),
+                                           read("keyframe_vertices")])
+        (added_vertices, offsets) = read("added_vertices")
+        store.deltas = _PackedDeltas([read("added_edges"), read("added_weights"), read("removed_edges"),
+                                      (added_vertices, offsets), (None, offsets), read("removed_vertices")])
+        return store
+
+
+    def truncate(self, length):
+        """
+        Discards the snapshots from the given position to the end of the sequence.
+
+        :param length: number of snapshots to keep
+        :return: void
+        """
+        if length >= len(self.deltas):
+            return
+        self._make_writable()
+        del self.deltas[length:]
+        del self.keyframes[(length + self.keyframe_interval - 1) // self.keyframe_interval:]
+        self.last_snapshot = self.get_snapshot(length - 1) if length > 0 else None
+
+
+    def get_snapshot(self, index):
+        """
+        Rebuilds a snapshot from the nearest earlier keyframe and the deltas since.
+
+        :param index: position of the snapshot in the sequence
+        :return: tuple of numpy arrays (sorted edge keys, weights, sorted vertices)
+        """
+        if index < 0:
+            index += len(self.deltas)
+        if index < 0 or index >= len(self.deltas):
+            raise IndexError("snapshot index out of range: %s" % index)
+
+        keyframe = index // self.keyframe_interval
+        (keys, weights, vertices) = self.keyframes[keyframe]
+        replay = self.deltas[keyframe * self.keyframe_interval + 1:index + 1]
+        (keys, weights) = _apply(keys, weights, [edges for edges, verts in replay])
+        (vertices, none) = _apply(vertices, None, [verts for edges, verts in replay])
+        return (keys, weights, vertices)
+
+
+    def get_matrix(self, index, numvertices):
+        """
+        Returns a snapshot as a CSR adjacency matrix.
+
+        :param index: position of the snapshot in the sequence
+        :param numvertices: number of rows and columns of the matrix
+        :return: scipy.sparse.csr_matrix of edge weights
+        """
+        (keys, weights, vertices) = self.get_snapshot(index)
+        (rows, cols) = decode_edges(keys)
+        return sparse.csr_matrix((weights, (rows, cols)), shape=(numvertices, numvertices))
+
+
+    def get_added_vertices(self, index):
+        """
+        Returns the vertices which are active in a snapshot, but were not in the previous one.
+
+        :param index: position of the snapshot in the sequence
+        :return: numpy array of vertex indices
+        """
+        return self.deltas[index][1][0]
+
+
+    def get_removed_vertices(self, index):
+        """
+        Returns the vertices which were active in the previous snapshot, but are not in this one.
+
+        :param index: position of the snapshot in the sequence
+        :return: numpy array of vertex indices
+        """
+        return self.deltas[index][1][2]
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# Copyright (c) 2013.  Mark E. Madsen <mark@madsenlab.org>
+#
+# This work is licensed under the terms of the Apache Software License, Version 2.0.  See the file LICENSE for details.
+
+"""
+Vectorized kernels for network-structured copying, which work directly on the CSR adjacency matrix of a network
+snapshot (e.g., from NetworkSequence.get_matrix_for_time()), so that a whole generation of agents chooses random
+neighbors with a few NumPy operations instead of one NetworkX lookup per agent.
+
+"""
+
+import logging as log
+import numpy as np
+import scipy.sparse as sparse
+
+
+def sample_neighbors(adjacency, agents=None, weighted=False, prng=None):
+    """
+    Chooses a random neighbor for each of a set of agents.  Agent i chooses among the vertices j with an edge
+    (i, j), i.e., the column indices of row i, using the CSR index pointers as offsets into the column indices:
+    the neighbor is indices[indptr[i] + floor(u * degree(i))] for a uniform draw u.  When weighted is True,
+    neighbors are chosen in proportion to the edge weights instead, by bisection on the cumulative weights of the
+    chosen agents' rows, so that the cost is proportional to their total degree rather than to the whole network.
+
+    :param adjacency: scipy.sparse adjacency matrix (converted to CSR if necessary)
+    :param agents: array of the agents (row indices) which choose a neighbor, or None for all of them
+    :param weighted: Boolean, whether to choose neighbors in proportion to edge weights
+    :param prng: numpy RandomState to draw from, or None to use the global numpy random state
+    :return: numpy array with the chosen neighbor of each agent, or -1 for agents without neighbors
+    """
+    if prng is None:
+        prng = np.random
+
+    csr = sparse.csr_matrix(adjacency)
+    if agents is None:
+        agents = np.arange(csr.shape[0])
+    else:
+        agents = np.asarray(agents, dtype=np.int64)
+
+    starts = csr.indptr[agents]
+    degrees = csr.indptr[agents + 1] - starts
+    uniforms = prng.random_sample(len(agents))
+
+    if weighted:
+        # gather the edges of the chosen rows end to end, and work with offsets into that array
+        ends = np.cumsum(degrees)
+        offsets = ends - degrees
+        numedges = ends[-1] if len(ends) > 0 else 0
+        if numedges == 0:
+            positions = starts
+        else:
+            shift = starts - offsets
+            cumulative = np.cumsum(csr.data[np.repeat(shift, degrees) + np.arange(numedges)], dtype=np.float64)
+            before = np.where(offsets > 0, cumulative[np.maximum(offsets - 1, 0)], 0.0)
+            totals = np.where(degrees > 0, cumulative[np.maximum(ends - 1, 0)] - before, 0.0)
+            local = np.searchsorted(cumulative, before + uniforms * totals, side='right')
+            # guard against rounding at the ends of a row
+            local = np.clip(local, offsets, offsets + np.maximum(degrees - 1, 0))
+            positions = local + shift
+    else:
+        positions = starts + (uniforms * degrees).astype(np.int64)
+
+    neighbors = np.full(len(agents), -1, dtype=np.int64)
+    has_neighbors = degrees > 0
+    neighbors[has_neighbors] = csr.indices[positions[has_neighbors]]
+    return neighbors
+
+
+def copy_neighbor_traits(adjacency, traits, agents=None, weighted=False, prng=None):
+    """
+    One round of network-structured copying:  each agent adopts the trait of a random neighbor, chosen with
+    sample_neighbors().  All agents copy from the traits as they were before the round, as in a Wright-Fisher
+    generation.  For Moran dynamics, pass the agent (or agents) which copy at a tick as agents.  Agents without
+    neighbors keep their own trait.
+
+    :param adjacency: scipy.sparse adjacency matrix, with rows and columns indexed like traits
+    :param traits: numpy array of the trait of each agent (or of shape (agents, loci) for several loci)
+    :param agents: array of the agents which copy, or None for all of them
+    :param weighted: Boolean, whether to choose neighbors in proportion to edge weights
+    :param prng: numpy RandomState to draw from, or None to use the global numpy random state
+    :return: new numpy array of traits
+    """
+    traits = np.asarray(traits)
+    if agents is None:
+        agents = np.arange(len(traits))
+    else:
+        agents = np.asarray(agents, dtype=np.int64)
+
+    neighbors = sample_neighbors(adjacency, agents, weighted=weighted, prng=prng)
+    copying = neighbors >= 0
+    result = traits.copy()
+    result[agents[copying]] = traits[neighbors[copying]]
+    return result
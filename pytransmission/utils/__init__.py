@@ -7,4 +7,6 @@
 Description here
 
 """
-from sampling import get_sampled_counter, get_sampled_dict_counts
\ No newline at end of file
+from sampling import get_sampled_counter, get_sampled_dict_counts, get_sampled_array_counts, \
+    multivariate_hypergeometric, sample_count_rows
+from caching import lru_cache
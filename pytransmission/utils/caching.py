@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# Copyright (c) 2013.  Mark E. Madsen <mark@madsenlab.org>
+#
+# This work is licensed under the terms of the Apache Software License, Version 2.0.  See the file LICENSE for details.
+
+"""
+Memoization of expensive, pure functions, which are frequently called with the same arguments many times
+inside parameter sweeps.
+
+"""
+
+import functools
+from collections import OrderedDict
+
+
+# separates positional from keyword arguments in a cache key
+_KWARGS_MARK = object()
+
+
+def lru_cache(maxsize=1024):
+    """
+    Decorator which caches the results of a function, keeping at most maxsize results and evicting the least
+    recently used.  (Python 2 has no functools.lru_cache.)  Results are keyed on the positional and keyword
+    arguments, so the same call made positionally and by keyword is cached twice.  Calls with unhashable arguments
+    (e.g., lists or 0-d numpy arrays) are passed straight through to the function, uncached.  The decorated function
+    has cache_info() and cache_clear() methods, like its Python 3 counterpart.
+
+    :param maxsize: maximum number of results to keep
+    :return: decorator
+    """
+    def decorator(func):
+        cache = OrderedDict()
+        stats = {'hits': 0, 'misses': 0}
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = args
+            if kwargs:
+                key += (_KWARGS_MARK,) + tuple(sorted(kwargs.items()))
+            try:
+                hash(key)
+            except TypeError:
+                stats['misses'] += 1
+                return func(*args, **kwargs)
+
+            try:
+                result = cache.pop(key)
+                stats['hits'] += 1
+            except KeyError:
+                result = func(*args, **kwargs)
+                stats['misses'] += 1
+                if len(cache) >= maxsize:
+                    cache.popitem(last=False)
+            cache[key] = result
+            return result
+
+        def cache_info():
+            return {'hits': stats['hits'], 'misses': stats['misses'], 'maxsize': maxsize, 'currsize': len(cache)}
+
+        def cache_clear():
+            cache.clear()
+            stats['hits'] = 0
+            stats['misses'] = 0
+
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        return wrapper
+
+    return decorator
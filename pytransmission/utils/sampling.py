@@ -8,76 +8,201 @@ Utility methods for sampling various objects, which is frequently done by simula
 
 """
 
-import random
+import numpy as np
 import numpy.random as npr
 from collections import Counter
 import logging as log
 
 
+def sample_count_rows(counts, nsample, replace=True, prng=None):
+    """
+    Draws one sample from each row of a matrix of category counts, where each row describes a different
+    population, without expanding the populations into individual elements.  When sampling with replacement, each
+    row is a single multinomial draw.  When sampling without replacement, the sampled count of each category is
+    drawn hypergeometrically, conditional on the categories already drawn, and all of the rows are advanced
+    together, so the cost is one vectorized draw per category regardless of the number of rows or the population
+    sizes.
+
+    :param counts: array of shape (M, K) of non-negative integer counts, one row per population
+    :param nsample: array of M sample sizes, one per row
+    :param replace: Boolean, whether to sample with replacement (multinomial) or without (multivariate hypergeometric)
+    :param prng: numpy RandomState to draw from, or None to use the global numpy random state
+    :return: numpy array of shape (M, K) of sampled counts
+    """
+    if prng is None:
+        prng = npr
+
+    counts = np.asarray(counts, dtype=np.int64)
+    remaining_sample = np.array(nsample, dtype=np.int64).reshape(len(counts))
+    remaining_pop = counts.sum(axis=1)
+
+    if replace == False and np.any(remaining_sample > remaining_pop):
+        raise ValueError("sample size requested: %s is larger than population: %s" % (remaining_sample.max(), remaining_pop.min()))
+    if replace == True and np.any((remaining_pop == 0) & (remaining_sample > 0)):
+        raise ValueError("sample size requested from an empty population")
+
+    sampled = np.zeros(counts.shape, dtype=np.int64)
+    if replace == True:
+        # numpy's multinomial is a single call per row, looping over the categories in C
+        for row in np.flatnonzero(remaining_sample > 0):
+            sampled[row] = prng.multinomial(remaining_sample[row], counts[row] / float(remaining_pop[row]))
+        return sampled
+
+    for k in xrange(0, counts.shape[1]):
+        active = (remaining_sample > 0) & (counts[:, k] > 0)
+        if not active.any():
+            if not remaining_sample.any():
+                break
+            continue
+
+        good = counts[active, k]
+        rest = remaining_pop[active]
+        drawn = prng.hypergeometric(good, rest - good, remaining_sample[active])
+
+        sampled[active, k] = drawn
+        remaining_sample[active] -= drawn
+        remaining_pop -= counts[:, k]
+
+    return sampled
+
+
+def multivariate_hypergeometric(counts, nsample, prng=None):
+    """
+    Draws samples without replacement from a population described by a vector of category counts, without
+    expanding the population into individual elements.  The count of each category in the sample is drawn
+    from a univariate hypergeometric conditional on the categories already drawn, so each draw costs O(K)
+    for K categories regardless of the population size.
+
+    If nsample is an array, one sample is drawn for each entry, all of them advanced together through the
+    categories with sample_count_rows().
+
+    :param counts: sequence of non-negative integer counts, one per category
+    :param nsample: sample size, or array of sample sizes
+    :param prng: numpy RandomState to draw from, or None to use the global numpy random state
+    :return: numpy array of sampled counts, shape (K,) for a scalar nsample or (len(nsample), K) otherwise
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    sizes = np.atleast_1d(np.array(nsample, dtype=np.int64))
+    total = counts.sum()
+
+    if np.any(sizes > total):
+        raise ValueError("sample size requested: %s is larger than population: %s" % (sizes.max(), total))
+
+    rows = np.tile(counts, (len(sizes), 1))
+    sampled = sample_count_rows(rows, sizes, replace=False, prng=prng)
+
+    if np.ndim(nsample) == 0:
+        return sampled[0]
+    return sampled
+
+
 def get_sampled_counter(ssize_list, counter):
     """
     Given a Counter object, and one or more sample sizes, take samples from the Counter
     of the appropriate sizes, creating new Counter objects with those samples.  Return
     a dict with the requested ssize as key, and the new sampled Counter objects as values.
 
+    Samples are drawn without replacement with multivariate_hypergeometric(), working directly on the
+    counts.  The samples are nested:  the largest sample is drawn from the Counter, and each smaller sample
+    is a subsample of the next larger one, just as if a single excavated assemblage were subsampled.
+
     :param ssize_list:
     :param counter:
     :return: dict with { ssize: counter } for all ssize in ssize_list
     """
     result = dict()
-    # unpacks the counts into a list, so {trait1:3, trait2:2} becomes {trait1,trait1,trait1,trait2,trait2}
-    items = list(counter.elements())
-    total = sum(counter.values())
+    traits = [trait for trait, count in counter.items() if count > 0]
+    counts = np.array([counter[trait] for trait in traits], dtype=np.int64)
+    total = int(counts.sum())
     #log.debug("total represented in counter: %s", total)
     #log.debug("original Counter: %s", counter)
     for ssize in ssize_list:
         if ssize > total:
             raise ValueError("sample size requested: %s is larger than population: %s" % (ssize, total))
-        sample = random.sample(items, ssize)
-        new_counter = Counter()
-        new_counter.update(sample)
+
+    current = counts
+    for ssize in sorted(set(ssize_list), reverse=True):
+        current = multivariate_hypergeometric(current, ssize)
+        nonzero = np.flatnonzero(current)
+        new_counter = Counter(dict(zip([traits[i] for i in nonzero], current[nonzero].tolist())))
         #log.debug("counter for ssize %s: %s", ssize, new_counter)
         result[ssize] = new_counter
 
     return result
 
 
-def get_sampled_dict_counts(ssize_list, dcounts):
+def get_sampled_array_counts(ssize_list, traits, counts, replace=True, replicates=None, prng=None):
     """
-    Often, we use a dict to keep counts of categories, classes, traits.  Given a dict where
-    objects to count are keys, and counts are values, take samples from the dict with sizes
-    given in the ssize_list, and return a new dict with the requested ssize as key, and a dict with
-    object:count_in_sample as value.
+    Array-based version of get_sampled_dict_counts().  Given an array of trait identifiers and a parallel
+    array of counts, take samples of each size in ssize_list.  Traits with zero counts are dropped.
+
+    With replace=True, samples are multinomial draws from a probability vector computed once and shared by
+    all of the sample sizes.  With replace=False, samples are drawn without replacement from the finite
+    population with multivariate_hypergeometric(), and every sample size and replicate is drawn in one pass over
+    the traits.
 
     :param ssize_list:
-    :param dcounts:
-    :return: dict with { ssize: { object: count }} for all ssize in ssize_list
+    :param traits: array of trait identifiers
+    :param counts: array of counts, parallel to traits
+    :param replace: Boolean, whether to sample with replacement (multinomial) or without (hypergeometric)
+    :param replicates: number of independent replicate samples of each size, or None for a single unreplicated set
+    :param prng: numpy RandomState to draw from, or None to use the global numpy random state
+    :return: tuple of (array of traits with non-zero counts, array of sampled counts).  The counts array has shape (len(ssize_list), len(traits)), or (replicates, len(ssize_list), len(traits)) if replicates is given.
     """
-    result = dict()
-    total = sum(dcounts.values())
+    if prng is None:
+        prng = npr
+
+    traits = np.asarray(traits)
+    counts = np.asarray(counts, dtype=np.int64)
+    total = counts.sum()
     for ssize in ssize_list:
         if ssize > total:
             raise ValueError("sample size requested: %s is larger than the population: %s" % (ssize, total))
 
-        traits = []
-        prob = []
-        for trait, count in dcounts.items():
-            if count > 0:
-                traits.append(trait)
-                prob.append(float(count) / float(total))
+    present = counts > 0
+    traits = traits[present]
+    counts = counts[present]
+    num_reps = 1 if replicates is None else replicates
 
-        sampled_counts = npr.multinomial(ssize,prob,size=1)
-        count_list = sampled_counts.tolist()
-        #log.debug("traits: %s total: %s prob: %s counts: %s", traits, total, prob, count_list)
-        sampled_dict = dict(zip(traits, count_list[0]))
-        result[ssize] = sampled_dict
-
-    #log.debug("result from sampled dict: %s", result)
-    return result
+    if replace == False:
+        sizes = np.tile(np.asarray(ssize_list, dtype=np.int64), num_reps)
+        sampled = multivariate_hypergeometric(counts, sizes, prng=prng)
+        sampled = sampled.reshape((num_reps, len(ssize_list), len(traits)))
+    else:
+        prob = counts / float(total)
+        # numpy's multinomial takes a single number of trials per call, so we make one call per ssize
+        sampled = np.empty((num_reps, len(ssize_list), len(traits)), dtype=np.int64)
+        for col, ssize in enumerate(ssize_list):
+            sampled[:, col, :] = prng.multinomial(ssize, prob, size=num_reps)
 
+    if replicates is None:
+        sampled = sampled[0]
+    return (traits, sampled)
 
 
+def get_sampled_dict_counts(ssize_list, dcounts, replace=True):
+    """
+    Often, we use a dict to keep counts of categories, classes, traits.  Given a dict where
+    objects to count are keys, and counts are values, take samples from the dict with sizes
+    given in the ssize_list, and return a new dict with the requested ssize as key, and a dict with
+    object:count_in_sample as value.
 
+    This is a wrapper around get_sampled_array_counts().  By default samples are drawn with replacement;
+    give replace=False to sample without replacement from the finite population of counts.
 
+    :param ssize_list:
+    :param dcounts:
+    :param replace: Boolean, whether to sample with replacement
+    :return: dict with { ssize: { object: count }} for all ssize in ssize_list
+    """
+    traits = list(dcounts.keys())
+    counts = [dcounts[trait] for trait in traits]
+    (sampled_traits, sampled) = get_sampled_array_counts(ssize_list, np.arange(len(traits)), counts, replace=replace)
+    sampled_traits = [traits[i] for i in sampled_traits]
 
+    result = dict()
+    for ssize, count_list in zip(ssize_list, sampled.tolist()):
+        result[ssize] = dict(zip(sampled_traits, count_list))
 
+    #log.debug("result from sampled dict: %s", result)
+    return result
@@ -6,6 +6,7 @@ setup(name="pytransmission",
                 'pytransmission.popgen',
                 'pytransmission.aggregation',
                 'pytransmission.utils',
+                'pytransmission.temporalnetwork',
 ],
       author='Mark E. Madsen',
       author_email='mark@pytransmission.org',
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Copyright (c) 2013.  Mark E. Madsen <mark@pytransmission.org>
+#
+# This work is licensed under the terms of the Apache Software License, Version 2.0.  See the file LICENSE for details.
+
+"""
+Description here
+
+"""
+
+import logging as log
+import unittest
+import random
+import numpy as np
+import pytransmission.popgen.crp as crp
+
+log.basicConfig(level=log.DEBUG, format='%(asctime)s %(levelname)s: %(message)s')
+
+
+def expected_k(n, theta):
+    return sum([float(theta) / (theta + i) for i in xrange(0, n)])
+
+
+class CRPTest(unittest.TestCase):
+
+    def test_membership_lengths(self):
+        np.random.seed(1001)
+        random.seed(1001)
+        loop = crp.simulate_crp_memberships(500, 3.0)
+        vec = crp.simulate_crp_memberships_vectorized(500, 3.0)
+        self.assertEqual(len(loop), 500)
+        self.assertEqual(len(vec), 500)
+
+
+    def test_vectorized_tables_numbered_in_order(self):
+        np.random.seed(1002)
+        vec = crp.simulate_crp_memberships_vectorized(2000, 5.0)
+        self.assertEqual(vec[0], 1)
+        # each new table is exactly one more than the largest table seen so far
+        running_max = np.maximum.accumulate(vec)
+        self.assertTrue(np.all(np.diff(running_max) <= 1))
+        self.assertEqual(set(vec.tolist()), set(range(1, running_max[-1] + 1)))
+
+
+    def test_vectorized_matches_loop_distribution(self):
+        np.random.seed(1003)
+        random.seed(1003)
+        n = 200
+        theta = 2.0
+        reps = 300
+        loop_k = [max(crp.simulate_crp_memberships(n, theta)) for i in xrange(0, reps)]
+        vec_k = [crp.simulate_crp_memberships_vectorized(n, theta).max() for i in xrange(0, reps)]
+        exp_k = expected_k(n, theta)
+        log.debug("expected K: %s loop mean: %s vectorized mean: %s", exp_k, np.mean(loop_k), np.mean(vec_k))
+        self.assertAlmostEqual(np.mean(loop_k), exp_k, delta=0.75)
+        self.assertAlmostEqual(np.mean(vec_k), exp_k, delta=0.75)
+
+
+    def test_unlabeled_counts(self):
+        np.random.seed(1004)
+        counts = crp.get_crp_unlabeled_counts(1000, 4.0)
+        self.assertEqual(sum(counts), 1000)
+        self.assertEqual(counts, sorted(counts, reverse=True))
+
+
+    def test_ewens_batch_shape_and_totals(self):
+        np.random.seed(1005)
+        counts = crp.sample_ewens_partition_counts_batch(10000, 3.0, 50)
+        self.assertEqual(counts.shape[0], 50)
+        self.assertTrue(np.all(counts.sum(axis=1) == 10000))
+        # rows are sorted and zero padding only appears at the end
+        self.assertTrue(np.all(np.diff(counts, axis=1) <= 0))
+
+
+    def test_ewens_counts_match_expected_k(self):
+        np.random.seed(1006)
+        n = 200
+        theta = 2.0
+        counts = crp.sample_ewens_partition_counts_batch(n, theta, 2000)
+        mean_k = (counts > 0).sum(axis=1).mean()
+        log.debug("expected K: %s direct sampler mean: %s", expected_k(n, theta), mean_k)
+        self.assertAlmostEqual(mean_k, expected_k(n, theta), delta=0.25)
+
+
+    def test_ewens_zero_replicates(self):
+        counts = crp.sample_ewens_partition_counts_batch(100, 3.0, 0)
+        self.assertEqual(counts.shape, (0, 1))
+        self.assertRaises(UserWarning, crp.sample_ewens_partition_counts_batch, 100, 3.0, -1)
+
+    def test_ewens_zero_theta(self):
+        self.assertEqual(crp.sample_ewens_partition_counts(100, 0.0), [100])
+
+
+    def test_batch_reproducible_across_workers(self):
+        serial = crp.simulate_crp_memberships_batch(1000, 2.0, 6, seed=42)
+        pooled = crp.simulate_crp_memberships_batch(1000, 2.0, 6, seed=42, processes=3)
+        self.assertEqual(len(serial), 6)
+        for s, p in zip(serial, pooled):
+            self.assertTrue(np.array_equal(s, p))
+        # replicates draw from distinct streams
+        self.assertFalse(np.array_equal(serial[0], serial[1]))
+
+
+    def test_batch_seed_changes_results(self):
+        first = crp.simulate_crp_memberships_batch(1000, 2.0, 2, seed=1)
+        second = crp.simulate_crp_memberships_batch(1000, 2.0, 2, seed=2)
+        self.assertFalse(np.array_equal(first[0], second[0]))
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# Copyright (c) 2013.  Mark E. Madsen <mark@pytransmission.org>
+#
+# This work is licensed under the terms of the Apache Software License, Version 2.0.  See the file LICENSE for details.
+
+"""
+Description here
+
+"""
+
+import logging as log
+import unittest
+import os
+import math
+import tempfile
+from collections import Counter
+import numpy as np
+import pytransmission.popgen.ewens as ewens
+import pytransmission.popgen.crp as crp
+import pytransmission.popgen.moran as m
+
+log.basicConfig(level=log.DEBUG, format='%(asctime)s %(levelname)s: %(message)s')
+
+
+class EwensTheoryTest(unittest.TestCase):
+
+    def test_moments_match_sums(self):
+        for theta in [0.5, 2.0, 10.0]:
+            for n in [1, 2, 30, 200]:
+                e_k = sum(theta / (theta + i) for i in range(0, n))
+                v_k = sum(theta * i / (theta + i) ** 2 for i in range(1, n))
+                self.assertAlmostEqual(ewens.expected_num_alleles(theta, n), e_k, places=8)
+                self.assertAlmostEqual(ewens.variance_num_alleles(theta, n), v_k, places=8)
+
+    def test_moments_relate_to_moran(self):
+        for theta in [0.5, 4.0]:
+            for n in [3, 50]:
+                (e_k, v_k) = m.moran_expected_traits_at_locus(theta, n)
+                self.assertAlmostEqual(ewens.expected_num_alleles(theta, n) - e_k, theta / (theta + n - 1), places=8)
+                self.assertAlmostEqual(ewens.variance_num_alleles(theta, n) - v_k,
+                                       theta * (n - 1) / (theta + n - 1) ** 2, places=8)
+
+    def test_moments_are_memoized(self):
+        ewens.expected_num_alleles.cache_clear()
+        ewens.expected_num_alleles(5.0, 100)
+        ewens.expected_num_alleles(5.0, 100)
+        info = ewens.expected_num_alleles.cache_info()
+        self.assertEqual(info['hits'], 1)
+        self.assertEqual(info['misses'], 1)
+
+    def test_esf_sums_to_one(self):
+        # enumerate all partitions of a small sample size
+        def partitions(n, largest):
+            if n == 0:
+                yield []
+                return
+            for part in range(min(n, largest), 0, -1):
+                for rest in partitions(n - part, part):
+                    yield [part] + rest
+
+        theta = 1.7
+        total = sum(math.exp(ewens.ewens_sampling_formula_logprob(p, theta)) for p in partitions(8, 8))
+        self.assertAlmostEqual(total, 1.0, places=10)
+        self.assertEqual(ewens.ewens_sampling_formula_logprob([3, 1, 4], theta),
+                         ewens.ewens_sampling_formula_logprob([4, 3, 1], theta))
+        # zero counts (e.g., rows of a count matrix) are ignored
+        self.assertEqual(ewens.ewens_sampling_formula_logprob([47, 2, 1, 0, 0], 2.0),
+                         ewens.ewens_sampling_formula_logprob([47, 2, 1], 2.0))
+        self.assertEqual(ewens.ewens_sampling_formula_logprob(np.array([0, 1, 47, 2]), 2.0),
+                         ewens.ewens_sampling_formula_logprob([47, 2, 1], 2.0))
+
+    def test_stirling_table(self):
+        table = np.exp(ewens.log_stirling_first_kind(6))
+        self.assertTrue(np.allclose(table[4, :5], [0, 6, 11, 6, 1]))
+        self.assertTrue(np.allclose(table[6, :7], [0, 120, 274, 225, 85, 15, 1]))
+        self.assertEqual(table[3, 5], 0.0)
+
+    def test_num_alleles_distribution(self):
+        theory = ewens.EwensTheoryTable(300)
+        dist = theory.num_alleles_distribution(300, 4.0)
+        self.assertAlmostEqual(dist.sum(), 1.0, places=10)
+        mean = (np.arange(0, 301) * dist).sum()
+        self.assertAlmostEqual(mean, ewens.expected_num_alleles(4.0, 300), places=8)
+
+        # compare against simulated partitions
+        counts = crp.sample_ewens_partition_counts_batch(300, 4.0, 2000, prng=np.random.RandomState(11))
+        k = (counts > 0).sum(axis=1)
+        self.assertAlmostEqual(k.mean(), mean, delta=0.3)
+
+        self.assertRaises(ValueError, theory.log_prob_num_alleles, 5, 301, 4.0)
+
+    def test_save_and_load(self):
+        theory = ewens.EwensTheoryTable(50)
+        (handle, path) = tempfile.mkstemp(suffix=".npy")
+        os.close(handle)
+        try:
+            theory.save(path)
+            loaded = ewens.EwensTheoryTable.load(path)
+            self.assertEqual(loaded.nmax, 50)
+            self.assertTrue(np.allclose(loaded.num_alleles_distribution(40, 2.5),
+                                        theory.num_alleles_distribution(40, 2.5)))
+            del loaded
+        finally:
+            os.remove(path)
+
+
+class EwensEstimationTest(unittest.TestCase):
+
+    def test_estimate_theta_inverts_expectation(self):
+        thetas = np.array([0.3, 1.0, 5.0, 40.0])
+        for n in [20, 500]:
+            expected = np.array([ewens.expected_num_alleles(t, n) for t in thetas])
+            estimates = ewens.estimate_theta(expected, n)
+            self.assertTrue(np.allclose(estimates, thetas, rtol=1e-6))
+
+        self.assertEqual(ewens.estimate_theta(1, 50), 0.0)
+        self.assertEqual(ewens.estimate_theta(50, 50), np.inf)
+        self.assertRaises(ValueError, ewens.estimate_theta, 51, 50)
+
+    def test_estimate_from_counts(self):
+        samples = [Counter({'a': 5, 'b': 3, 'c': 2}), [6, 2, 1, 1], np.array([10])]
+        estimates = ewens.estimate_theta_from_counts(samples)
+        self.assertEqual(len(estimates), 3)
+        self.assertAlmostEqual(estimates[0], ewens.estimate_theta(3, 10))
+        self.assertAlmostEqual(estimates[1], ewens.estimate_theta(4, 10))
+        self.assertEqual(estimates[2], 0.0)
+
+        batch = crp.sample_ewens_partition_counts_batch(200, 6.0, 3000, prng=np.random.RandomState(5))
+        estimates = ewens.estimate_theta_from_counts(batch)
+        self.assertAlmostEqual(np.median(estimates), 6.0, delta=0.75)
+
+    def test_conditional_logprob(self):
+        # exact ESF probabilities, up to the terms depending only on n, K and theta
+        matrix = ewens.count_matrix([[4, 3, 1], [3, 3, 2], [6, 1, 1]])
+        theta = 2.0
+        direct = np.array([ewens.ewens_sampling_formula_logprob(row, theta) for row in matrix])
+        conditional = ewens.conditional_logprob(matrix)
+        self.assertTrue(np.allclose(direct - conditional, direct[0] - conditional[0]))
+
+    def test_slatkin_exact_test(self):
+        prng = np.random.RandomState(17)
+        neutral = crp.sample_ewens_partition_counts_batch(100, 3.0, 200, prng=prng)
+        (p_slatkin, p_watterson) = ewens.slatkin_exact_test(neutral, replicates=500, prng=prng)
+        self.assertEqual(len(p_slatkin), 200)
+        self.assertTrue(np.all((p_slatkin >= 0.0) & (p_slatkin <= 1.0)))
+        # p-values are roughly uniform under the null
+        self.assertTrue(0.3 < p_slatkin.mean() < 0.7)
+        self.assertTrue(0.3 < p_watterson.mean() < 0.7)
+
+        # a very even sample is much less probable than neutral samples with the same n and K
+        (p_even, p_even_f) = ewens.slatkin_exact_test([[10] * 10], replicates=500, prng=prng)
+        self.assertLess(p_even[0], 0.05)
+        self.assertGreater(p_even_f[0], 0.95)
+
+        (p_single, p_single_f) = ewens.slatkin_exact_test([[100]], replicates=10, prng=prng)
+        self.assertEqual(p_single[0], 1.0)
+
+    def test_slatkin_exact_test_few_replicates(self):
+        # with few replicates, whole batches of draws can have fewer traits than the sample
+        for seed in range(0, 40):
+            (p_slatkin, p_watterson) = ewens.slatkin_exact_test([[20, 10, 5, 3, 2, 1, 1, 1, 1, 1]], replicates=2,
+                                                                prng=np.random.RandomState(seed))
+            self.assertTrue(0.0 <= p_slatkin[0] <= 1.0)
+            self.assertTrue(0.0 <= p_watterson[0] <= 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -11,6 +11,8 @@ Description here
 import logging as log
 import unittest
 import pytransmission.popgen.moran as m
+import pytransmission.aggregation as agg
+import numpy as np
 import os
 import tempfile
 
@@ -49,6 +51,79 @@ class MoranModelTest(unittest.TestCase):
         self.assertTrue(True, "Not a full test, always passes")
 
 
+    def test_expected_k_memoized_call_forms(self):
+        expected = m.moran_expected_traits_at_locus(2.0, 10)
+        self.assertEqual(expected, m.moran_expected_traits_at_locus(theta=2.0, ssize=10))
+        self.assertEqual(expected, m.moran_expected_traits_at_locus(2.0, ssize=10))
+        # 0-d arrays are unhashable, and bypass the cache
+        (e_k, v_k) = m.moran_expected_traits_at_locus(np.array(2.0), np.array(10))
+        self.assertAlmostEqual(e_k, expected[0], places=10)
+        self.assertAlmostEqual(v_k, expected[1], places=10)
+
+
+    def test_expected_k_vectorized(self):
+        theta = np.array([0.25, 0.5, 1.0, 2.0, 3.0, 10.0, 57.5])
+        ssize = np.array([1, 2, 3, 10, 50, 1000])
+        (e_k, v_k) = m.moran_expected_traits_at_locus_vectorized(theta[:, np.newaxis], ssize[np.newaxis, :])
+        self.assertEqual(e_k.shape, (len(theta), len(ssize)))
+
+        for i, t in enumerate(theta):
+            for j, n in enumerate(ssize):
+                (loop_e, loop_v) = m.moran_expected_traits_at_locus(t, n)
+                self.assertAlmostEqual(loop_e, e_k[i, j], places=8)
+                self.assertAlmostEqual(loop_v, v_k[i, j], places=8)
+
+
+    def test_moran_ia_simulation(self):
+        popsize = 50
+        mutation = m.moran_mutation_rate_from_theta(popsize, 2.0)
+        per_tick = agg.MoranCumulativeTimeAverager(1000, [1, 5, 10], popsize, 2, ending_interval=True)
+        per_span = agg.MoranCumulativeTimeAverager(1000, [1, 5, 10], popsize, 2, ending_interval=True)
+
+        # the hooks draw no random numbers, so two simulators with the same seed follow the same path
+        sims = []
+        for tatrack in [per_tick, per_span]:
+            sim = m.MoranInfiniteAlleles(popsize, mutation, numloci=2, initial_alleles=2,
+                                         prng=np.random.RandomState(4001))
+            sim.run(1000, burn_in=False)
+            sims.append(sim)
+        sims[0].run(600, callback=per_tick.record_trait_count_sample, burn_in=False)
+        sims[1].run(600, span_callback=per_span.record_trait_count_span, burn_in=False)
+
+        self.assertEqual(sims[0].tick, 1600)
+        self.assertEqual(sims[0].get_countmap(), sims[1].get_countmap())
+        for locus in range(0, 2):
+            (traits, counts) = sims[0].get_trait_counts(locus)
+            self.assertEqual(counts.sum(), popsize)
+            self.assertTrue((counts > 0).all())
+
+        self.assertEqual(per_tick.get_counts_for_generation_intervals(), per_span.get_counts_for_generation_intervals())
+        self.assertEqual(sum(per_tick.get_counts_for_interval_generations(10)[1].values()), 500 * popsize)
+
+
+    def test_moran_ia_allele_storage(self):
+        # many mutations force the allele arrays to grow and be compacted; the tree must track the counts
+        popsize = 200
+        sim = m.MoranInfiniteAlleles(popsize, m.moran_mutation_rate_from_theta(popsize, 40.0), numloci=2,
+                                     prng=np.random.RandomState(4002))
+        for chunk in range(0, 10):
+            sim.run(2000, burn_in=False)
+            for locus in range(0, 2):
+                size = sim.sizes[locus]
+                counts = sim.counts[locus]
+                self.assertTrue(np.all(counts[size:] == 0))
+                self.assertEqual(sim.extinct[locus], int((counts[:size] == 0).sum()))
+                self.assertEqual(sim.sum_squares[locus], int((counts ** 2).sum()))
+                tree = sim.trees[locus]
+                for i in range(1, len(tree)):
+                    self.assertEqual(tree[i], counts[i - (i & -i):i].sum())
+                (traits, present) = sim.get_trait_counts(locus)
+                self.assertEqual(present.sum(), popsize)
+                self.assertEqual(len(set(traits.tolist())), len(traits))
+        # the arrays grew, but extinct alleles were dropped rather than kept
+        self.assertGreater(len(sim.counts[0]), 16)
+        self.assertLess(len(sim.counts[0]), sim.next_trait_id // 4)
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
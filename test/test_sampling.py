@@ -12,6 +12,7 @@ import unittest
 from collections import Counter
 import pytransmission.utils as utils
 import itertools
+import numpy as np
 
 import os
 import tempfile
@@ -83,6 +84,54 @@ class SamplingTest(unittest.TestCase):
 
         self.assertTrue(success)
 
+    def test_counter_sampling_nested(self):
+        test_counter = Counter({'a': 300000, 'b': 200000, 'c': 400000, 'd': 7})
+        sample_sizes = [10, 500, 50]
+        sampled = utils.get_sampled_counter(sample_sizes, test_counter)
+        for ssize in sample_sizes:
+            self.assertEqual(sum(sampled[ssize].values()), ssize)
+        # smaller samples are subsamples of the larger ones
+        for small, large in [(10, 50), (50, 500)]:
+            for trait, count in sampled[small].items():
+                self.assertTrue(count <= sampled[large][trait])
+
+
+    def test_multivariate_hypergeometric(self):
+        counts = [5, 0, 10, 3]
+        draws = utils.multivariate_hypergeometric(counts, [0, 1, 9, 18])
+        self.assertEqual(draws.shape, (4, 4))
+        self.assertEqual(draws.sum(axis=1).tolist(), [0, 1, 9, 18])
+        self.assertEqual(draws[3].tolist(), counts)
+        self.assertTrue((draws[:, 1] == 0).all())
+        self.assertTrue((draws <= counts).all())
+
+
+    def test_array_count_sampling(self):
+        traits = np.array([1001, 1002, 1003, 1004])
+        counts = np.array([200, 0, 200, 400])
+        (sampled_traits, sampled) = utils.get_sampled_array_counts([20, 100, 5], traits, counts)
+        self.assertEqual(sampled_traits.tolist(), [1001, 1003, 1004])
+        self.assertEqual(sampled.shape, (3, 3))
+        self.assertEqual(sampled.sum(axis=1).tolist(), [20, 100, 5])
+
+
+    def test_array_count_sampling_without_replacement(self):
+        traits = np.array([1001, 1002, 1003])
+        counts = np.array([2, 3, 5])
+        (sampled_traits, sampled) = utils.get_sampled_array_counts([10, 4], traits, counts, replace=False, replicates=25)
+        self.assertEqual(sampled.shape, (25, 2, 3))
+        self.assertEqual(sampled.sum(axis=2).tolist(), [[10, 4]] * 25)
+        # the full-population sample must reproduce the population exactly
+        self.assertTrue((sampled[:, 0, :] == counts).all())
+        self.assertTrue((sampled[:, 1, :] <= counts).all())
+
+
+    def test_dict_count_sampling_without_replacement(self):
+        test_dict = {'trait1': 1, 'trait2': 0, 'trait3': 2}
+        sampled = utils.get_sampled_dict_counts([3], test_dict, replace=False)
+        self.assertEqual(sampled[3], {'trait1': 1, 'trait3': 2})
+
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -13,8 +13,10 @@ import unittest
 import pytransmission.temporalnetwork as tn
 import numpy as np
 import networkx as nx
+import scipy.sparse as sp
 import os
 import tempfile
+import shutil
 
 log.basicConfig(level=log.DEBUG, format='%(asctime)s %(levelname)s: %(message)s')
 
@@ -36,15 +38,221 @@ class TemporalNetworkTest(unittest.TestCase):
         times = ns.get_list_of_change_times()
 
 
-        ns.get_graph_matrix_for_time(8)
-        ns.get_graph_matrix_for_time(12)
-        ns.get_graph_matrix_for_time(0)
-        ns.get_graph_matrix_for_time(50)
+        self.assertEqual(times, [0, 3, 5, 10, 25])
+
+        self.assertEqual(ns.get_snapshot_time_for_time(8), 5)
+        self.assertEqual(ns.get_snapshot_time_for_time(12), 10)
+        self.assertEqual(ns.get_snapshot_time_for_time(0), 0)
+        self.assertEqual(ns.get_snapshot_time_for_time(50), 25)
+        self.assertEqual(ns.get_snapshot_time_for_time(1), 0)
+        self.assertEqual(ns.get_snapshot_time_for_time(5), 5)
+        self.assertRaises(ValueError, ns.get_snapshot_time_for_time, -1)
+
+        self.assertEqual(ns.get_graph_matrix_for_time(8).number_of_nodes(), 4)
+
+        # replacing a snapshot does not duplicate its change time
+        ns.add_network(5, g)
+        self.assertEqual(ns.get_list_of_change_times(), [0, 3, 5, 10, 25])
+
+    def test_bulk_load_and_cursor(self):
+        graphs = dict((t, nx.path_graph(t % 7 + 2)) for t in range(0, 1000, 3))
+        ns = tn.NetworkSequence()
+        ns.add_networks(reversed(sorted(graphs.items())))
+        self.assertEqual(ns.get_list_of_change_times(), sorted(graphs.keys()))
+
+        # monotonic queries, with jumps of varying sizes, then random access
+        queries = list(range(0, 1000)) + [500, 2, 999, 40, 40, 41, 998]
+        for time in queries:
+            expected = max(t for t in graphs if t <= time)
+            self.assertEqual(ns.get_snapshot_time_for_time(time), expected)
+            self.assertEqual(ns.get_graph_matrix_for_time(time).number_of_nodes(), expected % 7 + 2)
+
+        matrices = tn.NetworkSequence()
+        matrices.add_networks({0: np.ones((3, 3)), 10: np.zeros((5, 5))})
+        self.assertEqual(matrices.get_graph_matrix_for_time(12).number_of_nodes(), 5)
+
+
+    def test_sparse_snapshot_store(self):
+        prng = np.random.RandomState(3)
+        store = tn.SparseSnapshotStore(keyframe_interval=4)
+        n = 50
+        current = sp.random(n, n, density=0.05, random_state=prng, format='lil')
+        snapshots = []
+        for step in range(0, 23):
+            # add, remove and reweight a few edges at each step
+            for i in range(0, 5):
+                current[prng.randint(n), prng.randint(n)] = prng.randint(1, 4)
+            for (r, c) in zip(*current.nonzero())[:3]:
+                current[r, c] = 0
+            vertices = sorted(prng.choice(n, 40, replace=False))
+            snapshots.append((current.tocsr().copy(), vertices))
+            store.append(snapshots[-1][0], vertices)
+
+        self.assertEqual(len(store), 23)
+        self.assertEqual(len(store.keyframes), 6)
+        for index in [0, 3, 4, 9, 22, 17]:
+            (expected, vertices) = snapshots[index]
+            rebuilt = store.get_matrix(index, n)
+            self.assertEqual(abs(rebuilt - expected).sum(), 0)
+            self.assertEqual(store.get_snapshot(index)[2].tolist(), vertices)
+            if index > 0:
+                previous = set(snapshots[index - 1][1])
+                self.assertEqual(set(store.get_added_vertices(index).tolist()), set(vertices) - previous)
+                self.assertEqual(set(store.get_removed_vertices(index).tolist()), previous - set(vertices))
+
+        store.truncate(9)
+        self.assertEqual(len(store), 9)
+        self.assertEqual(len(store.keyframes), 3)
+        store.append(snapshots[22][0], snapshots[22][1])
+        self.assertEqual(abs(store.get_matrix(9, n) - snapshots[22][0]).sum(), 0)
+
+    def test_vertex_changes(self):
+        ns = tn.NetworkSequence(keyframe_interval=2)
+        g0 = nx.Graph([('a', 'b'), ('b', 'c')])
+        g1 = nx.Graph([('a', 'b'), ('b', 'd')])
+        g2 = nx.Graph([('a', 'b'), ('b', 'd'), ('d', 'e')])
+        g2.add_edge('a', 'b', weight=5)
+        ns.add_network(0, g0)
+        ns.add_network(20, g2)
+        ns.add_network(10, g1)
+
+        self.assertEqual(sorted(ns.get_new_vertices_for_time(0)), ['a', 'b', 'c'])
+        self.assertEqual(ns.get_new_vertices_for_time(12), ['d'])
+        self.assertEqual(ns.get_removed_vertices_for_time(12), ['c'])
+        self.assertEqual(ns.get_new_vertices_for_time(25), ['e'])
+        self.assertEqual(ns.get_removed_vertices_for_time(25), [])
+
+        graph = ns.get_graph_matrix_for_time(21)
+        self.assertEqual(sorted(graph.edges()), sorted(g2.edges()))
+        self.assertEqual(graph['a']['b']['weight'], 5)
+        self.assertEqual(sorted(ns.get_graph_matrix_for_time(15).edges()), sorted(g1.edges()))
+        self.assertEqual(ns.get_matrix_for_time(5).nnz, 4)
+
+
+    def test_graph_cache(self):
+        ns = tn.NetworkSequence(cache_size=2)
+        ns.add_networks((t, nx.path_graph(t + 2)) for t in range(0, 4))
+
+        first = ns.get_graph_matrix_for_time(0)
+        self.assertTrue(ns.get_graph_matrix_for_time(0) is first)
         ns.get_graph_matrix_for_time(1)
+        ns.get_graph_matrix_for_time(2)
+        # time 0 was least recently used, and was evicted
+        self.assertEqual(list(ns.time_to_graph.keys()), [1, 2])
+        self.assertFalse(ns.get_graph_matrix_for_time(0) is first)
+        info = ns.get_cache_info()
+        self.assertEqual(info['hits'], 1)
+        self.assertEqual(info['misses'], 4)
+        self.assertEqual(info['currsize'], 2)
+
+        # edge budget:  graphs with 3 and 4 edges exceed a budget of 6
+        budget = tn.NetworkSequence(cache_size=10, cache_edges=6)
+        budget.add_networks((t, nx.path_graph(t + 2)) for t in range(0, 4))
+        budget.get_graph_matrix_for_time(2)
+        budget.get_graph_matrix_for_time(3)
+        self.assertEqual(list(budget.time_to_graph.keys()), [3])
+
+        # adding a snapshot invalidates the cache
+        ns.add_network(10, nx.path_graph(3))
+        self.assertEqual(ns.get_cache_info()['currsize'], 0)
+
+    def test_prefetch(self):
+        ns = tn.NetworkSequence(cache_size=4, prefetch=True)
+        ns.add_networks((t * 10, nx.path_graph(t + 2)) for t in range(0, 20))
+        for time in range(0, 200):
+            graph = ns.get_graph_matrix_for_time(time)
+            self.assertEqual(graph.number_of_nodes(), time // 10 + 2)
+        info = ns.get_cache_info()
+        # only the first snapshot must be built in the foreground
+        self.assertEqual(info['hits'] + info['misses'], 200)
+        self.assertTrue(info['misses'] < 20)
+
+
+    def test_save_and_load(self):
+        prng = np.random.RandomState(9)
+        ns = tn.NetworkSequence(keyframe_interval=3)
+        graph = nx.gnm_random_graph(30, 60, seed=1)
+        for t in range(0, 10):
+            graph = graph.copy()
+            graph.remove_edges_from(list(graph.edges())[:2])
+            graph.add_edge(prng.randint(40), prng.randint(40), weight=t + 1)
+            ns.add_network(t * 5, graph)
+
+        path = tempfile.mkdtemp()
+        try:
+            ns.save(path)
+            loaded = tn.NetworkSequence.load(path)
+            self.assertEqual(loaded.get_list_of_change_times(), ns.get_list_of_change_times())
+            self.assertTrue(isinstance(loaded.store.keyframes[0][0], np.memmap))
+            for time in [0, 7, 23, 49]:
+                self.assertEqual(abs(loaded.get_matrix_for_time(time) - ns.get_matrix_for_time(time)).sum(), 0)
+                self.assertEqual(sorted(loaded.get_graph_matrix_for_time(time).edges(data=True)),
+                                 sorted(ns.get_graph_matrix_for_time(time).edges(data=True)))
+                self.assertEqual(loaded.get_new_vertices_for_time(time), ns.get_new_vertices_for_time(time))
 
+            # an opened sequence can still be extended
+            loaded.add_network(50, nx.path_graph(45))
+            self.assertEqual(loaded.get_graph_matrix_for_time(52).number_of_edges(), 44)
+            self.assertEqual(sorted(loaded.get_graph_matrix_for_time(12).edges()),
+                             sorted(ns.get_graph_matrix_for_time(12).edges()))
+            del loaded
+        finally:
+            shutil.rmtree(path)
 
-        self.assertTrue(True)
 
+    def test_neighbor_sampling(self):
+        prng = np.random.RandomState(21)
+        # star graph:  the hub 0 is connected to every leaf, and vertex 5 is isolated
+        graph = nx.star_graph(4)
+        graph.add_node(5)
+        adjacency = nx.to_scipy_sparse_matrix(graph, nodelist=range(0, 6), format='csr')
+
+        draws = np.array([tn.sample_neighbors(adjacency, prng=prng) for i in range(0, 2000)])
+        self.assertTrue(np.all(draws[:, 1:5] == 0))
+        self.assertTrue(np.all(draws[:, 5] == -1))
+        hub_counts = np.bincount(draws[:, 0], minlength=5)
+        self.assertEqual(hub_counts[0], 0)
+        self.assertTrue(np.all(np.abs(hub_counts[1:] - 500) < 80))
+
+        # weighted choice in proportion to edge weights, with a zero weight never chosen
+        weighted = sp.csr_matrix(([1.0, 3.0, 0.0, 1.0, 3.0], ([0, 0, 0, 1, 2], [1, 2, 3, 0, 0])), shape=(4, 4))
+        choices = tn.sample_neighbors(weighted, agents=np.zeros(8000, dtype=int), weighted=True, prng=prng)
+        counts = np.bincount(choices, minlength=4)
+        self.assertEqual(counts[3], 0)
+        self.assertAlmostEqual(counts[2] / 8000.0, 0.75, delta=0.03)
+
+        # a mix of rows, including one without edges, only gathers the weights of the chosen rows
+        agents = np.tile([2, 3, 0, 1], 4000)
+        choices = tn.sample_neighbors(weighted, agents=agents, weighted=True, prng=prng)
+        self.assertTrue(np.all(choices[agents == 1] == 0))
+        self.assertTrue(np.all(choices[agents == 2] == 0))
+        self.assertTrue(np.all(choices[agents == 3] == -1))
+        self.assertAlmostEqual(np.mean(choices[agents == 0] == 2), 0.75, delta=0.03)
+        self.assertEqual(tn.sample_neighbors(weighted, agents=[3], weighted=True, prng=prng).tolist(), [-1])
+
+        traits = np.array([10, 11, 12, 13, 14, 15])
+        copied = tn.copy_neighbor_traits(adjacency, traits, prng=prng)
+        self.assertEqual(copied[1:5].tolist(), [10] * 4)
+        self.assertEqual(copied[5], 15)
+        self.assertTrue(copied[0] in [11, 12, 13, 14])
+
+        # Moran-style update of a single agent, with several loci
+        multilocus = np.column_stack((traits, traits + 100))
+        copied = tn.copy_neighbor_traits(adjacency, multilocus, agents=[3], prng=prng)
+        self.assertEqual(copied[3].tolist(), [10, 110])
+        self.assertEqual(copied[np.arange(6) != 3].tolist(), multilocus[np.arange(6) != 3].tolist())
+
+    def test_copying_over_sequence(self):
+        ns = tn.NetworkSequence()
+        ns.add_network(0, nx.path_graph(100))
+        ns.add_network(50, nx.cycle_graph(100))
+        traits = np.arange(100)
+        prng = np.random.RandomState(4)
+        for time in range(0, 100):
+            adjacency = ns.get_matrix_for_time(time)
+            traits = tn.copy_neighbor_traits(adjacency, traits, prng=prng)
+        self.assertTrue(ns.get_matrix_for_time(99) is adjacency)
+        self.assertTrue(len(np.unique(traits)) < 100)
 
 
 
@@ -12,8 +12,11 @@ import logging as log
 import unittest
 import pytransmission.popgen.moran as m
 import pytransmission.aggregation as agg
+import random
+from collections import Counter
 import os
 import tempfile
+import numpy as np
 
 log.basicConfig(level=log.DEBUG, format='%(asctime)s %(levelname)s: %(message)s')
 
@@ -104,6 +107,319 @@ class MoranTimeAveragingTest(unittest.TestCase):
 
 
 
+    def test_active_intervals_match_tuples(self):
+        log.info("test_active_intervals_match_tuples")
+        popsize = 10
+        intervals = [1, 5, 10, 20]
+        for ending in [True, False]:
+            tatrack = agg.MoranCumulativeTimeAverager(1000, intervals, popsize, 1, ending_interval=ending)
+            for timestep in range(750, 1250):
+                expected = sorted([interval for interval, tup in tatrack.interval_tuple_map.items()
+                                   if tup[0] <= timestep < tup[1]])
+                self.assertEqual(expected, tatrack._active_intervals(timestep))
+
+
+    def _record_random_ticks(self, trackers, seed):
+        random.seed(seed)
+        for timestep in range(750, 1250):
+            countmap = dict()
+            countmap[0] = {random.randint(1, 20): random.randint(1, 5), random.randint(1, 20): 1}
+            countmap[1] = {random.randint(1, 20): random.randint(1, 5)}
+            configs = {(countmap[0].keys()[0], countmap[1].keys()[0]): 1}
+            for tatrack in trackers:
+                tatrack.record_trait_count_sample(timestep, countmap, configs)
+
+
+    def test_segmented_matches_direct(self):
+        log.info("test_segmented_matches_direct")
+        popsize = 10
+        intervals = [1, 5, 10, 20]
+        for ending in [True, False]:
+            direct = agg.MoranCumulativeTimeAverager(1000, intervals, popsize, 2, ending_interval=ending)
+            segmented = agg.MoranCumulativeTimeAverager(1000, intervals, popsize, 2, ending_interval=ending, segmented=True)
+            self._record_random_ticks([direct, segmented], 2001)
+
+            self.assertEqual(direct.get_counts_for_generation_intervals(), segmented.get_counts_for_generation_intervals())
+            self.assertEqual(direct.get_configuration_counts_for_generation_intervals(),
+                             segmented.get_configuration_counts_for_generation_intervals())
+
+
+    def test_dense_matches_counters(self):
+        log.info("test_dense_matches_counters")
+        popsize = 10
+        intervals = [1, 5, 10, 20]
+        for ending in [True, False]:
+            direct = agg.MoranCumulativeTimeAverager(1000, intervals, popsize, 2, ending_interval=ending)
+            dense = agg.MoranCumulativeTimeAverager(1000, intervals, popsize, 2, ending_interval=ending, dense=True)
+            dense_seg = agg.MoranCumulativeTimeAverager(1000, intervals, popsize, 2, ending_interval=ending,
+                                                         segmented=True, dense=True)
+            self._record_random_ticks([direct, dense, dense_seg], 2002)
+
+            expected = direct.get_counts_for_generation_intervals()
+            self.assertEqual(expected, dense.get_counts_for_generation_intervals())
+            self.assertEqual(expected, dense_seg.get_counts_for_generation_intervals())
+            expected_configs = direct.get_configuration_counts_for_generation_intervals()
+            self.assertEqual(expected_configs, dense.get_configuration_counts_for_generation_intervals())
+            self.assertEqual(expected_configs, dense_seg.get_configuration_counts_for_generation_intervals())
+
+
+    def test_dense_trait_counts_growth(self):
+        log.info("test_dense_trait_counts_growth")
+        dense = agg.DenseTraitCounts(2, 1, capacity=2)
+        dense.add_counts(slice(0, None), 0, {'a': 1, 'b': 2, 'c': 3})
+        dense.add(1, 0, ['c', 'd', 'd'], [1, 1, 1])
+        self.assertEqual(dense.get_counter(0, 0), {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(dense.get_counter(1, 0), {'a': 1, 'b': 2, 'c': 4, 'd': 2})
+
+    def test_dense_integer_label_lookup(self):
+        log.info("test_dense_integer_label_lookup")
+        dense = agg.DenseTraitCounts(1, 1, capacity=2)
+        expected = Counter()
+        prng = np.random.RandomState(8)
+        for tick in range(0, 50):
+            labels = prng.randint(0, 10 ** 9, 30).tolist() + [5, 17, 3]
+            labels = list(set(labels))
+            counts = prng.randint(1, 10, len(labels)).tolist()
+            dense.add_counts(0, 0, dict(zip(labels, counts)))
+            expected.update(dict(zip(labels, counts)))
+        # string labels at the same locus go through the dict index
+        dense.add_counts(0, 0, {'x': 3, 5: 1})
+        expected.update({'x': 3, 5: 1})
+        self.assertEqual(dense.get_counter(0, 0), expected)
+        self.assertEqual(len(dense.get_trait_labels(0)), len(expected))
+
+
+
+    def test_count_views_are_snapshots(self):
+        log.info("test_count_views_are_snapshots")
+        for segmented in [False, True]:
+            tatrack = agg.MoranCumulativeTimeAverager(10000, [10, 50], 100, 1, ending_interval=True, segmented=segmented)
+            tatrack.record_trait_count_sample(10025, {0: {1001: 5, 1002: 15}}, {})
+            view = tatrack.get_counts_for_interval_generations(50)
+            all_views = tatrack.get_counts_all_intervals()
+            tatrack.record_trait_count_sample(10030, {0: {1001: 1, 1003: 2}}, {})
+
+            self.assertEqual(view[0][1001], 5)
+            self.assertEqual(view[0][1003], 0)
+            self.assertEqual(all_views[5000][0][1001], 5)
+            self.assertEqual(tatrack.get_counts_for_interval_generations(50)[0][1001], 6)
+            with self.assertRaises(TypeError):
+                view[0][1001] = 10
+
+            copied = view.copy()
+            copied[0][1001] += 1
+            self.assertEqual(view[0][1001], 5)
+
+
+
+    def test_sampled_counts_for_intervals(self):
+        log.info("test_sampled_counts_for_intervals")
+        tatrack = agg.MoranCumulativeTimeAverager(10000, [10, 50], 100, 2, ending_interval=True)
+        tatrack.record_trait_count_sample(10025, {0: {1001: 5, 1002: 15}, 1: {2001: 20}}, {(1001, 2001): 5, (1002, 2001): 15})
+        tatrack.record_trait_count_sample(11005, {0: {1001: 5, 1003: 15}, 1: {2002: 20}}, {(1001, 2002): 5, (1003, 2002): 15})
+
+        sampled = tatrack.get_counts_for_generation_for_ssize_for_intervals([5, 20], replace=False)
+        self.assertEqual(sorted(sampled.keys()), [10, 50])
+        self.assertEqual(sampled[10][0][20], {1001: 5, 1002: 15})
+        self.assertEqual(sum(sampled[50][1][5].values()), 5)
+        self.assertTrue(set(sampled[50][0][20].keys()) <= set([1001, 1002, 1003]))
+
+        table = tatrack.get_counts_for_generation_for_ssize_for_intervals([5, 20], columnar=True)
+        for interval in [10, 50]:
+            for locus in [0, 1]:
+                for ssize in [5, 20]:
+                    rows = (table["interval"] == interval) & (table["locus"] == locus) & (table["ssize"] == ssize)
+                    self.assertEqual(table["count"][rows].sum(), ssize)
+
+        configs = tatrack.get_configurations_for_generation_for_ssize_for_intervals([20], replace=False)
+        self.assertEqual(configs[10][20], {(1001, 2001): 5, (1002, 2001): 15})
+        self.assertEqual(sum(configs[50][20].values()), 20)
+        config_table = tatrack.get_configurations_for_generation_for_ssize_for_intervals([10], columnar=True)
+        self.assertEqual(config_table["count"][config_table["interval"] == 50].sum(), 10)
+
+        with self.assertRaises(ValueError):
+            tatrack.get_counts_for_generation_for_ssize_for_intervals([21], replace=False)
+        # no rows at all still gives typed columns
+        empty = tatrack.get_counts_for_generation_for_ssize_for_intervals([0], columnar=True)
+        self.assertEqual(sorted(empty.keys()), ["count", "interval", "locus", "ssize", "trait"])
+        self.assertEqual(len(empty["trait"]), 0)
+        self.assertEqual(empty["count"].dtype, np.int64)
+        empty_configs = tatrack.get_configurations_for_generation_for_ssize_for_intervals([0], columnar=True)
+        self.assertEqual(len(empty_configs["configuration"]), 0)
+
+        # with replacement, a sample may be larger than the population
+        sampled = tatrack.get_counts_for_generation_for_ssize_for_intervals([100])
+        self.assertEqual(sum(sampled[10][0][100].values()), 100)
+
+
+
+    def test_sampled_columns_mixed_labels(self):
+        log.info("test_sampled_columns_mixed_labels")
+        tatrack = agg.MoranCumulativeTimeAverager(1000, [1, 5], 2, 1)
+        tatrack.record_trait_count_sample(1000, {0: {'x': 1, 7: 1}}, {('x',): 1, (7,): 1})
+        tatrack.record_trait_count_sample(1003, {0: {7: 2}}, {(7,): 2})
+        table = tatrack.get_counts_for_generation_for_ssize_for_intervals([50], columnar=True)
+        self.assertEqual(set(table["trait"].tolist()), set(['x', 7]))
+        self.assertTrue(7 in table["trait"].tolist())
+        self.assertFalse('7' in table["trait"].tolist())
+        self.assertEqual(table["count"].sum(), 100)
+
+
+
+    def test_dense_configuration_interning(self):
+        log.info("test_dense_configuration_interning")
+        configs = agg.DenseConfigurationCounts(2, capacity=1)
+        ids = configs.encode([(1, 2), (3, 4), (1, 2)])
+        self.assertEqual(ids.tolist(), [0, 1, 0])
+        self.assertEqual(configs.decode([1, 0]), [(3, 4), (1, 2)])
+        configs.add_configurations(slice(0, None), {(1, 2): 3, (5, 6): 1})
+        self.assertEqual(configs.get_configuration_counter(1), {(1, 2): 3, (5, 6): 1})
+
+
+
+    def test_rolling_windows_match_brute_force(self):
+        log.info("test_rolling_windows_match_brute_force")
+        random.seed(2003)
+        ticks = dict()
+        rolling = agg.MoranRollingTimeAverager(100, 3, 2, 5, 1)
+        for timestep in range(100, 200):
+            countmap = {0: {random.randint(1, 10): random.randint(1, 3)}}
+            configs = {(countmap[0].keys()[0],): 1}
+            ticks[timestep] = countmap
+            rolling.record_trait_count_sample(timestep, countmap, configs)
+        rolling.finalize()
+
+        windows = rolling.get_window_counts()
+        self.assertEqual([(w[0], w[1]) for w in windows], [(start, start + 15) for start in range(100, 190, 10)])
+        for (start, end, countmap, configs) in windows:
+            expected = Counter()
+            for timestep in range(start, end):
+                expected.update(ticks[timestep][0])
+            self.assertEqual(expected, countmap[0])
+            self.assertEqual(sum(configs.values()), 15)
+
+    def test_rolling_drops_incomplete_windows(self):
+        log.info("test_rolling_drops_incomplete_windows")
+        # one-generation steps over 5-tick blocks; the run ends part way through the block starting at 195
+        rolling = agg.MoranRollingTimeAverager(100, 3, 1, 5, 1)
+        for timestep in range(100, 198):
+            rolling.record_trait_count_sample(timestep, {0: {1: 1}}, {(1,): 1})
+        rolling.finalize()
+        windows = rolling.get_window_counts()
+        self.assertEqual(windows[-1][1], 195)
+        for (start, end, countmap, configs) in windows:
+            self.assertEqual(end - start, 15)
+            self.assertEqual(countmap[0][1], 15)
+
+        # a run which continues past the last recorded tick completes the block
+        rolling = agg.MoranRollingTimeAverager(100, 3, 1, 5, 1)
+        for timestep in range(100, 198):
+            rolling.record_trait_count_sample(timestep, {0: {1: 1}}, {(1,): 1})
+        rolling.finalize(end_tick=200)
+        self.assertEqual(rolling.get_window_counts()[-1][:2], (185, 200))
+
+
+
+    def test_spilled_counts_match_direct(self):
+        log.info("test_spilled_counts_match_direct")
+        popsize = 10
+        intervals = [1, 5, 10, 20]
+        spill_dir = tempfile.mkdtemp()
+        for ending in [True, False]:
+            direct = agg.MoranCumulativeTimeAverager(1000, intervals, popsize, 2, ending_interval=ending)
+            spilled = agg.MoranCumulativeTimeAverager(1000, intervals, popsize, 2, ending_interval=ending,
+                                                      spill_ticks=37, spill_dir=spill_dir)
+            dense_spilled = agg.MoranCumulativeTimeAverager(1000, intervals, popsize, 2, ending_interval=ending,
+                                                            dense=True, spill_ticks=50, spill_dir=spill_dir)
+            spilled.spill_file.chunk_rows = 64
+            self._record_random_ticks([direct, spilled, dense_spilled], 2004)
+
+            expected = direct.get_counts_for_generation_intervals()
+            expected_configs = direct.get_configuration_counts_for_generation_intervals()
+            for tatrack in [spilled, dense_spilled]:
+                self.assertEqual(expected, tatrack.get_counts_for_generation_intervals())
+                self.assertEqual(expected_configs, tatrack.get_configuration_counts_for_generation_intervals())
+                self.assertEqual(expected, dict(tatrack.iter_counts_for_generation_intervals()))
+
+                # totals are streamed from the compacted spill file, never held on the averager
+                self.assertEqual(os.path.getsize(tatrack.spill_file.counts_path), 0)
+                self.assertEqual(os.path.getsize(tatrack.spill_file.configs_path), 0)
+                self.assertTrue(all(len(locus_map[0]) == 0
+                                    for locus_map in tatrack.counts_by_interval_by_locus.values()))
+
+                sampled = tatrack.get_counts_for_generation_for_ssize_for_intervals([5, 10])
+                for gen in expected:
+                    self.assertEqual(sum(sampled[gen][1][10].values()), 10)
+                tatrack.remove_spill_file()
+
+        self.assertEqual(os.listdir(spill_dir), [])
+        os.rmdir(spill_dir)
+
+
+
+    def test_merge_matches_combined_recording(self):
+        log.info("test_merge_matches_combined_recording")
+        popsize = 10
+        intervals = [1, 5, 10, 20]
+        for ending in [True, False]:
+            combined = agg.MoranCumulativeTimeAverager(1000, intervals, popsize, 2, ending_interval=ending)
+            first = agg.MoranCumulativeTimeAverager(1000, intervals, popsize, 2, ending_interval=ending)
+            second = agg.MoranCumulativeTimeAverager(1000, intervals, popsize, 2, ending_interval=ending, dense=True)
+            third = agg.MoranCumulativeTimeAverager(1000, intervals, popsize, 2, ending_interval=ending, segmented=True)
+            self._record_random_ticks([combined, first], 2005)
+            self._record_random_ticks([combined, second], 2006)
+            self._record_random_ticks([combined, third], 2007)
+
+            merged = first.merge(second).merge(third)
+            self.assertEqual(combined.get_counts_for_generation_intervals(), merged.get_counts_for_generation_intervals())
+
+            regrouped = agg.MoranCumulativeTimeAverager(1000, intervals, popsize, 2, ending_interval=ending, segmented=True)
+            regrouped.merge(second.merge(third))
+            self.assertEqual(second.get_counts_for_generation_intervals(), regrouped.get_counts_for_generation_intervals())
+            self.assertEqual(second.get_configuration_counts_for_generation_intervals(),
+                             regrouped.get_configuration_counts_for_generation_intervals())
+
+        with self.assertRaises(ValueError):
+            first.merge(agg.MoranCumulativeTimeAverager(1000, [1, 5], popsize, 2))
+
+
+    def test_save_and_load(self):
+        log.info("test_save_and_load")
+        tatrack = agg.MoranCumulativeTimeAverager(1000, [1, 5, 10, 20], 10, 2, ending_interval=False)
+        self._record_random_ticks([tatrack], 2008)
+        (handle, path) = tempfile.mkstemp(suffix=".npz")
+        os.close(handle)
+        try:
+            tatrack.save(path)
+            for kwargs in [dict(), dict(dense=True), dict(segmented=True)]:
+                loaded = agg.MoranCumulativeTimeAverager.load(path, **kwargs)
+                self.assertEqual(tatrack.get_interval_tuples(), loaded.get_interval_tuples())
+                self.assertEqual(tatrack.get_counts_for_generation_intervals(), loaded.get_counts_for_generation_intervals())
+                self.assertEqual(tatrack.get_configuration_counts_for_generation_intervals(),
+                                 loaded.get_configuration_counts_for_generation_intervals())
+        finally:
+            os.remove(path)
+
+    def test_save_and_load_mixed_labels(self):
+        log.info("test_save_and_load_mixed_labels")
+        tatrack = agg.MoranCumulativeTimeAverager(1000, [1, 5], 2, 2)
+        tatrack.record_trait_count_sample(1000, {0: {'x': 1, 7: 1}, 1: {'y': 2}}, {(7, 'y'): 1, ('x', 'y'): 1})
+        (handle, path) = tempfile.mkstemp(suffix=".npz")
+        os.close(handle)
+        try:
+            tatrack.save(path)
+            loaded = agg.MoranCumulativeTimeAverager.load(path)
+            counts = loaded.get_counts_for_generation_intervals()
+            self.assertEqual(tatrack.get_counts_for_generation_intervals(), counts)
+            self.assertEqual(counts[1][0], Counter({'x': 1, 7: 1}))
+            self.assertEqual(tatrack.get_configuration_counts_for_generation_intervals(),
+                             loaded.get_configuration_counts_for_generation_intervals())
+            self.assertIn((7, 'y'), loaded.get_configuration_counts_for_generation_intervals()[1])
+        finally:
+            os.remove(path)
+
+
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
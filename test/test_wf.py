@@ -11,6 +11,8 @@ Description here
 import logging as log
 import unittest
 import pytransmission.popgen.wright_fisher as wf
+import pytransmission.aggregation as agg
+import numpy as np
 import os
 import tempfile
 
@@ -28,6 +30,26 @@ class WrightFisherTest(unittest.TestCase):
 
         self.assertTrue(True,"Not a full test, always passes")
 
+    def test_wfia_simulation(self):
+        np.random.seed(3001)
+        popsize = 1000
+        sim = wf.WrightFisherInfiniteAlleles(popsize, 0.001, numloci=2, initial_alleles=3)
+        self.assertEqual(sim.get_burn_in_generations(), 4000)
+
+        tatrack = agg.MoranCumulativeTimeAverager(4000, [10, 50], 1, 2, ending_interval=True)
+        sim.run(60, callback=tatrack.record_trait_count_sample)
+        self.assertEqual(sim.generation, 4060)
+
+        for locus in range(0, 2):
+            (traits, counts) = sim.get_trait_counts(locus)
+            self.assertEqual(counts.sum(), popsize)
+            self.assertTrue((counts > 0).all())
+            self.assertEqual(len(set(traits.tolist())), len(traits))
+
+        # generations 4001 - 4060 are reported, so the 50 generation interval holds 4000 - 4049
+        countmap = tatrack.get_counts_for_interval_generations(50)
+        self.assertEqual(sum(countmap[0].values()), 49 * popsize)
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file